@@ -0,0 +1,122 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Synthetic benchmark for bproc_camera_utility.remove_segmap_noise.
+
+Builds segmentation maps of large blobs crossed by thin fronds / fins, adds the stray
+interpolated labels distortion and antialiasing leave along label boundaries, then times the
+vectorized denoiser against the original per-pixel loop and checks the outputs are bit-identical.
+
+    python dev/benchmark_segmap_denoise.py --sizes 256 512 1024 --dtypes float32 uint8
+'''
+
+import argparse
+import time
+
+import numpy as np
+
+from infinigen.core.placement.bproc_camera_utility import remove_segmap_noise, get_pixel_neighbors, is_in
+
+def reference_determine_noisy_pixels(image, threshold=100, image_bit=16):
+    image = (image * 37) / (np.power(2, image_bit))
+    image = image.astype(np.int32)
+    b, counts = np.unique(image.flatten(), return_counts=True)
+    hist = sorted((np.asarray((b, counts)).T), key=lambda x: x[1])
+    noise_vals = [h[0] for h in hist if h[1] <= threshold]
+    return np.argwhere(is_in(image, noise_vals))
+
+def reference_remove_segmap_noise(image, image_bit=0, threshold=200):
+
+    '''
+    remove_segmap_noise as it was before it was vectorized
+    '''
+
+    noise_indices = reference_determine_noisy_pixels(image, image_bit=image_bit, threshold=threshold)
+    for index in noise_indices:
+        neighbors = get_pixel_neighbors(image, index[0], index[1])
+        curr_val = image[index[0]][index[1]][0]
+        neighbor_vals = [image[neighbor[0]][neighbor[1]] for neighbor in neighbors]
+        neighbor_vals = np.unique(np.array([np.array(index) for index in neighbor_vals]))
+        min_val = 10000000000
+        min_idx = 0
+        for idx, n in enumerate(neighbor_vals):
+            if n - curr_val <= min_val:
+                min_val = n - curr_val
+                min_idx = idx
+        new_val = neighbor_vals[min_idx]
+        image[index[0]][index[1]] = np.array([new_val, new_val, new_val])
+    return image
+
+def synthetic_segmap(size, dtype, n_blobs=40, n_fronds=60, noise_fraction=0.3, seed=0):
+
+    rng = np.random.default_rng(seed)
+    max_label = max(250 if dtype == np.uint8 else 5000, n_blobs + n_fronds + 1)
+
+    # blobs: nearest of a few random centers
+    yy, xx = np.mgrid[:size, :size]
+    centers = rng.uniform(0, size, (n_blobs, 2))
+    labels = rng.choice(np.arange(1, max_label), n_blobs + n_fronds, replace=False)
+    d = (yy[..., None] - centers[:, 0]) ** 2 + (xx[..., None] - centers[:, 1]) ** 2
+    seg = labels[np.argmin(d, axis=-1)].astype(np.float64)
+
+    # thin fronds / fins, 1-2px wide random walks
+    for label in labels[n_blobs:]:
+        p = rng.uniform(0, size, 2)
+        heading = rng.uniform(0, 2 * np.pi)
+        width = rng.integers(1, 3)
+        for _ in range(size):
+            heading += rng.normal(0, 0.15)
+            p += (np.sin(heading), np.cos(heading))
+            r, c = p.astype(int)
+            seg[max(r, 0):r + width, max(c, 0):c + width] = label
+
+    # stray values along label boundaries, as left by interpolation
+    boundary = np.zeros_like(seg, dtype=bool)
+    boundary[:-1] |= seg[:-1] != seg[1:]
+    boundary[:, :-1] |= seg[:, :-1] != seg[:, 1:]
+    idx = np.flatnonzero(boundary)
+    idx = rng.choice(idx, int(noise_fraction * len(idx)), replace=False)
+    flat = seg.reshape(-1)
+    flat[idx] = flat[idx] + rng.uniform(0.05, 0.95, len(idx)) * rng.choice([-1, 1], len(idx))
+    if dtype == np.uint8:
+        flat[:] = np.clip(np.rint(flat), 0, 255)
+
+    return np.repeat(seg[..., None], 3, axis=2).astype(dtype)
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--dtypes', nargs='+', default=['float32', 'uint8'])
+    parser.add_argument('--seeds', type=int, default=2)
+    parser.add_argument('--fronds', type=int, default=60)
+    parser.add_argument('--noise_fraction', type=float, default=0.3)
+    parser.add_argument('--skip_reference', action='store_true', help='only time the vectorized version, eg for 4K maps')
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'dtype':>8} {'seed':>4} {'noisy px':>9} {'vectorized s':>13} {'reference s':>12} {'identical':>9}")
+    for size in args.sizes:
+        for dtype in args.dtypes:
+            for seed in range(args.seeds):
+                image = synthetic_segmap(size, np.dtype(dtype).type, n_fronds=args.fronds,
+                                         noise_fraction=args.noise_fraction, seed=seed)
+                n_noisy = len(np.unique(reference_determine_noisy_pixels(image, image_bit=0, threshold=200)[:, :2], axis=0))
+
+                t = time.perf_counter()
+                fast = remove_segmap_noise(image.copy())
+                t_fast = time.perf_counter() - t
+
+                t_ref, identical = float('nan'), '-'
+                if not args.skip_reference:
+                    t = time.perf_counter()
+                    ref = reference_remove_segmap_noise(image.copy())
+                    t_ref = time.perf_counter() - t
+                    identical = np.array_equal(fast, ref, equal_nan=True) and fast.dtype == ref.dtype
+
+                print(f'{size:>6} {dtype:>8} {seed:>4} {n_noisy:>9} {t_fast:>13.3f} {t_ref:>12.3f} {str(identical):>9}')
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,10 @@
 from copy import deepcopy, copy
 import logging
 import math
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
 
 import bpy
 import mathutils
@@ -19,16 +23,64 @@ from tqdm import trange, tqdm
 
 from infinigen.assets.creatures.util.geometry.curve import Curve
 
-from infinigen.core.util.math import clip_gaussian, lerp
+from infinigen.core.util.math import clip_gaussian, lerp, FixedSeed, int_hash
 from infinigen.core.util.random import random_general
+from infinigen.core.util.logging import Timer
 from infinigen.core.util import blender as butil
+from infinigen.core.placement import trajectory, navlog, heightfield, raycast, auv_dynamics
+from infinigen.core.placement.telemetry import animation_telemetry
 
 logger = logging.getLogger(__name__)
 
 class PolicyError(ValueError):
     pass
 
+def timed_validate(validate_pose_func, obj):
+    start = time.perf_counter()
+    res = validate_pose_func(obj)
+    animation_telemetry.validation(time.perf_counter() - start)
+    return res
+
+def validate_planned_poses(obj, frames, locs, rots, validate_pose_func, stride=1):
+
+    '''
+    Checks every `stride`th pose of a planned trajectory with validate_pose_func, raising PolicyError on the first failure
+    '''
+
+    for i in range(0, len(frames), stride):
+        obj.location, obj.rotation_euler = locs[i], rots[i]
+        if not timed_validate(validate_pose_func, obj):
+            animation_telemetry.reject('validate_pose')
+            raise PolicyError(f'validate_pose_func failed for {obj.name=} planned trajectory at frame {frames[i]}')
+
+def plan_start(obj):
+
+    '''
+    Everything a policy's plan() reads from blender, as plain data: obj's name and pose, the scene's
+    frame range and fps, and sensor_width / lens of obj's first child camera (None if it has none)
+    '''
+
+    scene = bpy.context.scene
+    cams = [c for c in obj.children if c.type == 'CAMERA']
+    return dict(
+        name=obj.name,
+        location=np.array(obj.location, dtype=np.float64),
+        rotation_euler=np.array(obj.rotation_euler, dtype=np.float64),
+        frame_start=scene.frame_start,
+        frame_end=scene.frame_end,
+        fps=scene.render.fps,
+        footprint_ratio=cams[0].data.sensor_width / cams[0].data.lens if cams else None,
+    )
+
+def plan_and_validate(policy, obj, bvh, validate_pose_func=None):
+    frames, locs, rots = policy.plan(plan_start(obj), bvh)
+    if validate_pose_func is not None and policy.validate_stride is not None:
+        validate_planned_poses(obj, frames, locs, rots, validate_pose_func, policy.validate_stride)
+    return frames, locs, rots
+
 def get_altitude(loc, terrain_bvh, dir=Vector((0.,0.,-1.))):
+    if hasattr(terrain_bvh, 'altitude_one') and tuple(dir) == (0, 0, -1):
+        return terrain_bvh.altitude_one(loc)
     *_, straight_down_dist = terrain_bvh.ray_cast(loc, dir)
     return straight_down_dist
 
@@ -107,12 +159,45 @@ class AnimPolicyBrownian:
 @gin.configurable
 class AnimPolicyMowTheLawn:
 
-    def __init__(self, speed=("clip_gaussian", 0.5, 0.1, 0.4, 0.6), fps=2, percent_var=0.1, turn_frames=4, transect_multiple=5):
+    '''
+    With use_planner, animate_trajectory calls plan_trajectory to lay out the whole survey at once.
+    Otherwise __call__ is used to walk it one keyframe at a time, as by default.
+    The planned survey follows auv_dynamics rather than jittering each step, so percent_var only
+    applies to the keyframe walk.
+
+    line_spacing: distance between transects, defaults to the camera footprint width reduced by side_overlap
+    transect_length: defaults to the distance covered in turn_frames * transect_multiple frames
+    altitude: altitude to hold above the seabed, defaults to the starting altitude
+    dynamics: auv_dynamics.AUVDynamics limiting turn rate, depth rate etc of the planned survey
+    '''
+
+    def __init__(
+        self, 
+        speed=("clip_gaussian", 0.5, 0.1, 0.4, 0.6), 
+        fps=2, 
+        percent_var=0.1, 
+        turn_frames=4, 
+        transect_multiple=5,
+        use_planner=False,
+        line_spacing=None,
+        side_overlap=0.3,
+        transect_length=None,
+        altitude=None,
+        dynamics=None,
+        validate_stride=5,
+    ):
         self.speed = speed
         self.fps = fps
         self.percent_var = percent_var
         self.transect_frames = turn_frames * transect_multiple
         self.turn_frames = turn_frames
+        self.use_planner = use_planner
+        self.line_spacing = line_spacing
+        self.side_overlap = side_overlap
+        self.transect_length = transect_length
+        self.altitude = altitude
+        self.dynamics = dynamics if dynamics is not None else auv_dynamics.AUVDynamics()
+        self.validate_stride = validate_stride
 
     def __call__(self, obj, frame_curr, bvh, retry_pct):
         speed = random_general(self.speed)
@@ -143,6 +228,185 @@ class AnimPolicyMowTheLawn:
 
         return Vector(pos), Vector(rot), time, "BEZIER"
 
+    def plan_trajectory(self, obj, bvh, validate_pose_func=None):
+
+        '''
+        Lays out the whole survey from obj's current pose. Returns keyframe frames (K,), locations (K, 3)
+        and rotations (K, 3), or raises PolicyError if the draped path hits terrain or fails validation
+        '''
+
+        return plan_and_validate(self, obj, bvh, validate_pose_func)
+
+    def plan(self, start, bvh):
+
+        '''
+        plan_trajectory without validation, from a plan_start dict rather than the rig, so it needs no bpy
+        '''
+
+        scene_fps = start['fps']
+        speed = random_general(self.speed)
+
+        loc0, rot0 = start['location'], start['rotation_euler']
+        altitude = random_general(self.altitude) if self.altitude is not None else get_altitude(Vector(loc0), bvh)
+        if altitude is None:
+            raise PolicyError(f'{start["name"]=} has no terrain below it')
+
+        line_spacing = self.line_spacing
+        if line_spacing is None:
+            if start['footprint_ratio'] is None:
+                line_spacing = speed * self.turn_frames / self.fps
+            else:
+                line_spacing = altitude * start['footprint_ratio'] * (1 - self.side_overlap)
+        transect_length = self.transect_length
+        if transect_length is None:
+            transect_length = speed * self.transect_frames / self.fps
+
+        # dense pose at every frame, in the rig's frame of reference then rotated into the world
+        frames = np.arange(start['frame_start'], start['frame_end'] + 1)
+        t = (frames - start['frame_start']) / scene_fps
+        s = self.dynamics.survey_arclength(t, speed, transect_length, line_spacing)
+        local_xy, heading = trajectory.lawnmower_path(s, transect_length, line_spacing)
+
+        yaw0 = rot0[2]
+        u = np.array([np.cos(yaw0 + np.pi/2), np.sin(yaw0 + np.pi/2)])
+        v = np.array([-u[1], u[0]])
+        xy = loc0[:2] + local_xy[:, :1] * u + local_xy[:, 1:] * v
+
+        ground = trajectory.ground_height(bvh, xy)
+        if np.isnan(ground).any():
+            raise PolicyError(f'Planned survey leaves the terrain at frame {frames[np.isnan(ground)][0]}')
+        z = self.dynamics.altitude_hold(t, ground, altitude)
+
+        locs = np.column_stack([xy, z])
+        pitch, roll = self.dynamics.attitude(t)
+        rots = np.column_stack([rot0[0] + pitch, rot0[1] + roll, yaw0 + heading])
+
+        if not trajectory.segments_clear(bvh, locs[:-1], locs[1:]).all():
+            raise PolicyError('Planned survey path intersects the terrain')
+
+        step = int((1 / self.fps - 0.001) * scene_fps) + 1
+        keys = np.unique(np.append(np.arange(0, len(frames), step), len(frames) - 1))
+        logger.info(
+            f'Planned survey for {start["name"]=} with {len(keys)} keyframes, {speed=:.2f} {altitude=:.2f} '
+            f'{line_spacing=:.2f} {transect_length=:.2f}'
+        )
+
+        return frames[keys], locs[keys], rots[keys]
+
+@gin.configurable
+class AnimPolicyNavLogReplay:
+
+    '''
+    Replays a real AUV navigation log (CSV or Parquet) as the rig trajectory, via plan_trajectory.
+
+    The log is streamed in chunks, keeping only the time window covering the scene's frame range.
+    Positions are linearly interpolated and attitude slerped to every frame. Track xy is placed
+    relative to the rig's starting location, and z is re-anchored to the synthetic seabed using
+    the logged altitude, so the replay sits at the real altitude above our terrain.
+
+    columns: maps time, x, y (or lat, lon), altitude, heading, pitch, roll to log column names.
+        pitch / roll may be None. heading is a compass bearing, clockwise from north
+    start_time: log time in seconds to start the replay at, defaults to the first row of the log
+    validate_stride: run validate_pose_func on every validate_stride-th replayed pose. Defaults to None,
+        which skips it and only checks the track stays above and clear of the terrain, since the
+        logged track is fixed and a failing pose cannot be fixed by retrying
+    '''
+
+    use_planner = True
+
+    def __init__(
+        self,
+        path,
+        columns=dict(
+            time='time', x='easting', y='northing', lat=None, lon=None,
+            altitude='altitude', heading='heading', pitch='pitch', roll='roll',
+        ),
+        start_time=None,
+        angles_in_degrees=True,
+        altitude_offset=0.0,
+        min_clearance=0.5,
+        chunksize=100_000,
+        validate_stride=None,
+    ):
+        self.path = path
+        self.columns = columns
+        self.start_time = start_time
+        self.angles_in_degrees = angles_in_degrees
+        self.altitude_offset = altitude_offset
+        self.min_clearance = min_clearance
+        self.chunksize = chunksize
+        self.validate_stride = validate_stride
+
+    def read_track(self, duration):
+        names = {k: v for k, v in self.columns.items() if v is not None}
+        use_latlon = 'x' not in names
+        needed = ['time', 'lat', 'lon'] if use_latlon else ['time', 'x', 'y']
+        needed += ['altitude', 'heading'] + [k for k in ['pitch', 'roll'] if k in names]
+
+        window = navlog.read_window(
+            self.path, [names[k] for k in needed], 
+            start_time=self.start_time, duration=duration, chunksize=self.chunksize
+        )
+        track = {k: window[names[k]].astype(np.float64) for k in needed}
+
+        # read_window keeps the row before start_time for interpolation, the replay itself starts at start_time
+        t = track['time']
+        track['start'] = t[0] if self.start_time is None else np.clip(self.start_time, t[0], t[-1])
+        if use_latlon:
+            lat0 = np.interp(track['start'], t, track['lat'])
+            lon0 = np.interp(track['start'], t, track['lon'])
+            track['x'], track['y'] = navlog.latlon_to_local(track['lat'], track['lon'], lat0, lon0)
+        for k in ['heading', 'pitch', 'roll']:
+            if k not in track:
+                track[k] = np.zeros_like(track['time'])
+            elif self.angles_in_degrees:
+                track[k] = np.deg2rad(track[k])
+        return track
+
+    def plan_trajectory(self, obj, bvh, validate_pose_func=None):
+
+        '''
+        Returns keyframe frames (K,), locations (K, 3) and rotations (K, 3) for every frame of the scene
+        '''
+
+        return plan_and_validate(self, obj, bvh, validate_pose_func)
+
+    def plan(self, start, bvh):
+
+        from scipy.spatial.transform import Rotation, Slerp
+
+        fps = start['fps']
+        frames = np.arange(start['frame_start'], start['frame_end'] + 1)
+        duration = (start['frame_end'] - start['frame_start']) / fps
+        track = self.read_track(duration)
+
+        t, t0 = track['time'], track['start']
+        times = np.clip(t0 + (frames - start['frame_start']) / fps, t0, t[-1])
+        if times[-1] - t0 < duration - 1e-6:
+            logger.warning(f'Nav log {self.path} is shorter than the scene, holding its last pose')
+
+        xy = np.stack([np.interp(times, t, track['x']), np.interp(times, t, track['y'])], axis=-1)
+        xy = xy - xy[0] + start['location'][:2]
+        altitude = np.interp(times, t, track['altitude']) + self.altitude_offset
+
+        ground = trajectory.ground_height(bvh, xy)
+        if np.isnan(ground).any():
+            raise PolicyError(f'Nav log track leaves the terrain at frame {frames[np.isnan(ground)][0]}')
+        z = np.maximum(ground + altitude, ground + self.min_clearance)
+        locs = np.column_stack([xy, z])
+
+        # compass heading is clockwise from north, blender yaw is anticlockwise with the rig facing +y at 0
+        nav_rot = Rotation.from_euler('ZXY', np.stack([-track['heading'], track['pitch'], track['roll']], axis=-1))
+        nav_rot = Slerp(t, nav_rot)(times)
+        mount = Rotation.from_euler('xyz', [start['rotation_euler'][0], start['rotation_euler'][1], 0])
+        rots = np.unwrap((nav_rot * mount).as_euler('xyz'), axis=0)
+
+        if not trajectory.segments_clear(bvh, locs[:-1], locs[1:]).all():
+            raise PolicyError('Nav log track intersects the terrain')
+
+        logger.info(f'Replaying {len(frames)} frames of {self.path} from {t0=}')
+        return frames, locs, rots
+
 @gin.configurable
 class AnimPolicyPan:
 
@@ -169,6 +433,15 @@ class AnimPolicyPan:
 @gin.configurable
 class AnimPolicyRandomForwardWalk:
 
+    '''
+    With use_planner, plan_trajectory integrates the whole walk with auv_dynamics: the vehicle surges along
+    forward_vec at `speed`, and every step_range meters is commanded a heading change from yaw_dist, flown at
+    the dynamics' max yaw rate, and turned back at the edges of the terrain with AUVDynamics.keep_within.
+    Otherwise __call__ samples one step at a time, as by default. The planned walk follows auv_dynamics
+    rather than jittering each step, so rot_vars only applies to the step walk, and altitude_var is
+    drawn once for the whole planned walk rather than once per step.
+    '''
+
     def __init__(
         self, 
         forward_vec,
@@ -177,6 +450,9 @@ class AnimPolicyRandomForwardWalk:
         altitude_var=0,
         step_range=(1, 10),
         rot_vars=[5, 0, 5],
+        use_planner=False,
+        dynamics=None,
+        validate_stride=5,
     ):
         self.speed = speed
         self.yaw_dist = yaw_dist
@@ -184,6 +460,9 @@ class AnimPolicyRandomForwardWalk:
         self.altitude_var = altitude_var
         self.rot_vars = rot_vars
         self.forward_vec = forward_vec
+        self.use_planner = use_planner
+        self.dynamics = dynamics if dynamics is not None else auv_dynamics.AUVDynamics()
+        self.validate_stride = validate_stride
 
     def __call__(self, obj, frame_curr, bvh, retry_pct):
 
@@ -203,6 +482,56 @@ class AnimPolicyRandomForwardWalk:
         rot = np.array(obj.rotation_euler) + np.deg2rad(N(0, self.rot_vars, 3))
 
         return Vector(pos), Vector(rot), time, 'BEZIER'
+
+    def plan_trajectory(self, obj, bvh, validate_pose_func=None):
+
+        '''
+        Returns frames (K,), locations (K, 3) and rotations (K, 3) for every frame, or raises PolicyError
+        '''
+
+        return plan_and_validate(self, obj, bvh, validate_pose_func)
+
+    def plan(self, start, bvh):
+        frames = np.arange(start['frame_start'], start['frame_end'] + 1)
+        t = (frames - start['frame_start']) / start['fps']
+        speed = self.dynamics.surge_speed(random_general(self.speed))
+
+        loc0, rot0 = start['location'], start['rotation_euler']
+        altitude = get_altitude(Vector(loc0), bvh)
+        if altitude is None:
+            raise PolicyError(f'{start["name"]=} has no terrain below it')
+        altitude += N(0, self.altitude_var)
+
+        # heading change commands, one per step_range meters travelled
+        steps = U(*self.step_range, size=int(speed * t[-1] / self.step_range[0]) + 1)
+        times = np.cumsum(steps) / speed
+        changes = np.deg2rad([random_general(self.yaw_dist) for _ in times])
+
+        direction0 = np.array(Euler(rot0, 'XYZ').to_matrix() @ Vector(self.forward_vec))[:2]
+        if np.linalg.norm(direction0) < 1e-6:
+            raise PolicyError(f'{self.forward_vec=} has no horizontal component for {start["name"]=}')
+        direction0 /= np.linalg.norm(direction0)
+
+        bounds = trajectory.terrain_xy_bounds(bvh)
+        if bounds is None:
+            heading = self.dynamics.heading_changes(t, times, changes)
+            xy = loc0[:2] + self.dynamics.integrate_planar(t, speed, heading, direction0)
+        else:
+            # turn back at the edges of the terrain rather than failing with PolicyError below
+            heading, xy = self.dynamics.keep_within(t, speed, times, changes, direction0, loc0[:2], *bounds)
+
+        ground = trajectory.ground_height(bvh, xy)
+        if np.isnan(ground).any():
+            raise PolicyError(f'Planned walk leaves the terrain at frame {frames[np.isnan(ground)][0]}')
+        locs = np.column_stack([xy, self.dynamics.altitude_hold(t, ground, altitude)])
+
+        pitch, roll = self.dynamics.attitude(t)
+        rots = np.column_stack([rot0[0] + pitch, rot0[1] + roll, rot0[2] + heading])
+
+        if not trajectory.segments_clear(bvh, locs[:-1], locs[1:]).all():
+            raise PolicyError('Planned walk intersects the terrain')
+
+        return frames, locs, rots
     
 @gin.configurable
 class AnimPolicyRandomWalkLookaround:
@@ -342,35 +671,59 @@ def validate_keyframe_range(
     start_frame, end_frame, 
     bvhtree, validate_pose_func=None,
     stride=5, # runs faster but imperfect precision
-    check_straight_line=True # rules out proposals faster, but has imperfect precision
+    check_straight_line=True, # rules out proposals faster, but has imperfect precision
+    trajectory_buffer=None,
 ):
-    
-    last_pos = deepcopy(obj.location)
 
-    def freespace_ray_check(a, b):
-        location, *_ = bvhtree.ray_cast(a, b - a, (a - b).length)
-        return location is None
+    '''
+    Poses are sampled from trajectory_buffer if given, else from obj's fcurves. All freespace segments
+    are checked in one batch before validate_pose_func is run on each sampled pose in order.
+    The scene frame is only changed when obj has constraints, drivers or animated parents
+    (eg AnimPolicyFollowObject's TRACK_TO), so they are evaluated at the frame being validated
+    '''
+
+    start_pos = np.array(obj.location)
+    evaluate_scene = trajectory.needs_scene_evaluation(obj)
+
+    frames = np.arange(start_frame, end_frame + 1, stride)
+    sample_frames = np.append(frames, end_frame)
+    if trajectory_buffer is not None:
+        locs, rots = trajectory_buffer.evaluate(sample_frames)
+        locs = np.where(np.isnan(locs), np.array(obj.location), locs)
+        rots = np.where(np.isnan(rots), np.array(obj.rotation_euler), rots)
+    else:
+        locs, rots = trajectory.sample_object_trajectory(obj, sample_frames)
+
 
     if check_straight_line:
-        bpy.context.scene.frame_set(end_frame)
-        if not freespace_ray_check(last_pos, obj.location):
+        animation_telemetry.rays('straight_line', 1)
+        if not trajectory.segments_clear(bvhtree, start_pos[None], locs[-1:])[0]:
             logger.debug('straight line check failed')
+            animation_telemetry.reject('straight_line')
             return False
 
-    for frame_idx in range(start_frame, end_frame + 1, stride):
-        bpy.context.scene.frame_set(frame_idx)
+    locs, rots = locs[:-1], rots[:-1]
+    clear = trajectory.segments_clear(bvhtree, np.vstack([start_pos, locs[:-1]]), locs)
+    animation_telemetry.rays('freespace', len(locs))
 
-        if not freespace_ray_check(last_pos, obj.location):
+    for i, frame_idx in enumerate(frames):
+
+        if not clear[i]:
             logger.debug(f'{frame_idx=} freespace_ray_check failed')
+            animation_telemetry.reject('freespace')
             return False
 
-        if validate_pose_func is not None and not validate_pose_func(obj): 
+        if evaluate_scene:
+            bpy.context.scene.frame_set(int(frame_idx))
+        obj.location, obj.rotation_euler = locs[i], rots[i]
+        if evaluate_scene:
+            bpy.context.view_layer.update()
+        if validate_pose_func is not None and not timed_validate(validate_pose_func, obj): 
             # technically we should validate against all cameras, but this would be expensive
             logger.debug(f'{frame_idx} validate_pose_func failed')
+            animation_telemetry.reject('validate_pose')
             return False    
 
-        last_pos = deepcopy(obj.location)
-
     return True
 
 def try_animate_trajectory(
@@ -379,6 +732,7 @@ def try_animate_trajectory(
     validate_pose_func=None,
     max_step_tries=50,
     verbose=True,
+    trajectory_buffer=None,
 ):
  
     frame_curr = bpy.context.scene.frame_start
@@ -399,6 +753,7 @@ def try_animate_trajectory(
                 )
             except PolicyError as e:
                 logger.debug(f'PolicyError on {retry=} {e=}')
+                animation_telemetry.reject('policy_error')
                 continue
             
             step_frames = int(duration * bpy.context.scene.render.fps) + 1
@@ -406,9 +761,14 @@ def try_animate_trajectory(
 
             keyframe(loc, rot, step_end_frame, interp='BEZIER')
 
-            if not validate_keyframe_range(obj, frame_curr, step_end_frame, bvh, validate_pose_func):
+            if not validate_keyframe_range(
+                obj, frame_curr, step_end_frame, bvh, validate_pose_func, trajectory_buffer=trajectory_buffer
+            ):
                 logger.debug(f'validate_keyframe_range failed on moving {obj.location} to {loc}')
                 # clear out the candidate keyframes we just inserted, they were no good
+                if trajectory_buffer is not None:
+                    trajectory_buffer.pop()
+                    continue
                 for fc in obj.animation_data.action.fcurves:
                     if fc.data_path == "":
                         continue
@@ -418,9 +778,11 @@ def try_animate_trajectory(
             if verbose:
                 pbar.update(min(step_frames, duration_frames - frame_curr)) # dont overshoot the pbar, it makes the formatting not nice
 
+            animation_telemetry.accept()
             break # we found a good pose
 
         else: # for-else block triggers when for loop terminates w/o a break statement
+            animation_telemetry.reject('step_tries_exhausted')
             return False
 
         frame_curr = step_end_frame
@@ -439,39 +801,39 @@ def animate_trajectory(
     verbose=True,
     fatal=False,
     reverse_time=False,
+    plan=None,
+    flush=True,
 ):
+
+    '''
+    plan: optional (frames, locs, rots) already computed by policy_func.plan_trajectory, eg by plan_trajectories_parallel.
+        It is validated here and used for the first attempt, later attempts replan as usual
+    flush: if False, return the successful TrajectoryBuffer instead of writing it to obj, so the caller can apply many at once
+    '''
+
     duration_frames = (bpy.context.scene.frame_end - bpy.context.scene.frame_start)
     duration_sec = duration_frames / bpy.context.scene.render.fps
     if duration_sec < 1e-3:
         return
 
-    def keyframe(loc, rot, t, interp=default_interpolation):
-
-        if obj.animation_data is not None and obj.animation_data.action is not None:
-            for fc in obj.animation_data.action.fcurves:
-                for kp in fc.keyframe_points:
-                    if kp.co > t:
-                        raise ValueError(f'Unexpected out-of-order keyframing {kp.co=}, {t=}')
+    buffer = trajectory.TrajectoryBuffer()
 
+    def keyframe(loc, rot, t, interp=default_interpolation):
+        buffer.append(t, loc, rot, interp)
         if loc is not None:
             obj.location = loc
-            obj.keyframe_insert(data_path="location", frame=t),
-
         if rot is not None:
             obj.rotation_euler = rot
-            obj.keyframe_insert(data_path="rotation_euler", frame=t)
-
-        for fc in obj.animation_data.action.fcurves:
-            for k in fc.keyframe_points:
-                if k.co[0] == t:
-                    k.interpolation = interp
     
     obj_orig_loc = copy(obj.location)
     obj_orig_rot = copy(obj.rotation_euler)
+    animation_telemetry.begin_rig(obj.name)
 
     for attempt in range(max_full_retries):
 
+        animation_telemetry.attempt()
         obj.animation_data_clear()
+        buffer.trim(0)
         obj.location = obj_orig_loc
         obj.rotation_euler = obj_orig_rot
         if attempt > 0 and retry_rotation:
@@ -481,33 +843,43 @@ def animate_trajectory(
             policy_func.reset()
 
         keyframe(obj.location, obj.rotation_euler, 0, interp='LINEAR')
-        if try_animate_trajectory(obj, bvh, policy_func, keyframe, duration_frames, validate_pose_func, max_step_tries, verbose):
+        if getattr(policy_func, 'use_planner', False):
+            start_loc, start_rot = copy(obj.location), copy(obj.rotation_euler)
+            try:
+                if attempt == 0 and plan is not None:
+                    frames, locs, rots = plan
+                    stride = getattr(policy_func, 'validate_stride', 1)
+                    if validate_pose_func is not None and stride is not None:
+                        validate_planned_poses(obj, frames, locs, rots, validate_pose_func, stride)
+                else:
+                    frames, locs, rots = policy_func.plan_trajectory(obj, bvh, validate_pose_func)
+                if frames[0] == 0:
+                    frames, locs, rots = frames[1:], locs[1:], rots[1:]
+                buffer.extend(frames, locs, rots, interp=default_interpolation)
+                success = True
+            except PolicyError as e:
+                logger.debug(f'plan_trajectory failed with {e=}')
+                animation_telemetry.reject('plan_rejected')
+                success = False
+            obj.location, obj.rotation_euler = start_loc, start_rot
+        else:
+            success = try_animate_trajectory(
+                obj, bvh, policy_func, keyframe, duration_frames, validate_pose_func, 
+                max_step_tries, verbose, trajectory_buffer=buffer
+            )
+
+        if success:
             if reverse_time:
-                kf_locs = []
-                kf_rots = []
-                kf_ts = []
-                for j in range(len(obj.animation_data.action.fcurves[0].keyframe_points)):
-                    kf_ts.append(obj.animation_data.action.fcurves[0].keyframe_points[j].co.x)
-                    kf_locs.append((
-                        obj.animation_data.action.fcurves[0].keyframe_points[j].co.y,
-                        obj.animation_data.action.fcurves[1].keyframe_points[j].co.y,
-                        obj.animation_data.action.fcurves[2].keyframe_points[j].co.y,
-                    ))
-                    kf_rots.append((
-                        obj.animation_data.action.fcurves[3].keyframe_points[j].co.y,
-                        obj.animation_data.action.fcurves[4].keyframe_points[j].co.y,
-                        obj.animation_data.action.fcurves[5].keyframe_points[j].co.y,
-                    ))
-                obj.animation_data_clear()
-                for i, t in enumerate(kf_ts):
-                    keyframe(kf_locs[i], kf_rots[i], bpy.context.scene.frame_end + bpy.context.scene.frame_start - t, interp='LINEAR')
-                # bpy.context.scene.frame_set(bpy.context.scene.frame_end)
-                # obj.keyframe_insert(data_path="location", frame=bpy.context.scene.frame_end)
-                # obj.keyframe_insert(data_path="rotation_euler", frame=bpy.context.scene.frame_end)
-                # assert(0)
+                scene = bpy.context.scene
+                buffer = buffer.reversed(scene.frame_start, scene.frame_end, interp='LINEAR')
+            animation_telemetry.end_rig(True)
+            if not flush:
+                return buffer
+            buffer.flush(obj)
             break
         logger.info(f'Failed {attempt=} out of {max_full_retries=} for {obj.name=}')
     else:
+        animation_telemetry.end_rig(False)
         err = f'Animation for {obj.name=} failed with {max_full_retries=} and {max_step_tries=}, quitting'
         if fatal:
             raise ValueError(err)
@@ -515,6 +887,87 @@ def animate_trajectory(
             logger.warning(err)
             return
     
+_PLANNER_STATE = {}
+
+def _init_plan_worker(index_dir):
+    index_dir = Path(index_dir)
+    if (index_dir/'heightfield.json').exists():
+        bvh = heightfield.SeabedHeightfield.load(index_dir)
+    else:
+        bvh = raycast.RaycasterBVH(raycast.MeshRaycaster.load(index_dir))
+    _PLANNER_STATE['bvh'] = bvh
+
+def _plan_worker(i):
+    # only plain data from plan_start is read here, blender state in a forked child is not safe to use.
+    # animation_telemetry is per process, so failed attempts are returned for the parent to record
+    state = _PLANNER_STATE
+    start, policy = state['starts'][i], state['policies'][i]
+    with FixedSeed(int_hash((state['seed'], i))):
+        for attempt in range(state['max_full_retries']):
+            if hasattr(policy, 'reset'):
+                policy.reset()
+            try:
+                return policy.plan(start, state['bvh']), attempt
+            except PolicyError as e:
+                logger.debug(f'plan for {start["name"]=} failed {attempt=} with {e=}')
+    return None, state['max_full_retries']
+
+@gin.configurable
+def plan_trajectories_parallel(objs, policies, bvh, raycaster=None, n_workers=4, max_full_retries=10):
+
+    '''
+    Runs policy.plan for every (obj, policy) pair concurrently in forked worker processes.
+    Each obj's start pose, frame range and fps are read into a plan_start dict first, so workers never read bpy state.
+
+    The terrain index (SeabedHeightfield and/or MeshRaycaster) is exported once to .npy files which every
+    worker memory-maps read-only, so workers never touch the mathutils BVHTree. Each obj gets its own seed
+    stream derived from the current random state, so results do not depend on worker scheduling.
+    Pose validation needs the full blender scene, so it is left to the caller (see animate_trajectory's plan argument)
+    and runs serially: only planning gets faster with n_workers, not validate_pose_func.
+
+    Failed attempts in the workers are recorded in animation_telemetry under each obj's name.
+
+    Returns a list with (frames, locs, rots) per obj, or None where planning failed or could not run
+    '''
+
+    results = [None] * len(objs)
+    if isinstance(bvh, heightfield.SeabedHeightfield):
+        export = bvh.save
+    elif raycaster is not None:
+        export = raycaster.save
+    else:
+        logger.warning(f'plan_trajectories_parallel needs a heightfield or raycaster terrain index, planning sequentially')
+        return results
+
+    try:
+        ctx = multiprocessing.get_context('fork')
+    except ValueError:
+        logger.warning(f'fork start method unavailable, planning sequentially')
+        return results
+
+    _PLANNER_STATE.update(
+        starts=[plan_start(obj) for obj in objs],
+        policies=list(policies),
+        seed=np.random.randint(np.iinfo(np.int32).max),
+        max_full_retries=max_full_retries,
+    )
+    try:
+        with tempfile.TemporaryDirectory(prefix='terrain_index_') as index_dir:
+            with Timer('Exporting terrain index'):
+                export(index_dir)
+            with ctx.Pool(min(n_workers, len(objs)), initializer=_init_plan_worker, initargs=(index_dir,)) as pool:
+                results = pool.map(_plan_worker, range(len(objs)))
+    finally:
+        _PLANNER_STATE.clear()
+
+    # counted as animate_trajectory counts its own failed plans, the successful plan is counted when it is validated
+    for obj, (_, n_failed) in zip(objs, results):
+        animation_telemetry.add_attempts(obj.name, n_failed, {'plan_rejected': n_failed})
+    results = [plan for plan, _ in results]
+
+    logger.info(f'Planned {sum(r is not None for r in results)}/{len(objs)} trajectories with {n_workers=}')
+    return results
+
 def policy_create_bezier_path(start_pose_obj, bvh, policy_func, to_mesh=False, eval_offset=(0,0,0), **kwargs):
     
     eval_offset = Vector(eval_offset)
@@ -529,10 +982,9 @@ def policy_create_bezier_path(start_pose_obj, bvh, policy_func, to_mesh=False, e
     positions = []
     if temp.animation_data is not None:
         fc = next(fc for fc in temp.animation_data.action.fcurves if fc.data_path == 'location')
-        for p in fc.keyframe_points:
-            f = int(p.co[0])
-            bpy.context.scene.frame_set(f)
-            positions.append(deepcopy(temp.location - eval_offset))
+        frames, *_ = trajectory.read_fcurve(fc)
+        locs, _ = trajectory.sample_object_trajectory(temp, frames.astype(int))
+        positions = [Vector(loc) - eval_offset for loc in locs]
 
     logger.debug(f'Created policy path with {len(positions)} keypoints')
 
@@ -0,0 +1,213 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Vectorized kinematic model of a survey AUV.
+
+Rather than sampling random steps and rejecting implausible ones, planner policies describe
+what the vehicle is commanded to do (speed, heading changes, altitude) and AUVDynamics turns
+that into the motion a real vehicle could achieve: surge speed and yaw rate are limited, an
+altitude-hold controller follows the seabed with a first-order lag and a maximum depth rate,
+and the hull pitches / rolls slightly. Every step is a whole-trajectory numpy operation, so a
+survey is integrated in one pass with a single batched seabed lookup.
+'''
+
+import logging
+
+import gin
+import numpy as np
+from numpy.random import uniform as U
+from scipy.signal import lfilter
+
+from infinigen.core.util.random import random_general
+
+logger = logging.getLogger(__name__)
+
+def lipschitz_majorant(f, c):
+
+    '''
+    Smallest g >= f with |g[k+1] - g[k]| <= c, ie max_j f[j] - c|k - j|, via two running maxima
+    '''
+
+    idx = np.arange(len(f))
+    forward = np.maximum.accumulate(f + c * idx) - c * idx
+    backward = np.maximum.accumulate((f - c * idx)[::-1])[::-1] + c * idx
+    return np.maximum(forward, backward)
+
+@gin.configurable
+class AUVDynamics:
+
+    '''
+    max_surge_speed: m/s, commanded speeds are clipped to this. The default covers the planner policies' default speeds
+    max_yaw_rate: deg/s, turns are flown no tighter than this allows at the current speed
+    max_depth_rate: m/s, limits climb / descent of the altitude-hold controller
+    altitude_time_constant: s, first-order lag of the altitude-hold controller
+    min_clearance: m, the vehicle always climbs early enough to stay this far above the seabed
+    pitch_amplitude, roll_amplitude: deg, small hull oscillations
+    oscillation_period: s, period of the oscillations, sampled per trajectory
+    '''
+
+    def __init__(
+        self,
+        max_surge_speed=2.0,
+        max_yaw_rate=15,
+        max_depth_rate=0.3,
+        altitude_time_constant=2.0,
+        min_clearance=0.5,
+        pitch_amplitude=1.0,
+        roll_amplitude=1.5,
+        oscillation_period=('uniform', 4, 10),
+    ):
+        self.max_surge_speed = max_surge_speed
+        self.max_yaw_rate = max_yaw_rate
+        self.max_depth_rate = max_depth_rate
+        self.altitude_time_constant = altitude_time_constant
+        self.min_clearance = min_clearance
+        self.pitch_amplitude = pitch_amplitude
+        self.roll_amplitude = roll_amplitude
+        self.oscillation_period = oscillation_period
+
+    def surge_speed(self, speed):
+        if speed > self.max_surge_speed:
+            logger.info(f'Clipping commanded {speed=:.2f} to {self.max_surge_speed=}')
+        return min(speed, self.max_surge_speed)
+
+    def survey_arclength(self, t, speed, transect_length, line_spacing):
+
+        '''
+        Distance along trajectory.lawnmower_path travelled by times `t`. Straight legs are flown at
+        `speed`, the semicircular turns are slowed down so their yaw rate stays under max_yaw_rate
+        '''
+
+        speed = self.surge_speed(speed)
+        r = line_spacing / 2
+        turn_speed = min(speed, np.deg2rad(self.max_yaw_rate) * r)
+
+        straight_time = transect_length / speed
+        period_time = straight_time + np.pi * r / turn_speed
+        period_length = transect_length + np.pi * r
+
+        t = np.asarray(t, dtype=np.float64)
+        leg = np.floor(t / period_time)
+        rem = t - leg * period_time
+        s = np.where(rem <= straight_time, rem * speed, transect_length + (rem - straight_time) * turn_speed)
+        return leg * period_length + s
+
+    def heading_changes(self, t, times, changes):
+
+        '''
+        (N,) heading offset at `t` when commanded to turn by `changes[i]` radians starting at `times[i]`.
+        Each turn is flown at max_yaw_rate, and a new command takes over from wherever the last turn got to
+        '''
+
+        rate = np.deg2rad(self.max_yaw_rate)
+        heading = np.zeros(len(t))
+        prev = 0.
+        for i, (start, dpsi) in enumerate(zip(times, changes)):
+            end = times[i + 1] if i + 1 < len(times) else np.inf
+            duration = min(abs(dpsi) / rate, end - start)
+            mask = t >= start
+            heading[mask] = prev + np.sign(dpsi) * rate * np.clip(t[mask] - start, 0, duration)
+            prev = prev + np.sign(dpsi) * rate * duration
+        return heading
+
+    def integrate_planar(self, t, speed, heading, direction0):
+
+        '''
+        (N, 2) xy offsets from the start for a vehicle moving at `speed` along `direction0` rotated by `heading`
+        '''
+
+        c, s = np.cos(heading), np.sin(heading)
+        d = np.stack([c * direction0[0] - s * direction0[1], s * direction0[0] + c * direction0[1]], axis=-1)
+        dt = np.diff(t, prepend=t[0])[:, None]
+        # trapezoidal integration of the velocity
+        v = self.surge_speed(speed) * d
+        steps = dt * np.vstack([v[:1], (v[1:] + v[:-1]) / 2])
+        return np.cumsum(steps, axis=0)
+
+    def keep_within(self, t, speed, times, changes, direction0, start, lo, hi, max_turns=100):
+
+        '''
+        (N,) heading and (N, 2) xy of the walk commanded by heading_changes(t, times, changes) from `start`,
+        with an extra turn commanded whenever the vehicle heads out of the [lo, hi] xy box, reflecting its
+        direction off that side. Turns start a turning radius inside the box so the vehicle stays within it,
+        and commands which would interrupt such a turn are dropped
+        '''
+
+        speed = self.surge_speed(speed)
+        rate = np.deg2rad(self.max_yaw_rate)
+        margin = 2 * speed / rate # a turning radius, twice over for turns away from one side towards another
+        lo, hi = np.asarray(lo) + margin, np.asarray(hi) - margin
+        commands = sorted(zip(times, changes))
+
+        def integrate(commands):
+            heading = self.heading_changes(t, [c[0] for c in commands], [c[1] for c in commands])
+            return heading, start + self.integrate_planar(t, speed, heading, direction0)
+
+        if (lo >= hi).any():
+            logger.warning(f'Bounds {lo - margin}, {hi + margin} are too small for a {margin=:.1f}m turning radius')
+            return integrate(commands)
+
+        # new commands never change the path before them, so search on from the last one.
+        # While a reflection turn is flown, only leaving the box along another axis needs a new one
+        last, settled, turning_axes, turn_sign = -1, -np.inf, np.zeros(2, dtype=bool), 1
+        for _ in range(max_turns):
+            heading, xy = integrate(commands)
+            c, s = np.cos(heading), np.sin(heading)
+            d = np.stack([c * direction0[0] - s * direction0[1], s * direction0[0] + c * direction0[1]], axis=-1)
+            outward = ((xy < lo) & (d < 0)) | ((xy > hi) & (d > 0))
+            hits = np.where((t >= settled)[:, None], outward, outward & ~turning_axes).any(axis=1)
+            hits = np.nonzero(hits[last + 1:])[0] + last + 1
+            if len(hits) == 0:
+                return heading, xy
+            k = last = hits[0]
+            reflected = np.where(outward[k], -d[k], d[k])
+            dpsi = np.arctan2(reflected[1], reflected[0]) - np.arctan2(d[k, 1], d[k, 0])
+            dpsi = (dpsi + np.pi) % (2 * np.pi) - np.pi
+            if t[k] < settled:
+                # a turn cut short by this one may still be heading out along its own axes, so reflect those
+                # too, and keep turning the same way rather than back towards the side it was turning from
+                heading_out = d[k] * (xy[k] - (lo + hi) / 2) > 0
+                turning_axes = outward[k] | (turning_axes & heading_out)
+                reflected = np.where(turning_axes, -d[k], d[k])
+                dpsi = np.arctan2(reflected[1], reflected[0]) - np.arctan2(d[k, 1], d[k, 0])
+                dpsi = dpsi % (2 * np.pi) if turn_sign > 0 else dpsi % (2 * np.pi) - 2 * np.pi
+            else:
+                turning_axes = outward[k]
+            turn_sign = np.sign(dpsi)
+            settled = t[k] + abs(dpsi) / rate
+            commands = sorted([c for c in commands if c[0] < t[k] or c[0] >= settled] + [(t[k], dpsi)])
+
+        logger.warning(f'keep_within gave up after {max_turns=}')
+        return heading, xy
+
+    def altitude_hold(self, t, ground, altitude):
+
+        '''
+        (N,) vehicle z holding `altitude` above (N,) `ground` heights sampled at times `t`
+        '''
+
+        target = ground + altitude
+        if len(t) < 2:
+            return target
+        dt = float(np.median(np.diff(t)))
+
+        a = 1 - np.exp(-dt / self.altitude_time_constant)
+        z, _ = lfilter([a], [1, a - 1], target, zi=[(1 - a) * target[0]])
+
+        z = np.maximum(z, ground + self.min_clearance)
+        return lipschitz_majorant(z, self.max_depth_rate * dt)
+
+    def attitude(self, t):
+
+        '''
+        (N,) pitch and roll oscillation in radians
+        '''
+
+        res = []
+        for amplitude in (self.pitch_amplitude, self.roll_amplitude):
+            period = random_general(self.oscillation_period)
+            res.append(np.deg2rad(amplitude) * np.sin(2 * np.pi * t / period + U(0, 2 * np.pi)))
+        return res
@@ -1,11 +1,14 @@
 """Camera utility, collection of useful camera functions."""
 import os
+from pathlib import Path
 from typing import Union, Optional, List
 
 import bpy
 import numpy as np
 from mathutils import Matrix
-from scipy.ndimage import map_coordinates
+
+from infinigen.core.placement import distortion_cache
+from infinigen.core.placement.lens_distortion import DistortionRemapPlan, LensModel, BrownConrady, lens_from_dict
 
 
 def set_intrinsics_from_blender_params(cam_ob, lens: float = None, image_width: int = None, image_height: int = None,
@@ -219,25 +222,90 @@ def set_lens_distortion(cam: bpy.types.Camera, resolution_y, resolution_x,
     :param fy: focal length
     :return: mapping coordinates from distorted to undistorted image pixels
     """
-    if all(v == 0.0 for v in [k1, k2, k3, p1, p2]):
-        raise Exception("All given lens distortion parameters (k1, k2, k3, p1, p2) are zero.")
-
-    # save the original image resolution (desired output resolution)
-    original_image_resolution = (resolution_y, resolution_x)
-
     # get the current K matrix (skew==0 in Blender)
     # camera_K_matrix = CameraUtility.get_intrinsics_as_K_matrix()
-    camera_K_matrix = get_intrinsics_as_K_matrix(cam, original_image_resolution[1], original_image_resolution[0])
-    fx, fy = camera_K_matrix[0][0], camera_K_matrix[1][1]
-    cx, cy = camera_K_matrix[0][2], camera_K_matrix[1][2]
+    camera_K_matrix = get_intrinsics_as_K_matrix(cam, resolution_x, resolution_y)
+
+    mapping_coords, camera_changed_K_matrix, new_image_resolution = compute_lens_distortion_mapping(
+        camera_K_matrix, resolution_y, resolution_x, k1, k2, k3, p1, p2)
 
+    # reuse the values, which have been set before
+    clip_start = cam.data.clip_start
+    clip_end = cam.data.clip_end
+
+    set_intrinsics_from_K_matrix(cam, camera_changed_K_matrix, new_image_resolution[0],
+                                 new_image_resolution[1], clip_start, clip_end)
+
+    return mapping_coords
+
+
+def compute_lens_distortion_mapping(camera_K_matrix: np.ndarray, resolution_y, resolution_x,
+                                    k1: float, k2: float, k3: float = 0.0, p1: float = 0.0, p2: float = 0.0):
+    """
+    The camera independent part of `set_lens_distortion`, see there for the meaning of the parameters.
+
+    :param camera_K_matrix: The 3x3 K matrix of the camera at the desired (distorted) resolution.
+    :return: mapping coordinates from distorted to undistorted image pixels, the K matrix and
+             [width, height] resolution Blender has to render the undistorted image at.
+    """
     # Get row,column image coordinates for all pixels for row-wise image flattening
     # The center of the upper-left pixel has coordinates [0,0] both in DLR CalDe and python/scipy
-    row = np.repeat(np.arange(0, original_image_resolution[0]), original_image_resolution[1])
-    column = np.tile(np.arange(0, original_image_resolution[1]), original_image_resolution[0])
+    row = np.repeat(np.arange(0, resolution_y), resolution_x)
+    column = np.tile(np.arange(0, resolution_x), resolution_y)
+
+    u, v = undistorted_pixel_coords(camera_K_matrix, row, column, BrownConrady(k1, k2, k3, p1, p2))
+    camera_changed_K_matrix, new_image_resolution = render_intrinsics_for_extent(camera_K_matrix, u, v)
+    mapping_coords = shift_mapping_coords(camera_K_matrix, camera_changed_K_matrix, u, v)
+
+    return mapping_coords, camera_changed_K_matrix, new_image_resolution
+
+
+def compute_lens_distortion_render_intrinsics(camera_K_matrix: np.ndarray, resolution_y, resolution_x,
+                                              lens: LensModel):
+    """
+    The K matrix and [width, height] resolution of `compute_lens_distortion_mapping` for any lens_distortion.LensModel,
+    from the border pixels only.
+    For physically sensible lenses the extremes of the undistorted coordinates lie on the image border, so this
+    only solves O(H+W) instead of H*W pixels. Get the mapping itself later with `compute_lens_distortion_mapping_for`.
+    """
+    rows, columns = np.arange(resolution_y), np.arange(resolution_x)
+    row = np.concatenate([np.zeros(resolution_x), np.full(resolution_x, resolution_y - 1), rows, rows])
+    column = np.concatenate([columns, columns, np.zeros(resolution_y), np.full(resolution_y, resolution_x - 1)])
+
+    u, v = undistorted_pixel_coords(camera_K_matrix, row, column, lens)
+    return render_intrinsics_for_extent(camera_K_matrix, u, v)
+
+
+def compute_lens_distortion_mapping_for(camera_K_matrix: np.ndarray, camera_changed_K_matrix: np.ndarray,
+                                        new_image_resolution, resolution_y, resolution_x, lens: LensModel):
+    """
+    The mapping coordinates of `compute_lens_distortion_mapping` for a render K matrix and resolution that were
+    computed before, e.g. by `compute_lens_distortion_render_intrinsics`.
+    """
+    row = np.repeat(np.arange(0, resolution_y), resolution_x)
+    column = np.tile(np.arange(0, resolution_x), resolution_y)
+
+    u, v = undistorted_pixel_coords(camera_K_matrix, row, column, lens)
+    mapping_coords = shift_mapping_coords(camera_K_matrix, camera_changed_K_matrix, u, v)
+
+    if (mapping_coords.min() < 0 or mapping_coords[0].max() > new_image_resolution[1] - 1
+            or mapping_coords[1].max() > new_image_resolution[0] - 1):
+        print("Some interior pixels of the distorted image map outside of the rendered image, "
+              "they will be filled with the nearest border pixels. Double-check your distortion model.")
+
+    return mapping_coords
 
-    # P_und is the undistorted pinhole projection at z==1 of all image pixels
-    P_und = np.linalg.inv(camera_K_matrix) @ np.vstack((column, row, np.ones(np.prod(original_image_resolution[:2]))))
+
+def undistorted_pixel_coords(camera_K_matrix: np.ndarray, row: np.ndarray, column: np.ndarray, lens: LensModel):
+    """
+    :return: the (u, v) pixel coordinates on the undistorted image that distort into the given row, column
+             coordinates of the distorted image under the lens_distortion.LensModel lens.
+    """
+    fx, fy = camera_K_matrix[0][0], camera_K_matrix[1][1]
+    cx, cy = camera_K_matrix[0][2], camera_K_matrix[1][2]
+
+    # P_und is the undistorted pinhole projection at z==1 of the image pixels
+    P_und = np.linalg.inv(camera_K_matrix) @ np.vstack((column, row, np.ones(len(row))))
 
     # P_und are then distorted by the lens, i.e. P_dis = dis(P_und)
     # => Find mapping I_dis(row,column) -> I_und(float,float)
@@ -261,56 +329,21 @@ def set_lens_distortion(cam: bpy.types.Camera, resolution_y, resolution_x,
     # and then interpolate on an irregular grid of distorted points. This is faster
     # when generating the mapping matrix but much slower in inference.
 
-    # Init dist at undist
-    x = P_und[0, :].copy()
-    y = P_und[1, :].copy()
-    res = [1e3]
-    it = 0
-    while res[-1] > 0.15:
-        r2 = np.square(x) + np.square(y)
-        radial_part = 1 + k1 * r2 + k2 * r2 * r2 + k3 * r2 * r2 * r2
-        x_ = x * radial_part + 2 * p2 * x * y + p1 * (r2 + 2 * np.square(x))
-        y_ = y * radial_part + 2 * p1 * x * y + p2 * (r2 + 2 * np.square(y))
-
-        error = np.max(np.hypot(fx * (x_ - P_und[0, :]), fy * (y_ - P_und[1, :])))
-        res.append(error)
-        it += 1
-
-        # Take action if the optimization stalls or gets unstable
-        # (distortion models are tricky if badly parameterized, especially in outer regions)
-        if (it > 1) and (res[-1] > res[-2] * .99999):
-            print("The residual for the worst distorted pixel got unstable/stalled.")
-            # factor *= .5
-            if it > 1e3:
-                raise Exception(
-                    "The iterative distortion algorithm is unstable/stalled after 1000 iterations.")
-            if error > 1e9:
-                print("Some (corner) pixels of the desired image are not defined by the used lens distortion model.")
-                print("We invite you to double-check your distortion model.")
-                print("The parameters k3,p1,p2 can easily overshoot for regions where the calibration "
-                      "software had no datapoints.")
-                print("You can either:")
-                print("- take more projections (ideally image-filling) at the image corners and repeat calibration,")
-                print("- reduce the # of released parameters to calibrate to k1,k2, or")
-                print("- reduce the target image size (subtract some lines and columns from the desired resolution")
-                print("  and subtract at most that number of lines and columns from the main point location).")
-                print("BlenderProc will not generate incomplete images with void regions since these are not "
-                      "useful for ML (data leakage).")
-                print("For that, you can use the Matlab code in robotic.de/callab, which robustifies against "
-                      "these unstable pixels.")
-                raise Exception("The iterative distortion algorithm is unstable.")
-
-        # update undistorted projection
-        x -= x_ - P_und[0, :]  # * factor
-        y -= y_ - P_und[1, :]  # * factor
+    # For Brown-Conrady this is the iteration described above, other lens models invert more directly
+    x, y = lens.undistort(P_und[0, :], P_und[1, :], fx, fy)
 
     # u and v are now the pixel coordinates on the undistorted image that
     # will distort into the row,column coordinates of the distorted image
-    u = fx * x + cx
-    v = fy * y + cy
+    return fx * x + cx, fy * y + cy
 
-    # Stacking this way for the interpolation in the undistorted image array
-    mapping_coords = np.vstack([v, u])
+
+def render_intrinsics_for_extent(camera_K_matrix: np.ndarray, u: np.ndarray, v: np.ndarray):
+    """
+    :return: the K matrix and [width, height] resolution Blender has to render so that the undistorted
+             pixel coordinates u, v are all inside the rendered image.
+    """
+    fx, fy = camera_K_matrix[0][0], camera_K_matrix[1][1]
+    cx, cy = camera_K_matrix[0][2], camera_K_matrix[1][2]
 
     # Find out the image resolution needed from Blender to generate filled-in distorted images of the desired resolution
     min_und_column_needed = np.floor(np.min(u))
@@ -329,12 +362,6 @@ def set_lens_distortion(cam: bpy.types.Camera, resolution_y, resolution_x,
     # suggested resolution for Blender image generation
     new_image_resolution = np.array([columns_needed, rows_needed], dtype=int)
 
-    # Adapt/shift the mapping function coordinates to the new_image_resolution resolution
-    # (if we didn't, the mapping would only be valid for same resolution mapping)
-    # (same resolution mapping yields undesired void image areas)
-    mapping_coords[0, :] += cy_new - cy
-    mapping_coords[1, :] += cx_new - cx
-
     camera_changed_K_matrix = np.array([[fx, 0, cx],
                                         [0, fy, cy],
                                         [0, 0, 1]])
@@ -342,13 +369,19 @@ def set_lens_distortion(cam: bpy.types.Camera, resolution_y, resolution_x,
     camera_changed_K_matrix[0, 2] = cx_new
     camera_changed_K_matrix[1, 2] = cy_new
 
-    # reuse the values, which have been set before
-    clip_start = cam.data.clip_start
-    clip_end = cam.data.clip_end
+    return camera_changed_K_matrix, new_image_resolution
 
-    set_intrinsics_from_K_matrix(cam, camera_changed_K_matrix, new_image_resolution[0],
-                                 new_image_resolution[1], clip_start, clip_end)
 
+def shift_mapping_coords(camera_K_matrix: np.ndarray, camera_changed_K_matrix: np.ndarray,
+                         u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    # Stacking this way for the interpolation in the undistorted image array
+    mapping_coords = np.vstack([v, u])
+
+    # Adapt/shift the mapping function coordinates to the new_image_resolution resolution
+    # (if we didn't, the mapping would only be valid for same resolution mapping)
+    # (same resolution mapping yields undesired void image areas)
+    mapping_coords[0, :] += camera_changed_K_matrix[1][2] - camera_K_matrix[1][2]
+    mapping_coords[1, :] += camera_changed_K_matrix[0][2] - camera_K_matrix[0][2]
     return mapping_coords
 
 
@@ -356,7 +389,8 @@ def apply_lens_distortion(image: Union[List[np.ndarray], np.ndarray],
                           mapping_coords: Optional[np.ndarray] = None,
                           orig_res_x: Optional[int] = None,
                           orig_res_y: Optional[int] = None,
-                          use_interpolation: bool = True) -> Union[List[np.ndarray], np.ndarray]:
+                          use_interpolation: bool = True,
+                          plan: Optional[DistortionRemapPlan] = None) -> Union[List[np.ndarray], np.ndarray]:
     """
     this function has been taken from BlenderProc https://github.com/DLR-RM/BlenderProc
 
@@ -370,60 +404,29 @@ def apply_lens_distortion(image: Union[List[np.ndarray], np.ndarray],
     :param mapping_coords: an array of pixel mappings from undistorted to distorted image
     :param orig_res_x: original and output width resolution of the image
     :param orig_res_y: original and output height resolution of the image
-    :param use_interpolation: if this is True, for each pixel an interpolation will be performed, if this is false
-                              the nearest pixel will be used
-    :return: a list of images or an image that have been distorted, now in the desired (original) resolution
-    """
-
-    if mapping_coords is None or orig_res_x is None or orig_res_y is None:
-        # if lens distortion was used apply it now
-        raise Exception("Applying of a lens distortion is only possible after calling "
-                        "bproc.camera.set_lens_distortion(...) and pass 'mapping_coords' and "
-                        "'orig_res_x' + 'orig_res_x' to bproc.postprocessing.apply_lens_distortion(...). "
-                        "Previously this could also have been done via the CameraInterface module, "
-                        "see the example on lens_distortion.")
-    interpolation_order = 2 if use_interpolation else 0
-
-    def _internal_apply(input_image: np.ndarray) -> np.ndarray:
-        """
-        Applies the distortion to the input image
-        :param input_image: input image, which will be distorted
-        :return: distorted input image
-        """
-        amount_of_output_channels = 1
-        if len(input_image.shape) == 3:
-            amount_of_output_channels = input_image.shape[2]
-        image_distorted = np.zeros((orig_res_y, orig_res_x, amount_of_output_channels))
-        used_dtpye = input_image.dtype
-        data = input_image.astype(float)
-        # Forward mapping in order to distort the undistorted image coordinates
-        # and reshape the arrays into the image shape grid.
-        # The reference frame for coords is as in DLR CalDe etc. (the upper-left pixel center is at [0,0])
-        mode = 'nearest'
-        for i in range(image_distorted.shape[2]):
-            if len(input_image.shape) == 3:
-                image_distorted[:, :, i] = np.reshape(map_coordinates(data[:, :, i], mapping_coords,
-                                                                      order=interpolation_order,
-                                                                      mode=mode), image_distorted[:, :, i].shape)
-            else:
-                image_distorted[:, :, i] = np.reshape(map_coordinates(data, mapping_coords, order=interpolation_order,
-                                                                      mode=mode),
-                                                      image_distorted[:, :, i].shape)
-        # Other options are:
-        # - map_coordinates() in all channels at the same time (turns out to be slower)
-        # - use torch.nn.functional.grid_sample() instead to do it on the GPU (even in batches)
-
-        if used_dtpye == np.uint8:
-            image_distorted = np.clip(image_distorted, 0, 255)
-        data = image_distorted.astype(used_dtpye)
-        if len(input_image.shape) == 2:
-            return data[:, :, 0]
-        return data
+    :param use_interpolation: if this is True, for each pixel a bilinear interpolation will be performed, if this
+                              is false the nearest pixel will be used
+    :param plan: a DistortionRemapPlan built from the mapping, to reuse its gather tables between calls.
+                 If given, mapping_coords, orig_res_x and orig_res_y are not needed
+    :return: a list of images or an image that have been distorted, now in the desired (original) resolution,
+             with the dtype of the input
+    """
 
+    if plan is None:
+        if mapping_coords is None or orig_res_x is None or orig_res_y is None:
+            # if lens distortion was used apply it now
+            raise Exception("Applying of a lens distortion is only possible after calling "
+                            "bproc.camera.set_lens_distortion(...) and pass 'mapping_coords' and "
+                            "'orig_res_x' + 'orig_res_x' to bproc.postprocessing.apply_lens_distortion(...). "
+                            "Previously this could also have been done via the CameraInterface module, "
+                            "see the example on lens_distortion.")
+        plan = DistortionRemapPlan.from_mapping_coords(mapping_coords, orig_res_y, orig_res_x)
+
+    # The reference frame for coords is as in DLR CalDe etc. (the upper-left pixel center is at [0,0])
     if isinstance(image, list):
-        return [_internal_apply(img) for img in image]
+        return [plan.apply(img, interpolate=use_interpolation) for img in image]
     if isinstance(image, np.ndarray):
-        return _internal_apply(image)
+        return plan.apply(image, interpolate=use_interpolation)
     raise Exception(f"This type can not be worked with here: {type(image)}, only "
                     f"np.ndarray or list of np.ndarray are supported")
 
@@ -470,12 +473,56 @@ def save_distortion_parameters(cam_ob, mapping_coords, original_resolution, para
 
 
 def load_distortion_parameters(cam_ob, parameter_dir="./"):
+    entry = distortion_cache.entry_path(cam_ob)
+    if entry is not None:
+        # set up through the shared cache, see camera.set_lens_model_distortion
+        cached = distortion_cache.load(entry.parent, entry.name)
+        if cached is None:
+            raise FileNotFoundError(f"{cam_ob.name} uses lens distortion mapping {entry} which does not exist")
+        mapping_coords, _, _, original_resolution = cached
+        if mapping_coords is None:
+            # the camera was configured from the border pixels only, see compute_lens_distortion_render_intrinsics
+            manifest = distortion_cache.load_manifest(entry.parent, entry.name)
+            mapping_coords = compute_lens_distortion_mapping_for(
+                np.array(manifest['K']), np.array(manifest['render_K']), manifest['render_resolution'],
+                *manifest['orig_resolution'], lens_from_dict(manifest['lens']))
+            distortion_cache.save_mapping(entry.parent, entry.name, mapping_coords)
+        return mapping_coords, original_resolution
     cam_name_string = cam_ob.name.replace("/", "_")
     mapping_coords = np.load(os.path.join(parameter_dir, f"{cam_name_string}_mapping_coords.npy"))
     original_resolution = np.load(os.path.join(parameter_dir, f"{cam_name_string}_orig_res.npy"))
     return mapping_coords, original_resolution
 
 
+def distortion_mapping_path(cam_ob, parameter_dir="./") -> Path:
+    """
+    The .npy file load_distortion_parameters reads cam_ob's mapping from, once it has been computed.
+    """
+    entry = distortion_cache.entry_path(cam_ob)
+    if entry is not None:
+        return entry / 'mapping_coords.npy'
+    cam_name_string = cam_ob.name.replace("/", "_")
+    return Path(parameter_dir, f"{cam_name_string}_mapping_coords.npy").resolve()
+
+
+_distortion_plans = {}
+
+
+def load_distortion_plan(cam_ob, parameter_dir="./") -> DistortionRemapPlan:
+    """
+    The DistortionRemapPlan for cam_ob's lens distortion parameters. Plans are loaded once per process
+    and shared by cameras using the same cached mapping, so every frame and pass of a render task
+    reuses the same gather tables.
+    """
+    entry = distortion_cache.entry_path(cam_ob)
+    key = str(entry) if entry is not None else os.path.join(os.path.abspath(parameter_dir), cam_ob.name)
+    if key not in _distortion_plans:
+        mapping_coords, original_resolution = load_distortion_parameters(cam_ob, parameter_dir)
+        _distortion_plans[key] = DistortionRemapPlan.from_mapping_coords(
+            mapping_coords, original_resolution[0], original_resolution[1])
+    return _distortion_plans[key]
+
+
 def remove_segmap_noise(image: Union[list, np.ndarray], image_bit=0, threshold=200) -> Union[list, np.ndarray]:
     """
     A function that takes an image and a few 2D indices, where these indices correspond to pixel values in
@@ -484,6 +531,9 @@ def remove_segmap_noise(image: Union[list, np.ndarray], image_bit=0, threshold=2
 
     Assumes that noise pixel values won't occur more than 100 times.
 
+    Noisy pixels are repaired as if in raster order, each one seeing the already repaired values of its earlier
+    neighbours, but vectorized over all pixels that do not depend on each other.
+
     :param image: ndarray of the .exr segmap
     :return: The denoised segmap image
     """
@@ -491,34 +541,88 @@ def remove_segmap_noise(image: Union[list, np.ndarray], image_bit=0, threshold=2
     if isinstance(image, list) or hasattr(image, "shape") and len(image.shape) > 3:
         return [remove_segmap_noise(img) for img in image]
 
-    noise_indices = determine_noisy_pixels(image, image_bit=image_bit, threshold=threshold)
+    noisy_channels = noisy_value_mask(image, image_bit=image_bit, threshold=threshold)
+    if noisy_channels.ndim == 3:
+        noisy_channels = np.add.reduce(noisy_channels, axis=2, dtype=np.uint8)
+    noisy = noisy_channels > 0
+    if not noisy.any():
+        return image
+
+    # Each pixel sees the repaired values of its noisy neighbours that come earlier in raster order and the
+    # original values of the later ones. Giving every pixel a level one above its earlier noisy neighbours keeps
+    # that order for every pair of adjacent noisy pixels, and pixels of the same level are never adjacent, so
+    # each level can be repaired at once. Levels are only as many as the longest chain of adjacent noisy pixels
+    rows, cols = np.nonzero(noisy)
+    index = np.full((noisy.shape[0] + 2, noisy.shape[1] + 2), -1, dtype=np.int64)
+    index[rows + 1, cols + 1] = np.arange(len(rows))
+    neighbors = np.stack([index[rows + 1 + dr, cols + 1 + dc] for dr, dc in _NEIGHBOR_OFFSETS], axis=1)
+    earlier, later = neighbors[:, :4], neighbors[:, 4:]
+    level = np.zeros(len(rows), dtype=np.int64)
+    # only pixels whose earlier neighbours changed level need to be looked at again
+    frontier = np.flatnonzero((earlier >= 0).any(axis=1))
+    while len(frontier):
+        e = earlier[frontier]
+        new_level = np.where(e >= 0, level[e] + 1, 0).max(axis=1)
+        changed = frontier[new_level != level[frontier]]
+        level[frontier] = new_level
+        frontier = later[changed].ravel()
+        frontier = np.unique(frontier[frontier >= 0])
+
+    order = np.argsort(level, kind="stable")
+    for group in np.split(order, np.flatnonzero(np.diff(level[order])) + 1):
+        _repair_pixels(image, rows[group], cols[group], noisy_channels[rows[group], cols[group]])
 
-    for index in noise_indices:
-        neighbors = get_pixel_neighbors(image, index[0], index[
-            1])  # Extracting the indices surrounding 3x3 neighbors
-        curr_val = image[index[0]][index[1]][0]  # Current value of the noisy pixel
+    return image
 
-        neighbor_vals = [image[neighbor[0]][neighbor[1]] for neighbor in
-                         neighbors]  # Getting the values of the neighbors
-        # Getting the unique values only
-        neighbor_vals = np.unique(np.array([np.array(index) for index in neighbor_vals]))
 
-        min_val = 10000000000
-        min_idx = 0
+_NEIGHBOR_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
 
-        # Here we iterate through the unique values of the neighbor and find the one closest to the current noisy value
-        for idx, n in enumerate(neighbor_vals):
-            # Is this closer than the current closest value?
-            if n - curr_val <= min_val:
-                # If so, update
-                min_val = n - curr_val
-                min_idx = idx
 
-        # Now that we have found the closest value, assign it to the noisy value
-        new_val = neighbor_vals[min_idx]
-        image[index[0]][index[1]] = np.array([new_val, new_val, new_val])
+def _repair_pixels(image: np.ndarray, rows: np.ndarray, cols: np.ndarray, repeats: np.ndarray):
+    """
+    Replaces the given independent pixels by their closest neighbour value, once per noisy channel like the
+    original per-index loop did.
+    """
+    height, width = image.shape[:2]
+    offsets = np.array(_NEIGHBOR_OFFSETS)
+    neighbor_rows = rows[:, None] + offsets[None, :, 0]
+    neighbor_cols = cols[:, None] + offsets[None, :, 1]
+    inside = (neighbor_rows >= 0) & (neighbor_rows < height) & (neighbor_cols >= 0) & (neighbor_cols < width)
+    vals = image[np.clip(neighbor_rows, 0, height - 1), np.clip(neighbor_cols, 0, width - 1)]
+    vals = vals.reshape(len(rows), -1)
+    inside = np.repeat(inside, vals.shape[1] // offsets.shape[0], axis=1)
+
+    for it in range(int(repeats.max(initial=0))):
+        sel = repeats > it
+        curr = image[rows[sel], cols[sel]]
+        if curr.ndim > 1:
+            curr = curr[:, 0]
+        new_vals = _closest_neighbor_value(vals[sel], inside[sel], curr)
+        image[rows[sel], cols[sel]] = new_vals[:, None] if image.ndim == 3 else new_vals
+
+
+def _closest_neighbor_value(vals: np.ndarray, inside: np.ndarray, curr: np.ndarray) -> np.ndarray:
+    """
+    Per row, the value the original neighbour loop picks: of the sorted unique neighbour values n, the last one
+    minimizing n - curr (computed in the image dtype, so unsigned differences wrap around) among those with
+    n - curr <= 1e10, or else the smallest one.
+    """
+    if np.issubdtype(vals.dtype, np.floating):
+        lowest, highest = -np.inf, np.inf
+    else:
+        lowest, highest = np.iinfo(vals.dtype).min, np.iinfo(vals.dtype).max
+
+    diff = vals - curr[:, None]
+    ok = inside & (diff <= 1e10)
+    best_diff = np.where(ok, diff, highest).min(axis=1)
+    best = np.where(ok & (diff == best_diff[:, None]), vals, lowest).max(axis=1)
+
+    fallback = np.fmin.reduce(np.where(inside, vals, highest), axis=1)
+    if np.issubdtype(vals.dtype, np.floating):
+        # np.unique sorts nan last, so it is only picked if every neighbour is nan
+        fallback = np.where((inside & ~np.isnan(vals)).any(axis=1), fallback, np.nan).astype(vals.dtype)
+    return np.where(ok.any(axis=1), best, fallback)
 
-    return image
 
 def get_pixel_neighbors(data: np.ndarray, i: int, j: int) -> np.ndarray:
     """ Returns the valid neighbor pixel indices of the given pixel.
@@ -543,21 +647,39 @@ def determine_noisy_pixels(image: np.ndarray, threshold=100, image_bit=16) -> np
                           these pixels is to use a histogram and find the pixels with frequencies lower than \
                           a threshold, e.g. 100.
     """
+    return np.argwhere(noisy_value_mask(image, threshold=threshold, image_bit=image_bit))
+
+
+def noisy_value_mask(image: np.ndarray, threshold=100, image_bit=16) -> np.ndarray:
+    """
+    :return: a boolean mask of the image's shape, True where the (scaled) value occurs at most threshold times
+    """
     # The map was scaled to be ranging along the entire 16-bit color depth, and this is the scaling down operation
     # that should remove some noise or deviations
     image = (image * 37) / (np.power(2, image_bit))  # assuming 16 bit color depth
     image = image.astype(np.int32)
-    b, counts = np.unique(image.flatten(), return_counts=True)
 
     # Removing further noise where there are some stray pixel values with very small counts, by assigning them to
     # their closest (numerically, since this deviation is a
     # result of some numerical operation) neighbor.
-    hist = sorted((np.asarray((b, counts)).T), key=lambda x: x[1])
     # Assuming the stray pixels wouldn't have a count of more than 100
-    noise_vals = [h[0] for h in hist if h[1] <= threshold]
-    noise_indices = np.argwhere(is_in(image, noise_vals))
+    return _value_counts(image) <= threshold
+
+
+def _value_counts(values: np.ndarray) -> np.ndarray:
+    """
+    :return: for every element, the number of elements of values with the same value
+    """
+    flat = values.ravel()
+    if flat.size == 0:
+        return np.zeros(values.shape, dtype=np.int64)
+    low, high = int(flat.min()), int(flat.max())
+    if high - low <= max(4 * flat.size, 2 ** 20):
+        offset = flat.astype(np.int64) - low
+        return np.bincount(offset)[offset].reshape(values.shape)
+    _, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+    return counts[inverse].reshape(values.shape)
 
-    return noise_indices
 
 def is_in(element, test_elements, assume_unique=False, invert=False):
     """ As np.isin is only available after v1.13 and blender is using 1.10.1 we have to implement it manually. """
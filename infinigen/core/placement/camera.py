@@ -12,9 +12,12 @@ import sys
 import warnings
 import os
 from copy import deepcopy, copy
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from itertools import chain
 import logging
+import threading
 from pathlib import Path
 
 from numpy.random import uniform as U
@@ -34,30 +37,48 @@ from infinigen.core.placement import placement
 from infinigen.core.nodes import node_utils
 from infinigen.core.nodes.node_wrangler import NodeWrangler, Nodes
 
-from . import animation_policy
+from . import animation_policy, raycast, heightfield, camera_cache, distortion_cache
+from .telemetry import animation_telemetry
 
 from infinigen.core.util import blender as butil
 from infinigen.core.util.logging import Timer
-from infinigen.core.util.math import clip_gaussian, lerp
+from infinigen.core.util.math import clip_gaussian, lerp, FixedSeed, int_hash
 from infinigen.core.util import camera
 from infinigen.core.util.random import random_general
 
 from infinigen.tools.suffixes import get_suffix
 
-from infinigen.core.placement.bproc_camera_utility import set_intrinsics_from_blender_params, set_lens_distortion, save_distortion_parameters
+from infinigen.core.placement.bproc_camera_utility import (set_intrinsics_from_blender_params, set_lens_distortion, save_distortion_parameters,
+    set_intrinsics_from_K_matrix, get_intrinsics_as_K_matrix, compute_lens_distortion_render_intrinsics,
+    compute_lens_distortion_mapping_for)
+from infinigen.core.placement.lens_distortion import BrownConrady
 
 logger = logging.getLogger(__name__)
 
 CAMERA_RIGS_DIRNAME = 'CameraRigs'
 
-@gin.configurable
-def get_sensor_coords(cam, H, W, sparse=False):
+def get_sensor_pixel_locs(H, W, sparse=False, n_sparse=1000):
+
+    '''
+    Returns an (N, 2) int array of (x, y) pixel locations, either every pixel in
+    row-major order or `n_sparse` randomly sampled pixels
+    '''
+
+    if sparse:
+        ii = np.random.choice(H*W, size=n_sparse)
+    else:
+        ii = np.arange(H*W)
+    return np.stack((ii % W, ii // W), axis=-1)
+
+def sensor_plane_coords(cam, H, W, pixel_locs):
+
+    '''
+    Camera-space (N, 3) coordinates of the given pixels on the sensor plane, in meters
+    '''
 
     camd = cam.data
     f_in_m = camd.lens / 1000
     scene = bpy.context.scene
-    resolution_x_in_px = W
-    resolution_y_in_px = H
 
     scale = scene.render.resolution_percentage / 100
     sensor_width_in_m = camd.sensor_width / 1000
@@ -66,38 +87,66 @@ def get_sensor_coords(cam, H, W, sparse=False):
 
     pixel_aspect_ratio = scene.render.pixel_aspect_x / scene.render.pixel_aspect_y
     if (camd.sensor_fit == 'VERTICAL'):
+        s_u = W * scale / sensor_width_in_m / pixel_aspect_ratio
+        s_v = H * scale / sensor_height_in_m
+    else: # 'HORIZONTAL' and 'AUTO'
+        s_u = W * scale / sensor_width_in_m
+        s_v = H * scale * pixel_aspect_ratio / sensor_height_in_m
 
-        # the sensor height is fixed (sensor fit is horizontal),
-        # the sensor width is effectively changed with the pixel aspect ratio
-        s_u = resolution_x_in_px * scale / sensor_width_in_m / pixel_aspect_ratio  # pixels per milimeter
-        s_v = resolution_y_in_px * scale / sensor_height_in_m
+    u_0 = W * scale / 2
+    v_0 = H * scale / 2
 
-    else: # 'HORIZONTAL' and 'AUTO'
+    coords = np.empty((len(pixel_locs), 3), dtype=np.float64)
+    coords[:, 0] = (pixel_locs[:, 0] - u_0) / s_u
+    coords[:, 1] = (pixel_locs[:, 1] - v_0 + 1) / s_v
+    coords[:, 2] = -f_in_m
+    return coords
 
-        # the sensor width is fixed (sensor fit is horizontal),
-        # the sensor height is effectively changed with the pixel aspect ratio
-        pixel_aspect_ratio = scene.render.pixel_aspect_x / scene.render.pixel_aspect_y
-        s_u = resolution_x_in_px * scale / sensor_width_in_m
-        s_v = resolution_y_in_px * scale * pixel_aspect_ratio / sensor_height_in_m
+@gin.configurable
+def get_sensor_rays(cam, H, W, sparse=False, pixel_locs=None, matrix_world=None):
 
-    u_0 = resolution_x_in_px * scale / 2 # cx (in pixels) Usually is just W/2
-    v_0 = resolution_y_in_px * scale / 2 # cx (in pixels) Usually is just H/2
-    xx, yy = np.meshgrid(np.arange(W).astype(float), np.arange(H).astype(float))
-    coords_x = (xx - u_0) / s_u # relative, in mm
-    coords_y = (yy - v_0 + 1) / s_v # relative, in mm
+    '''
+    Vectorized replacement for looping over get_sensor_coords
 
-    coords_z = np.full(coords_x.shape, -f_in_m)
-    relative_cam_coords = np.stack((coords_x, coords_y, coords_z), axis=-1)
+    Returns contiguous float32 (N, 3) ray origins and unit directions in world space,
+    plus the (N, 2) (x, y) pixel locations they were generated for.
+    `matrix_world` may be passed to evaluate a pose without moving `cam`
+    '''
 
-    cam_coords_vectors = np.empty((H,W), dtype=Vector)
-    pixel_locs = np.stack((np.meshgrid(np.arange(W), np.arange(H))), axis=-1).reshape((W*H, 2))#np.array(list(product(range(H), range(W))))
-    if sparse:
-        ii = np.random.choice(H*W, size=1000)
-        pixel_locs = pixel_locs[ii]
+    if pixel_locs is None:
+        pixel_locs = get_sensor_pixel_locs(H, W, sparse=sparse)
+
+    if matrix_world is None:
+        matrix_world = cam.matrix_world
+    M = np.asarray(matrix_world, dtype=np.float64)
+
+    rel = sensor_plane_coords(cam, H, W, pixel_locs)
+    directions = rel @ M[:3, :3].T
+    directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
 
-    for x,y in tqdm(pixel_locs, desc="Building Camera Vectors", disable=True):
-        pixelVector = Vector(relative_cam_coords[y,x])
-        cam_coords_vectors[y,x] = cam.matrix_world @ pixelVector
+    origins = np.broadcast_to(M[:3, 3], directions.shape)
+
+    return (
+        np.ascontiguousarray(origins, dtype=np.float32),
+        np.ascontiguousarray(directions, dtype=np.float32),
+        pixel_locs
+    )
+
+@gin.configurable
+def get_sensor_coords(cam, H, W, sparse=False):
+
+    '''
+    Legacy (H, W) object array of world-space sensor points, only filled at `pixel_locs`.
+    Prefer get_sensor_rays, which avoids building mathutils Vectors entirely
+    '''
+
+    pixel_locs = get_sensor_pixel_locs(H, W, sparse=sparse)
+    M = np.asarray(cam.matrix_world, dtype=np.float64)
+    world_coords = sensor_plane_coords(cam, H, W, pixel_locs) @ M[:3, :3].T + M[:3, 3]
+
+    cam_coords_vectors = np.empty((H,W), dtype=Vector)
+    for (x, y), co in zip(pixel_locs, world_coords):
+        cam_coords_vectors[y,x] = Vector(co)
 
     return cam_coords_vectors, pixel_locs
 
@@ -234,15 +283,31 @@ def set_camera(
     if focus_dist is not None:
         camera.data.dof.keyframe_insert(data_path="focus_distance", frame=frame)
 
-def terrain_camera_query(cam, terrain_bvh, terrain_tags_queries, vertexwise_min_dist, min_dist=0):
+def terrain_camera_query(cam, terrain_bvh, terrain_tags_queries, vertexwise_min_dist, min_dist=0, terrain_raycaster=None, rays=None):
+
+    if rays is None:
+        rays = get_sensor_rays(cam, sparse=True)
+    origins, directions, pix_it = rays
+    n_pix = pix_it.shape[0]
+
+    if terrain_raycaster is not None:
+        dist, index = terrain_raycaster.ray_cast(origins, directions)
+        hit = np.isfinite(dist)
+        dists, index = dist[hit], index[hit]
+        too_close = dists < min_dist
+        if vertexwise_min_dist is not None:
+            too_close |= dists < vertexwise_min_dist[index]
+        if too_close.any():
+            return None, {q: 0 for q in terrain_tags_queries}, n_pix
+        terrain_tags_queries_counts = {q: terrain_tags_queries[q][index].sum() for q in terrain_tags_queries}
+        return dists, terrain_tags_queries_counts, n_pix
 
     dists = []
-    sensor_coords, pix_it = get_sensor_coords(cam, sparse=True)
     terrain_tags_queries_counts = {q: 0 for q in terrain_tags_queries}
 
-    for x,y in pix_it:
-        direction = (sensor_coords[y,x] - cam.matrix_world.translation).normalized()
-        _, _, index, dist = terrain_bvh.ray_cast(cam.matrix_world.translation, direction)
+    origin = Vector(origins[0])
+    for direction in directions:
+        _, _, index, dist = terrain_bvh.ray_cast(origin, Vector(direction))
         if dist is None:
             continue
         dists.append(dist)
@@ -255,8 +320,6 @@ def terrain_camera_query(cam, terrain_bvh, terrain_tags_queries, vertexwise_min_
         for q in terrain_tags_queries:
             terrain_tags_queries_counts[q] += terrain_tags_queries[q][index]
 
-    n_pix = pix_it.shape[0]
-
     return dists, terrain_tags_queries_counts, n_pix
 
 @gin.configurable
@@ -310,6 +373,48 @@ def camera_pose_proposal(
 
     return loc, rot
 
+class PoseRejectionStats:
+
+    '''
+    Thread-safe tally of why keep_cam_pose_proposal rejected poses, and how many rays were cast
+    before each rejection was decided
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = defaultdict(int)
+            self.rays = defaultdict(int)
+
+    def record(self, reason, n_rays):
+        with self._lock:
+            self.counts[reason] += 1
+            self.rays[reason] += n_rays
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts), dict(self.rays)
+
+    def summary(self):
+        with self._lock:
+            return ', '.join(
+                f'{reason}: {self.counts[reason]} ({self.rays[reason]} rays)'
+                for reason in sorted(self.counts, key=self.rays.get, reverse=True)
+            )
+
+pose_rejection_stats = PoseRejectionStats()
+
+def hoeffding_radius(n, delta):
+
+    '''
+    Half-width of a two-sided confidence interval of level 1-delta on the mean of n samples in [0, 1]
+    '''
+
+    return np.sqrt(np.log(2 / delta) / (2 * n))
+
 @gin.configurable
 def keep_cam_pose_proposal(
     cam,
@@ -322,54 +427,102 @@ def keep_cam_pose_proposal(
     min_placeholder_dist=0,
     min_terrain_distance=0,
     terrain_coverage_range=(0.5, 1),
+    terrain_raycaster=None,
+    rays=None,
+    terrain_sdf=None,
+    early_reject_stages=(50, 200),
+    early_reject_delta=1e-3,
 ):
 
-    if terrain is not None: # TODO refactor
-        terrain_sdf = terrain.compute_camera_space_sdf(np.array(cam.location).reshape((1, 3)))
+    '''
+    rays, terrain_sdf: precomputed get_sensor_rays() output and terrain sdf for the pose to be checked.
+    When given, `cam` is neither moved nor updated, so proposals can be evaluated off the main thread
 
-    if not cam.type == 'CAMERA':
-        cam = [c for c in cam.children if c.type == 'CAMERA'][0]
-    if not cam.type == 'CAMERA':
-        raise ValueError(f'{cam.name=} had {cam.type=}')
+    early_reject_stages: ray counts after which coverage, closeup and tag ratios are checked against
+    Hoeffding bounds of level 1-early_reject_delta, so clearly out-of-range poses are rejected before
+    the full ray budget is cast. Accepting a pose always uses every ray. Pass () to disable
+    '''
 
-    bpy.context.view_layer.update()
+    if rays is None:
+        if terrain is not None: # TODO refactor
+            terrain_sdf = terrain.compute_camera_space_sdf(np.array(cam.location).reshape((1, 3)))
+
+        if not cam.type == 'CAMERA':
+            cam = [c for c in cam.children if c.type == 'CAMERA'][0]
+        if not cam.type == 'CAMERA':
+            raise ValueError(f'{cam.name=} had {cam.type=}')
+
+        bpy.context.view_layer.update()
+        cam_loc = cam.matrix_world.translation
+    else:
+        cam_loc = Vector(rays[0][0])
 
     # Reject cameras too close to any placeholder vertex
-    v, i, dist_to_placeholder = placeholders_kd.find(cam.matrix_world.translation)
+    v, i, dist_to_placeholder = placeholders_kd.find(cam_loc)
     if dist_to_placeholder is not None and dist_to_placeholder < min_placeholder_dist:
         logger.debug(f'keep_cam_pose_proposal rejects {dist_to_placeholder=}, {v, i}')
+        pose_rejection_stats.record('placeholder', 0)
         return None
 
-    dists, camera_selection_answers_counts, n_pix = terrain_camera_query(
-        cam, terrain_bvh, camera_selection_answers, vertexwise_min_dist, min_dist=min_terrain_distance)
-    
-    if dists is None:
-        logger.debug('keep_cam_pose_proposal rejects terrain dists')
-        return None
-    
-    coverage = len(dists)/n_pix
-    if coverage < terrain_coverage_range[0] or coverage > terrain_coverage_range[1]:
+    if rays is None:
+        rays = get_sensor_rays(cam, sparse=True)
+    origins, directions, pix_it = rays
+    n_pix = pix_it.shape[0]
+
+    if terrain is not None and terrain_sdf <= 0:
+        logger.debug(f'keep_cam_pose_proposal rejects {terrain_sdf=}')
+        pose_rejection_stats.record('terrain_sdf', 0)
         return None
 
-    if terrain is None:
-        return 0
+    def violated_range(dists, counts, n, eps):
 
-    if terrain_sdf <= 0:
-        logger.debug(f'keep_cam_pose_proposal rejects {terrain_sdf=}')
+        # a range is only violated once the whole confidence interval lies outside it
+        def outside(estimate, minv, maxv):
+            return estimate + eps < minv or estimate - eps > maxv
+
+        if outside(len(dists) / n, *terrain_coverage_range):
+            return 'coverage'
+        if terrain is None:
+            return None
+        if rparams := camera_selection_ratio:
+            for q in rparams:
+                if type(q) is tuple and q[0] == "closeup":
+                    if outside(np.count_nonzero(dists < q[1]) / n, rparams[q][0], rparams[q][1]):
+                        return 'closeup'
+                elif q in counts and outside(counts[q] / n, rparams[q][0], rparams[q][1]):
+                    return q
         return None
 
-    if rparams := camera_selection_ratio:
-        for q in rparams:
-            if type(q) is tuple and q[0] == "closeup":
-                closeup = len([d for d in dists if d < q[1]])/n_pix
-                if closeup < rparams[q][0] or closeup > rparams[q][1]:
-                    return None
-            else:
-                minv, maxv = rparams[q][0], rparams[q][1]
-                if q in camera_selection_answers_counts:
-                    ratio = camera_selection_answers_counts[q] / n_pix
-                    if ratio < minv or ratio > maxv:
-                        return None
+    stages = sorted({s for s in early_reject_stages if 0 < s < n_pix}) + [n_pix]
+    dists = np.zeros(0)
+    camera_selection_answers_counts = {q: 0 for q in camera_selection_answers}
+    n_cast = 0
+    for n in stages:
+        stage_dists, stage_counts, _ = terrain_camera_query(
+            cam, terrain_bvh, camera_selection_answers, vertexwise_min_dist,
+            min_dist=min_terrain_distance, terrain_raycaster=terrain_raycaster, 
+            rays=(origins[n_cast:n], directions[n_cast:n], pix_it[n_cast:n]))
+        n_cast = n
+
+        if stage_dists is None:
+            logger.debug('keep_cam_pose_proposal rejects terrain dists')
+            pose_rejection_stats.record('min_terrain_distance', n_cast)
+            return None
+
+        dists = np.concatenate([dists, stage_dists])
+        for q in camera_selection_answers_counts:
+            camera_selection_answers_counts[q] += stage_counts[q]
+
+        eps = 0 if n == n_pix else hoeffding_radius(n, early_reject_delta)
+        if (reason := violated_range(dists, camera_selection_answers_counts, n, eps)) is not None:
+            logger.debug(f'keep_cam_pose_proposal rejects {reason=} after {n_cast} rays')
+            pose_rejection_stats.record(reason, n_cast)
+            return None
+
+    pose_rejection_stats.record('accepted', n_cast)
+
+    if terrain is None:
+        return 0
 
     return np.std(dists)
     
@@ -401,6 +554,34 @@ class AnimPolicyGoToProposals:
         time = np.linalg.norm(pos - camera_rig.location) / random_general(self.speed)
         return Vector(pos), Vector(rot), time, 'BEZIER'
    
+def propose_view_batch(cam, terrain, terrain_bvh, terrain_bbox, n_proposals):
+
+    '''
+    Samples up to `n_proposals` camera poses using the global RNG, and precomputes everything
+    which needs bpy so that keep_cam_pose_proposal can later check them from worker threads.
+    Returns a list of (loc, rot, rays, terrain_sdf)
+    '''
+
+    if not cam.type == 'CAMERA':
+        cam = [c for c in cam.children if c.type == 'CAMERA'][0]
+
+    proposals = []
+    for _ in range(n_proposals):
+        props = camera_pose_proposal(terrain_bvh=terrain_bvh, terrain_bbox=terrain_bbox)
+        if props is None: continue
+        loc, rot = Vector(props[0]), Euler(props[1], 'XYZ')
+        matrix_world = Matrix.LocRotScale(loc, rot, None)
+        rays = get_sensor_rays(cam, sparse=True, matrix_world=matrix_world)
+        proposals.append([loc, rot, rays, None])
+
+    if terrain is not None and len(proposals):
+        locs = np.array([p[0] for p in proposals]).reshape((-1, 3))
+        sdfs = terrain.compute_camera_space_sdf(locs)
+        for p, sdf in zip(proposals, sdfs):
+            p[3] = sdf
+
+    return proposals
+
 @gin.configurable
 def compute_base_views(
     cam, n_views,
@@ -411,46 +592,102 @@ def compute_base_views(
     camera_selection_answers={},
     vertexwise_min_dist=None,
     camera_selection_ratio=None,
+    terrain_raycaster=None,
     min_candidates_ratio=20,
     max_tries=10000,
+    n_workers=1,
+    batch_size=64,
 ):
-    potential_views = []
-    n_min_candidates = int(min_candidates_ratio * n_views)
-    with tqdm(total=n_min_candidates, desc='Searching for camera viewpoints') as pbar:
-        for it in range(1, max_tries):
 
-            props = camera_pose_proposal(terrain_bvh=terrain_bvh, terrain_bbox=terrain_bbox)
-            if props is None: continue
-            loc, rot = props
+    '''
+    Proposals are sampled in batches of `batch_size`, each under its own seed, and results are accepted
+    in batch order, so the selected views are identical for any n_workers. n_workers > 1 checks the
+    batches on a thread pool, which requires terrain_raycaster since BVHTree queries hold the GIL.
+    Only the raycaster's larger numpy operations release it, placeholders_kd.find and the many small
+    per-proposal numpy calls do not, so the speedup stays well below n_workers
+    '''
 
-            cam.location = loc
-            cam.rotation_euler = rot
-
-            criterion = keep_cam_pose_proposal(
-                cam, terrain, terrain_bvh, placeholders_kd,
-                camera_selection_answers=camera_selection_answers,
-                vertexwise_min_dist=vertexwise_min_dist,
-                camera_selection_ratio=camera_selection_ratio,
-            )
-            if criterion is None:
-                continue
+    n_min_candidates = int(min_candidates_ratio * n_views)
+    pose_rejection_stats.reset()
 
-            # Compute focus distance
-            destination = cam.matrix_world @ Vector((0.,0.,-1.))
-            forward_dir = (destination - cam.location).normalized()
-            *_, straight_ahead_dist = terrain_bvh.ray_cast(cam.location, forward_dir)
+    if n_workers > 1 and terrain_raycaster is None:
+        logger.warning(f'compute_base_views ignoring {n_workers=} since no terrain_raycaster is available')
+        n_workers = 1
 
-            potential_views.append((criterion, deepcopy(cam.location), deepcopy(cam.rotation_euler), straight_ahead_dist))
-            pbar.update(1)
+    keep_func = partial(
+        keep_cam_pose_proposal,
+        terrain=terrain, 
+        terrain_bvh=terrain_bvh, 
+        placeholders_kd=placeholders_kd,
+        camera_selection_answers=camera_selection_answers,
+        vertexwise_min_dist=vertexwise_min_dist,
+        camera_selection_ratio=camera_selection_ratio,
+        terrain_raycaster=terrain_raycaster,
+    )
 
-            if len(potential_views) >= n_min_candidates:
-                break
+    potential_views = compute_base_views_batched(
+        cam, keep_func, terrain, terrain_bvh, terrain_bbox,
+        n_min_candidates, max_tries, n_workers, batch_size)
 
+    logger.info(f'compute_base_views pose checks: {pose_rejection_stats.summary()}')
     if len(potential_views) < n_views:
         raise ValueError(f'Could not find {n_views} camera views')
     
     return sorted(potential_views, reverse=True)[:n_views]
 
+def compute_base_views_batched(
+    cam, keep_func, terrain, terrain_bvh, terrain_bbox,
+    n_min_candidates, max_tries, n_workers, batch_size
+):
+
+    def evaluate(proposals):
+        return [keep_func(cam, rays=rays, terrain_sdf=sdf) for _, _, rays, sdf in proposals]
+
+    base_seed = np.random.randint(np.iinfo(np.int32).max)
+    n_batches = int(np.ceil((max_tries - 1) / batch_size))
+    batch_idxs = iter(range(n_batches))
+
+    def submit(executor, pending):
+        b = next(batch_idxs, None)
+        if b is None:
+            return
+        with FixedSeed(int_hash((base_seed, b))):
+            n = min(batch_size, max_tries - 1 - b * batch_size)
+            proposals = propose_view_batch(cam, terrain, terrain_bvh, terrain_bbox, n)
+        # with a single worker batches are checked inline when they are reached
+        future = executor.submit(evaluate, proposals) if executor is not None else None
+        pending.append((proposals, future))
+
+    potential_views = []
+    pbar = tqdm(total=n_min_candidates, desc=f'Searching for camera viewpoints ({n_workers=})')
+    executor = ThreadPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    with pbar:
+        pending = deque()
+        try:
+            for _ in range(2 * n_workers if executor is not None else 1):
+                submit(executor, pending)
+
+            while pending and len(potential_views) < n_min_candidates:
+                proposals, future = pending.popleft()
+                submit(executor, pending)
+                results = future.result() if future is not None else evaluate(proposals)
+                for (loc, rot, rays, _), criterion in zip(proposals, results):
+                    if criterion is None:
+                        continue
+                    forward_dir = rot.to_matrix() @ Vector((0., 0., -1.))
+                    *_, straight_ahead_dist = terrain_bvh.ray_cast(loc, forward_dir)
+                    potential_views.append((criterion, loc, rot, straight_ahead_dist))
+                    pbar.update(1)
+                    if len(potential_views) >= n_min_candidates:
+                        break
+        finally:
+            if executor is not None:
+                for _, future in pending:
+                    future.cancel()
+                executor.shutdown(wait=True)
+
+    return potential_views
+
 @gin.configurable
 def camera_selection_keep_in_animation(**kwargs):
     return kwargs
@@ -471,9 +708,66 @@ def camera_selection_ranges_ratio(**kwargs):
         d[kwargs[k][:-2]] = (kwargs[k][-2], kwargs[k][-1], k in keep_in_animation and keep_in_animation[k])
     return d
 
+def cached_terrain_bvh_and_attrs(terrain, terrain_mesh, scene_seed, ratio_keys, cache_dir, use_batched_raycast):
+
+    '''
+    terrain.build_terrain_bvh_and_attrs, reusing the attributes from `cache_dir` when the seed, a digest
+    of the terrain mesh and the ratio keys match. Only terrains whose every face is part of the terrain bvh
+    are cached. Their attributes are reindexed to the polygons of `terrain_mesh`, and cache hits and misses
+    alike return the bvh of `terrain_mesh` they are indexed by, so cold and warm runs of a scene give identical
+    camera selections. Terrains which are not cached return the terrain bvh on every run, as for cache_dir=None
+    '''
+
+    vertices, faces, polys = raycast.mesh_arrays_from_object(terrain_mesh)
+    key = camera_cache.cache_key(scene_seed, camera_cache.mesh_fingerprint(vertices, faces, polys), ratio_keys)
+
+    cached = camera_cache.load(cache_dir, key, ratio_keys)
+    if cached is None:
+        with Timer(f'Building terrain BVHTree'):
+            attrs_bvh, answers, vertexwise_min_dist = terrain.build_terrain_bvh_and_attrs(ratio_keys)
+        face_ids = raycast.match_faces_to_bvh(vertices, faces, attrs_bvh, polys=polys)
+        keep = face_ids >= 0
+
+        if not keep.all():
+            logger.warning(f'{np.count_nonzero(~keep)} of {len(faces)} terrain mesh faces are not part of the '
+                           f'terrain bvh, not caching camera selection attributes')
+            terrain_raycaster = None
+            if not keep.any():
+                logger.warning('Terrain mesh does not match terrain_bvh, falling back to per-ray BVH queries')
+            elif use_batched_raycast:
+                terrain_raycaster = raycast.MeshRaycaster(vertices, faces[keep], face_ids=face_ids[keep])
+            return attrs_bvh, answers, vertexwise_min_dist, terrain_raycaster
+
+        # reindex to the polygons of terrain_mesh, which is what BVHTree.FromObject reports
+        poly_face = np.empty(polys.max() + 1, dtype=np.int64)
+        poly_face[polys] = face_ids
+        answers = {k: np.asarray(v)[poly_face] for k, v in answers.items()}
+        if vertexwise_min_dist is not None:
+            vertexwise_min_dist = np.asarray(vertexwise_min_dist)[poly_face]
+        with Timer('Building terrain raycaster'):
+            terrain_raycaster = raycast.MeshRaycaster(vertices, faces, face_ids=polys)
+        camera_cache.save(cache_dir, key, ratio_keys, answers, vertexwise_min_dist, terrain_raycaster)
+        cached = camera_cache.load(cache_dir, key, ratio_keys) or (answers, vertexwise_min_dist, terrain_raycaster)
+        del attrs_bvh # its face indices no longer match the attributes
+
+    # the one bvh both hits and misses return
+    answers, vertexwise_min_dist, terrain_raycaster = cached
+    with Timer('Building terrain BVHTree from terrain mesh'):
+        terrain_bvh = BVHTree.FromObject(terrain_mesh, bpy.context.evaluated_depsgraph_get())
+
+    if not use_batched_raycast:
+        terrain_raycaster = None
+
+    return terrain_bvh, answers, vertexwise_min_dist, terrain_raycaster
+
+@gin.configurable
 def camera_selection_preprocessing(
     terrain, 
     terrain_mesh,
+    use_batched_raycast=True,
+    use_heightfield=True,
+    scene_seed=None,
+    cache_dir=None,
 ):
     camera_selection_ratio = camera_selection_tags_ratio()
     camera_selection_ratio.update(camera_selection_ranges_ratio())
@@ -488,14 +782,42 @@ def camera_selection_preprocessing(
 
     if terrain is None:
         bvh = BVHTree.FromObject(terrain_mesh, bpy.context.evaluated_depsgraph_get())
+        terrain_raycaster = None
+        if use_batched_raycast:
+            with Timer('Building terrain raycaster'):
+                terrain_raycaster = raycast.MeshRaycaster.from_object(terrain_mesh)
+        if use_heightfield and terrain_raycaster is not None:
+            with Timer('Building terrain heightfield'):
+                bvh = heightfield.SeabedHeightfield(bvh, terrain_raycaster)
         return dict(
             terrain=None,
             terrain_bvh=bvh,
-            placeholders_kd=placeholders_kd
+            placeholders_kd=placeholders_kd,
+            terrain_raycaster=terrain_raycaster,
         )
 
-    with Timer(f'Building terrain BVHTree'):
-        terrain_bvh, camera_selection_answers, vertexwise_min_dist = terrain.build_terrain_bvh_and_attrs(camera_selection_ratio.keys())
+    if cache_dir is not None:
+        terrain_bvh, camera_selection_answers, vertexwise_min_dist, terrain_raycaster = cached_terrain_bvh_and_attrs(
+            terrain, terrain_mesh, scene_seed, list(camera_selection_ratio.keys()), cache_dir, use_batched_raycast)
+    else:
+        with Timer(f'Building terrain BVHTree'):
+            terrain_bvh, camera_selection_answers, vertexwise_min_dist = terrain.build_terrain_bvh_and_attrs(camera_selection_ratio.keys())
+
+        terrain_raycaster = None
+        if use_batched_raycast:
+            with Timer('Building terrain raycaster'):
+                # the attribute arrays are indexed by terrain_bvh faces, so translate our face indices to match
+                vertices, faces, polys = raycast.mesh_arrays_from_object(terrain_mesh)
+                face_ids = raycast.match_faces_to_bvh(vertices, faces, terrain_bvh, polys=polys)
+                keep = face_ids >= 0
+                if not keep.any():
+                    logger.warning('Terrain mesh does not match terrain_bvh, falling back to per-ray BVH queries')
+                else:
+                    terrain_raycaster = raycast.MeshRaycaster(vertices, faces[keep], face_ids=face_ids[keep])
+
+    if use_heightfield and terrain_raycaster is not None:
+        with Timer('Building terrain heightfield'):
+            terrain_bvh = heightfield.SeabedHeightfield(terrain_bvh, terrain_raycaster)
 
     return dict(
         terrain=terrain,
@@ -504,6 +826,7 @@ def camera_selection_preprocessing(
         vertexwise_min_dist=vertexwise_min_dist,
         placeholders_kd=placeholders_kd,
         camera_selection_ratio=camera_selection_ratio,
+        terrain_raycaster=terrain_raycaster,
     )
 
 @gin.configurable
@@ -553,6 +876,41 @@ def configure_camera_lights(
 
 
 
+def set_lens_model_distortion(cam_ob, image_height, image_width, lens, cache_dir=None):
+
+    '''
+    set_lens_distortion for any lens_distortion.LensModel. Only the border pixels are solved to configure
+    the camera. With a `cache_dir` the render intrinsics are reused when the intrinsics, resolution and
+    lens match, the camera is tagged with the cache entry and the full mapping is computed by the first
+    task that loads it. Otherwise the mapping is saved with the camera as save_distortion_parameters does
+    '''
+
+    K = get_intrinsics_as_K_matrix(cam_ob, image_width, image_height)
+    orig_resolution = (image_height, image_width)
+
+    if cache_dir is None:
+        with Timer(f'Computing {lens.name} lens distortion mapping for {cam_ob.name}'):
+            render_K, render_resolution = compute_lens_distortion_render_intrinsics(
+                K, image_height, image_width, lens)
+            mapping_coords = compute_lens_distortion_mapping_for(
+                K, render_K, render_resolution, image_height, image_width, lens)
+        save_distortion_parameters(cam_ob, mapping_coords, np.array(orig_resolution))
+    else:
+        key = distortion_cache.cache_key(K, orig_resolution, lens)
+        cached = distortion_cache.load(cache_dir, key)
+        if cached is None:
+            with Timer(f'Computing {lens.name} lens distortion render intrinsics for {cam_ob.name}'):
+                render_K, render_resolution = compute_lens_distortion_render_intrinsics(
+                    K, image_height, image_width, lens)
+            distortion_cache.save(cache_dir, key, None, K, render_K, render_resolution, orig_resolution, lens)
+        else:
+            _, render_K, render_resolution, _ = cached
+
+    set_intrinsics_from_K_matrix(cam_ob, render_K, render_resolution[0], render_resolution[1],
+                                 cam_ob.data.clip_start, cam_ob.data.clip_end)
+    if cache_dir is not None:
+        cam_ob[distortion_cache.MAPPING_ATTR] = str((Path(cache_dir)/key).resolve())
+
 @gin.configurable
 def set_camera_parameters(cam_rigs,
                           focal_mm=15.89,
@@ -565,7 +923,17 @@ def set_camera_parameters(cam_rigs,
                           cx=None,
                           cy=None,
                           focus_dist=None,
+                          distortion_cache_dir=None,
+                          lens_model=None,
                           ):
+
+    '''
+    distortion_cache_dir: if set, lens distortion mappings are shared between cameras, scenes and tasks
+        through this folder rather than saved per camera in the working directory
+    lens_model: a lens_distortion.LensModel eg @KannalaBrandt() for fisheye lenses,
+        Brown-Conrady with k1_k2_p1_p2_k3 if None
+    '''
+
     [k1, k2, p1, p2, k3] = k1_k2_p1_p2_k3
     image_height = bpy.context.scene.render.resolution_y
     image_width = bpy.context.scene.render.resolution_x
@@ -591,7 +959,10 @@ def set_camera_parameters(cam_rigs,
             set_intrinsics_from_blender_params(cam_ob, lens=focal_mm, lens_unit="MILLIMETERS",
                                                             shift_x=cx,
                                                             shift_y=cy)
-            if use_distortion:
+            if use_distortion and (distortion_cache_dir is not None or lens_model is not None):
+                lens = lens_model if lens_model is not None else BrownConrady(k1, k2, k3, p1, p2)
+                set_lens_model_distortion(cam_ob, image_height, image_width, lens, distortion_cache_dir)
+            elif use_distortion:
                 mapping_coords = set_lens_distortion(
                     cam_ob, image_height, image_width, k1, k2, k3, p1, p2)
                 save_distortion_parameters(cam_ob, mapping_coords, np.array([image_height, image_width]))
@@ -609,7 +980,15 @@ def animate_cameras(
     pois=None,
     follow_poi_chance=0.0,
     policy_registry = None,
+    planning_workers=1,
 ):
+
+    '''
+    planning_workers: if > 1 and every rig's policy has a plan_trajectory planner, plan all rigs
+        concurrently with animation_policy.plan_trajectories_parallel, then validate and apply them here.
+        Validation stays serial, so only the planning time scales with planning_workers
+    '''
+
     animation_ratio = {}
     animation_answers = {}
     for k in scene_preprocessed['camera_selection_ratio']:
@@ -625,32 +1004,71 @@ def animate_cameras(
         vertexwise_min_dist=scene_preprocessed['vertexwise_min_dist'],
         camera_selection_answers=animation_answers,
         camera_selection_ratio=animation_ratio,
+        terrain_raycaster=scene_preprocessed.get('terrain_raycaster'),
     )
 
-    for cam_rig in cam_rigs:
-
-        if policy_registry is None:
-            if U() < follow_poi_chance and pois is not None and len(pois):
-                policy = animation_policy.AnimPolicyFollowObject(
-                    target_obj=cam_rig, 
-                    pois=pois, 
-                    bvh=scene_preprocessed['terrain_bvh']
-                )
-            else:
-                policy = animation_policy.AnimPolicyRandomWalkLookaround()
-        else:
-            policy = policy_registry()
-
-        logger.info(f'Animating {cam_rig=} using {policy=}')
+    def make_policy(cam_rig):
+        if policy_registry is not None:
+            return policy_registry()
+        if U() < follow_poi_chance and pois is not None and len(pois):
+            return animation_policy.AnimPolicyFollowObject(
+                target_obj=cam_rig, 
+                pois=pois, 
+                bvh=scene_preprocessed['terrain_bvh']
+            )
+        return animation_policy.AnimPolicyRandomWalkLookaround()
 
-        animation_policy.animate_trajectory(
-            cam_rig, 
+    def animate(cam_rig, **kwargs):
+        counts, rays = pose_rejection_stats.snapshot()
+        res = animation_policy.animate_trajectory(
+            cam_rig,
             scene_preprocessed['terrain_bvh'],
-            policy_func=policy,
             validate_pose_func=anim_valid_pose_func, 
             verbose=True, 
-            fatal=True
+            fatal=True,
+            **kwargs
         )
+        # attribute the pose checks made while animating this rig to it
+        counts_after, rays_after = pose_rejection_stats.snapshot()
+        animation_telemetry.add_pose_stats(
+            cam_rig.name,
+            {k: v - counts.get(k, 0) for k, v in counts_after.items()},
+            {k: v - rays.get(k, 0) for k, v in rays_after.items()},
+        )
+        return res
+
+    pose_rejection_stats.reset()
+    animation_telemetry.reset()
+    if planning_workers > 1 and len(cam_rigs) > 1:
+        policies = [make_policy(cam_rig) for cam_rig in cam_rigs]
+        if all(getattr(p, 'use_planner', False) for p in policies):
+            plans = animation_policy.plan_trajectories_parallel(
+                cam_rigs, policies, 
+                scene_preprocessed['terrain_bvh'], 
+                raycaster=scene_preprocessed.get('terrain_raycaster'),
+                n_workers=planning_workers,
+            )
+            # validation needs the scene so happens here, rigs whose plan failed are replanned sequentially
+            buffers = []
+            for cam_rig, policy, plan in zip(cam_rigs, policies, plans):
+                logger.info(f'Animating {cam_rig=} using {policy=} {plan is not None=}')
+                buffers.append(animate(cam_rig, policy_func=policy, plan=plan, flush=False))
+            for cam_rig, buffer in zip(cam_rigs, buffers):
+                if buffer is not None:
+                    buffer.flush(cam_rig)
+            logger.info(f'animate_cameras pose checks: {pose_rejection_stats.summary()}')
+            return
+        logger.warning(f'{planning_workers=} needs planner policies for every rig, animating sequentially')
+    else:
+        policies = [None] * len(cam_rigs)
+
+    for cam_rig, policy in zip(cam_rigs, policies):
+        if policy is None:
+            policy = make_policy(cam_rig)
+        logger.info(f'Animating {cam_rig=} using {policy=}')
+        animate(cam_rig, policy_func=policy)
+
+    logger.info(f'animate_cameras pose checks: {pose_rejection_stats.summary()}')
 
 @gin.configurable
 def save_camera_parameters(camera_ids, output_folder, frame, use_dof=False):
@@ -692,18 +1110,18 @@ if __name__ == "__main__":
 
     target_obj = bpy.context.active_object
     to_obj_coords = target_obj.matrix_world.inverted()
-    sensor_coords, pix_it = get_sensor_coords(cam, sparse=False)
 
-    H,W = sensor_coords.shape
+    H, W = scene.render.resolution_y, scene.render.resolution_x
+    origins, directions, pix_it = get_sensor_rays(cam, H, W, sparse=False)
+    M = np.asarray(cam.matrix_world)
+    sensor_dists = np.linalg.norm(sensor_plane_coords(cam, H, W, pix_it) @ M[:3, :3].T, axis=-1)
+
     depth_output = np.zeros((H,W), dtype=np.float64)
 
-    for x,y in tqdm(pix_it):
-        destination = sensor_coords[y,x]
-        direction = (destination - cam.location).normalized()
-        location, normal, index, dist = bvhtree.ray_cast(cam.location, direction)
+    origin = Vector(origins[0])
+    for (x, y), direction, dist_diff in tqdm(zip(pix_it, directions, sensor_dists), total=len(pix_it)):
+        location, normal, index, dist = bvhtree.ray_cast(origin, Vector(direction))
         if dist is not None:
-            dist_diff = (destination - cam.location).length
-            assert dist > (location - destination).length, (dist, (location - destination).length)
             assert dist > dist_diff
             depth_output[H-y-1,x] = dist - dist_diff
 
@@ -0,0 +1,115 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Content-addressed on-disk cache for the terrain side of camera_selection_preprocessing.
+
+Entries are keyed on the scene seed, a digest of the whole terrain mesh and the
+camera selection ratio keys. Each entry is a directory of .npy files plus a manifest,
+written to a temporary directory then renamed into place so concurrent tasks never see
+a partial entry. Arrays, including the terrain's raycast.MeshRaycaster, are loaded
+memory-mapped, so only the pages touched by camera queries are ever read.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from infinigen.core.placement import raycast
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 3
+
+def mesh_fingerprint(vertices, faces, polys):
+
+    '''
+    Digest of the full world-space vertex, triangle and polygon index buffers of the terrain mesh,
+    as returned by raycast.mesh_arrays_from_object, so any edit to the terrain changes the key
+    '''
+
+    m = hashlib.md5()
+    m.update(np.ascontiguousarray(vertices, dtype=np.float32).tobytes())
+    m.update(np.ascontiguousarray(faces, dtype=np.int32).tobytes())
+    m.update(np.ascontiguousarray(polys, dtype=np.int32).tobytes())
+    return m.hexdigest()
+
+def cache_key(scene_seed, fingerprint, ratio_keys):
+    m = hashlib.md5()
+    m.update(f'v{CACHE_VERSION} seed={scene_seed} ratios={[repr(k) for k in ratio_keys]}'.encode('utf-8'))
+    m.update(f'mesh={fingerprint}'.encode('utf-8'))
+    return m.hexdigest()
+
+def load(cache_dir, key, ratio_keys):
+
+    '''
+    Returns (camera_selection_answers, vertexwise_min_dist, raycaster) memory-mapped from disk,
+    or None if there is no complete entry for `key`. Attributes are indexed by terrain mesh polygon
+    '''
+
+    entry = Path(cache_dir)/key
+    manifest_path = entry/'manifest.json'
+    if not manifest_path.exists():
+        return None
+
+    with manifest_path.open('r') as f:
+        manifest = json.load(f)
+
+    ratio_keys = list(ratio_keys)
+    arrays = {name: np.load(entry/f'{name}.npy', mmap_mode='r') for name in manifest['arrays']}
+    answers = {ratio_keys[i]: arrays[f'answers_{i}'] for i in manifest['answers']}
+    vertexwise_min_dist = arrays.get('vertexwise_min_dist')
+
+    raycaster = raycast.MeshRaycaster.load(entry/'raycaster')
+
+    logger.info(f'Loaded camera selection cache {entry}')
+    return answers, vertexwise_min_dist, raycaster
+
+def save(cache_dir, key, ratio_keys, camera_selection_answers, vertexwise_min_dist, raycaster):
+
+    cache_dir = Path(cache_dir)
+    entry = cache_dir/key
+    if entry.exists():
+        return
+
+    tmp = cache_dir/f'.{key}.tmp-{os.getpid()}'
+    tmp.mkdir(parents=True, exist_ok=True)
+
+    ratio_keys = list(ratio_keys)
+    arrays = {}
+    answer_idxs = []
+    for k, v in camera_selection_answers.items():
+        i = ratio_keys.index(k)
+        arrays[f'answers_{i}'] = v
+        answer_idxs.append(i)
+    if vertexwise_min_dist is not None:
+        arrays['vertexwise_min_dist'] = vertexwise_min_dist
+
+    for name, arr in arrays.items():
+        np.save(tmp/f'{name}.npy', np.ascontiguousarray(arr))
+    raycaster.save(tmp/'raycaster')
+
+    manifest = dict(
+        version=CACHE_VERSION,
+        arrays=list(arrays.keys()),
+        answers=answer_idxs,
+        ratio_keys=[repr(k) for k in ratio_keys],
+    )
+    with (tmp/'manifest.json').open('w') as f:
+        json.dump(manifest, f, indent=4)
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another task won the race to write the same entry
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    logger.info(f'Saved camera selection cache {entry}')
@@ -0,0 +1,124 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Content-addressed on-disk cache for lens distortion mappings.
+
+The inversion of the lens model in bproc_camera_utility.compute_lens_distortion_mapping_for
+only depends on the K matrix, the output resolution and the lens model, which
+are the same calibration for every camera of every scene. Entries are keyed on a hash of
+those, written to a temporary directory then renamed into place so concurrent tasks never
+see a partial entry, and the mapping is loaded memory-mapped by every render task.
+
+Configuring cameras only needs the render K matrix and resolution, so entries may be created
+without the mapping, which is then added by the first task that needs it via save_mapping.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 3
+MAPPING_ATTR = 'distortion_mapping' # camera custom property pointing render tasks at a cache entry
+
+def cache_key(K, resolution, lens):
+
+    '''
+    K: 3x3 intrinsics at the output resolution, resolution: (H, W), lens: a lens_distortion.LensModel
+    '''
+
+    m = hashlib.md5()
+    m.update(f'v{CACHE_VERSION} res={[int(r) for r in resolution]} lens={lens.name}'.encode('utf-8'))
+    m.update(np.ascontiguousarray(K, dtype=np.float64).tobytes())
+    m.update(np.ascontiguousarray(lens.params(), dtype=np.float64).tobytes())
+    return m.hexdigest()
+
+def load(cache_dir, key):
+
+    '''
+    Returns (mapping_coords, render_K, render_resolution, orig_resolution) with mapping_coords
+    memory-mapped from disk, or None if there is no complete entry for `key`.
+    mapping_coords is None if the entry was saved without it and nobody has computed it yet
+    '''
+
+    entry = Path(cache_dir)/key
+    manifest_path = entry/'manifest.json'
+    if not manifest_path.exists():
+        return None
+
+    with manifest_path.open('r') as f:
+        manifest = json.load(f)
+
+    mapping_path = entry/'mapping_coords.npy'
+    mapping_coords = np.load(mapping_path, mmap_mode='r') if mapping_path.exists() else None
+    logger.debug(f'Loaded lens distortion mapping {entry}')
+    return (
+        mapping_coords,
+        np.array(manifest['render_K']),
+        np.array(manifest['render_resolution']),
+        np.array(manifest['orig_resolution']),
+    )
+
+def load_manifest(cache_dir, key):
+    with (Path(cache_dir)/key/'manifest.json').open('r') as f:
+        return json.load(f)
+
+def save(cache_dir, key, mapping_coords, K, render_K, render_resolution, orig_resolution, lens):
+
+    '''
+    mapping_coords may be None, to be added later with save_mapping
+    '''
+
+    cache_dir = Path(cache_dir)
+    entry = cache_dir/key
+    if entry.exists():
+        return
+
+    tmp = cache_dir/f'.{key}.tmp-{os.getpid()}'
+    tmp.mkdir(parents=True, exist_ok=True)
+
+    if mapping_coords is not None:
+        np.save(tmp/'mapping_coords.npy', np.ascontiguousarray(mapping_coords))
+    manifest = dict(
+        version=CACHE_VERSION,
+        K=np.asarray(K).tolist(),
+        render_K=np.asarray(render_K).tolist(),
+        render_resolution=[int(r) for r in render_resolution],
+        orig_resolution=[int(r) for r in orig_resolution],
+        lens=lens.to_dict(),
+    )
+    with (tmp/'manifest.json').open('w') as f:
+        json.dump(manifest, f, indent=4)
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another task won the race to write the same entry
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    logger.info(f'Saved lens distortion mapping {entry}')
+
+def save_mapping(cache_dir, key, mapping_coords):
+    entry = Path(cache_dir)/key
+    path = entry/'mapping_coords.npy'
+    if path.exists():
+        return
+    # np.save would append .npy to a name without it
+    tmp = entry/f'.mapping_coords.tmp-{os.getpid()}.npy'
+    np.save(tmp, np.ascontiguousarray(mapping_coords))
+    os.replace(tmp, path)
+    logger.info(f'Saved lens distortion mapping {path}')
+
+def entry_path(cam_ob):
+    path = cam_ob.get(MAPPING_ATTR)
+    return None if path is None else Path(path)
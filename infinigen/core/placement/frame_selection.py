@@ -0,0 +1,221 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Overlap-targeted selection of the frames to render from an animated survey.
+
+Survey policies move the rig much less than a footprint per frame, so consecutive frames
+overlap far more than is needed. After animate_cameras we project each frame's image border
+onto the terrain, and keep only the frames needed to hold a target forward overlap along
+track, dropping frames whose footprint is already covered by other parts of the survey.
+The result is written to render_frames.json in the coarse folder, which iterate_scene_tasks only
+renders from when its render_frames_file is set. Both are opt-in: generate_auv_mission only runs
+the selection when compose_scene.select_render_frames is set.
+'''
+
+import json
+import logging
+import math
+from pathlib import Path
+
+import bpy
+import gin
+import numpy as np
+from mathutils import Vector
+from scipy.spatial.transform import Rotation
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+
+from infinigen.core.placement import trajectory, raycast
+from infinigen.core.placement.camera import sensor_plane_coords
+
+logger = logging.getLogger(__name__)
+
+RENDER_FRAMES_FILENAME = 'render_frames.json'
+
+def parent_space_matrices(obj, frames):
+
+    '''
+    (F, 4, 4) matrix_parent_inverse @ matrix_basis of `obj` at each frame, from its keyframes
+    '''
+
+    locs, rots = trajectory.evaluate_object_fcurves(obj, frames)
+    M = np.zeros((len(frames), 4, 4))
+    M[:, :3, :3] = Rotation.from_euler('xyz', rots).as_matrix() * np.array(obj.scale)
+    M[:, :3, 3] = locs
+    M[:, 3, 3] = 1
+    return np.asarray(obj.matrix_parent_inverse, dtype=np.float64) @ M
+
+def camera_world_matrices(cam, frames):
+
+    '''
+    (F, 4, 4) world matrix of `cam` at each frame, composed from the keyframes of cam and every parent
+    without setting the scene frame. Falls back to scene.frame_set if any of them has constraints or drivers
+    '''
+
+    chain = []
+    o = cam
+    while o is not None:
+        chain.append(o)
+        o = o.parent
+
+    if any(trajectory.has_constraints_or_drivers(o) for o in chain):
+        M = np.zeros((len(frames), 4, 4))
+        for i, frame in enumerate(frames):
+            bpy.context.scene.frame_set(int(frame))
+            M[i] = np.array(cam.matrix_world)
+        return M
+
+    M = np.broadcast_to(np.eye(4), (len(frames), 4, 4))
+    for o in reversed(chain):
+        M = M @ parent_space_matrices(o, frames)
+    return M
+
+def border_pixel_locs(H, W, n_per_edge):
+    t = np.linspace(0, 1, n_per_edge, endpoint=False)
+    top = np.stack([t * W, np.zeros_like(t)], axis=-1)
+    right = np.stack([np.full_like(t, W), t * H], axis=-1)
+    bottom = np.stack([W - t * W, np.full_like(t, H)], axis=-1)
+    left = np.stack([np.zeros_like(t), H - t * H], axis=-1)
+    return np.concatenate([top, right, bottom, left])
+
+def cast_rays(terrain, origins, directions):
+    if isinstance(terrain, raycast.MeshRaycaster):
+        dist, _ = terrain.ray_cast(origins, directions)
+        return dist
+    dist = np.full(len(origins), np.inf)
+    for k, (o, d) in enumerate(zip(origins, directions)):
+        *_, hit = terrain.ray_cast(Vector(o), Vector(d))
+        if hit is not None:
+            dist[k] = hit
+    return dist
+
+@gin.configurable
+def frame_footprints(cam, frames, terrain, n_per_edge=8):
+
+    '''
+    Terrain footprint of `cam` at each frame, as a shapely Polygon in world xy, or None where some
+    of the image border does not land on the terrain.
+    terrain: a raycast.MeshRaycaster, or anything with a BVHTree-like ray_cast
+    '''
+
+    scene = bpy.context.scene
+    H, W = scene.render.resolution_y, scene.render.resolution_x
+    rel = sensor_plane_coords(cam, H, W, border_pixel_locs(H, W, n_per_edge))
+
+    M = camera_world_matrices(cam, frames)
+    directions = np.einsum('fij,pj->fpi', M[:, :3, :3], rel)
+    directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+    origins = np.broadcast_to(M[:, None, :3, 3], directions.shape)
+
+    dist = cast_rays(terrain, origins.reshape(-1, 3), directions.reshape(-1, 3)).reshape(len(frames), -1)
+    hits = origins + directions * dist[..., None]
+
+    footprints = []
+    for f in range(len(frames)):
+        if not np.isfinite(dist[f]).all():
+            footprints.append(None)
+            continue
+        poly = Polygon(hits[f, :, :2])
+        if not poly.is_valid:
+            poly = poly.buffer(0) # very oblique views over rough terrain can fold the border over itself
+        footprints.append(poly if poly.area > 0 else None)
+    return footprints
+
+@gin.configurable
+def select_frames(frames, footprints, forward_overlap=0.6, max_redundant_overlap=0.6):
+
+    '''
+    Greedy along-track selection. Each selected frame is the last one that still overlaps the
+    previously selected frame by at least `forward_overlap` of its area. A selected frame is then
+    dropped if more than `max_redundant_overlap` of it is already covered by selected frames other
+    than its along-track neighbours, eg turns, hovering, or revisiting an earlier transect.
+    Frames without a footprint are never selected
+
+    max_redundant_overlap is a cap on redundancy, not a target side overlap between adjacent lanes,
+    which is set by the survey itself, eg AnimPolicyMowTheLawn.side_overlap. Keep it above that
+    side overlap, or frames of every lane after the first are dropped as redundant
+    '''
+
+    assert 0 <= forward_overlap < 1
+    valid = [i for i, fp in enumerate(footprints) if fp is not None]
+    if not valid:
+        return []
+
+    def overlap(a, b):
+        return footprints[a].intersection(footprints[b]).area / footprints[b].area
+
+    # on a straight track, only the previous ceil(1/(1-forward_overlap)) selected frames can overlap the next one
+    n_neighbours = math.ceil(1 / (1 - forward_overlap))
+    selected = []
+    n_redundant = 0
+
+    def take(i):
+        nonlocal n_redundant
+        others = [footprints[j] for j in selected[:-n_neighbours]]
+        b = footprints[i].bounds
+        others = [o for o in others if not (
+            o.bounds[0] > b[2] or o.bounds[2] < b[0] or o.bounds[1] > b[3] or o.bounds[3] < b[1])]
+        if others and unary_union(others).intersection(footprints[i]).area / footprints[i].area > max_redundant_overlap:
+            n_redundant += 1
+            return
+        selected.append(i)
+
+    anchor, candidate = valid[0], None
+    take(anchor)
+    k = 1
+    while k < len(valid):
+        i = valid[k]
+        if overlap(anchor, i) >= forward_overlap:
+            candidate = i
+            k += 1
+            continue
+        if candidate is None:
+            # even the next frame is too far, take it anyway rather than leave a gap
+            candidate = i
+            k += 1
+        anchor, candidate = candidate, None
+        take(anchor)
+    if candidate is not None:
+        take(candidate)
+
+    logger.info(
+        f'Selected {len(selected)}/{len(frames)} frames for {forward_overlap=} {max_redundant_overlap=}, '
+        f'dropped {len(frames) - len(valid)} without a footprint and {n_redundant} redundant'
+    )
+    return [int(frames[i]) for i in selected]
+
+@gin.configurable
+def select_render_frames(cam_rigs, scene_preprocessed, output_folder, subcam_ids=None):
+
+    '''
+    Selects the frames to render for every rig and writes them to output_folder/render_frames.json.
+    A rig's footprint is the union of its cameras' footprints, subcam_ids restricts which cameras count
+    '''
+
+    scene = bpy.context.scene
+    frames = np.arange(scene.frame_start, scene.frame_end + 1)
+
+    terrain_bvh = scene_preprocessed['terrain_bvh']
+    terrain = getattr(terrain_bvh, 'raycaster', None) or scene_preprocessed.get('terrain_raycaster') or terrain_bvh
+
+    result = {}
+    for i, rig in enumerate(cam_rigs):
+        cams = [c for c in rig.children if c.type == 'CAMERA']
+        if subcam_ids is not None:
+            cams = [c for c in cams if int(c.name.split('/')[-1]) in subcam_ids]
+        per_cam = [frame_footprints(cam, frames, terrain) for cam in cams]
+        footprints = [
+            None if any(fp is None for fp in fps) else unary_union(fps)
+            for fps in zip(*per_cam)
+        ]
+        result[str(i)] = select_frames(frames, footprints)
+
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    with (output_folder/RENDER_FRAMES_FILENAME).open('w') as f:
+        json.dump(dict(frame_range=[int(frames[0]), int(frames[-1])], frames=result), f, indent=4)
+
+    return result
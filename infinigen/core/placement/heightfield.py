@@ -0,0 +1,251 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+2.5D heightfield index of the seabed, for cheap batched altitude / slope queries.
+
+Downward looking AUV cameras spend most of their placement and animation time asking
+"how far is the terrain straight below this point". SeabedHeightfield rasterizes the top
+surface of the terrain once per scene and answers those queries by bilinear lookup,
+falling back to the exact BVH only where the terrain is not a heightfield (overhangs)
+or the query point is not clearly above it.
+'''
+
+import json
+import logging
+from pathlib import Path
+
+import gin
+import numpy as np
+from mathutils import Vector
+
+from . import raycast
+
+logger = logging.getLogger(__name__)
+
+DOWN = np.array([0., 0., -1.])
+
+@gin.configurable
+class SeabedHeightfield:
+
+    '''
+    Wraps a terrain BVHTree, so it can be passed anywhere a terrain_bvh is expected.
+    Attributes other than the heightfield queries (ray_cast, find_nearest, ...) go to the BVH.
+
+    bvh: mathutils BVHTree of the terrain, used for fallback queries
+    raycaster: raycast.MeshRaycaster of the same terrain, used to rasterize the top surface
+    cell_size: grid spacing in meters, defaults to the median triangle edge length
+    '''
+
+    def __init__(self, bvh, raycaster, cell_size=None, max_nodes=2**24, overhang_min_normal_z=0.05):
+
+        self.bvh = bvh
+        self.raycaster = raycaster
+
+        vertices = raycaster.vertices.astype(np.float64)
+        tri = vertices[raycaster.faces]
+
+        if cell_size is None:
+            edges = np.linalg.norm(tri[:, 1, :2] - tri[:, 0, :2], axis=-1)
+            cell_size = float(np.median(edges[edges > 0])) if (edges > 0).any() else 1.0
+        lo, hi = vertices[:, :2].min(axis=0), vertices[:, :2].max(axis=0)
+        cell_size = max(cell_size, np.sqrt(np.prod(hi - lo) / max_nodes))
+        self.cell_size = cell_size
+        self.origin = lo
+        self.shape = np.maximum(np.ceil((hi - lo) / cell_size).astype(np.int64), 1) # (nx, ny) cells
+
+        self._rasterize_top(raycaster, vertices[:, 2].max())
+        self._bin_triangles(tri, overhang_min_normal_z)
+
+        logger.info(
+            f'Built SeabedHeightfield with {self.shape=} {self.cell_size=:.3f}, '
+            f'{self.fallback.mean():.1%} cells need BVH fallback'
+        )
+
+    def __getattr__(self, name):
+        # only called for attributes not found normally, guard against recursion during unpickling
+        if name in ('bvh', 'raycaster'):
+            raise AttributeError(name)
+        return getattr(self.bvh, name)
+
+    _ARRAYS = ('heights', 'zmin', 'zmax', 'overhang', 'fallback')
+
+    def save(self, folder):
+
+        '''
+        Exports the grid and its raycaster to `folder` as .npy files, for load() in worker processes
+        '''
+
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        for name in self._ARRAYS:
+            np.save(folder/f'{name}.npy', getattr(self, name))
+        meta = dict(cell_size=self.cell_size, origin=self.origin.tolist(), shape=self.shape.tolist())
+        with (folder/'heightfield.json').open('w') as f:
+            json.dump(meta, f)
+        self.raycaster.save(folder/'raycaster')
+
+    @classmethod
+    def load(cls, folder, bvh=None):
+
+        '''
+        Memory-maps a heightfield written by save(). Without a `bvh`, fallback queries
+        go to the exported raycaster instead
+        '''
+
+        folder = Path(folder)
+        self = cls.__new__(cls)
+        self.raycaster = raycast.MeshRaycaster.load(folder/'raycaster')
+        self.bvh = bvh if bvh is not None else raycast.RaycasterBVH(self.raycaster)
+        with (folder/'heightfield.json').open('r') as f:
+            meta = json.load(f)
+        self.cell_size = meta['cell_size']
+        self.origin = np.array(meta['origin'])
+        self.shape = np.array(meta['shape'], dtype=np.int64)
+        for name in cls._ARRAYS:
+            setattr(self, name, np.load(folder/f'{name}.npy', mmap_mode='r'))
+        return self
+
+    def _rasterize_top(self, raycaster, zmax, chunk=2**18):
+
+        # top surface height at every grid node, by batched straight-down raycasts
+        nx, ny = self.shape
+        xs = self.origin[0] + np.arange(nx + 1) * self.cell_size
+        ys = self.origin[1] + np.arange(ny + 1) * self.cell_size
+        gx, gy = np.meshgrid(xs, ys, indexing='ij')
+        origins = np.stack([gx.ravel(), gy.ravel(), np.full(gx.size, zmax + 1)], axis=-1)
+
+        dist = np.empty(len(origins))
+        for i in range(0, len(origins), chunk):
+            o = origins[i:i+chunk]
+            dist[i:i+chunk], _ = raycaster.ray_cast(o, np.broadcast_to(DOWN, o.shape))
+        self.heights = (zmax + 1 - dist).reshape(gx.shape) # -inf where missed
+
+    def _bin_triangles(self, tri, overhang_min_normal_z):
+
+        # per cell z range, and whether any triangle faces against the dominant orientation, ie is a ceiling
+        nx, ny = self.shape
+        cmin = self._cells(tri[..., :2].min(axis=1))
+        cmax = self._cells(tri[..., :2].max(axis=1))
+        span = cmax - cmin + 1
+        counts = span[:, 0] * span[:, 1]
+        tri_idx = np.repeat(np.arange(len(tri)), counts)
+        offs = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        ci = cmin[tri_idx, 0] + offs // span[tri_idx, 1]
+        cj = cmin[tri_idx, 1] + offs % span[tri_idx, 1]
+        cell = ci * ny + cj
+
+        self.zmin = np.full(nx * ny, np.inf)
+        self.zmax = np.full(nx * ny, -np.inf)
+        np.minimum.at(self.zmin, cell, tri[tri_idx, :, 2].min(axis=-1))
+        np.maximum.at(self.zmax, cell, tri[tri_idx, :, 2].max(axis=-1))
+        self.zmin, self.zmax = self.zmin.reshape(nx, ny), self.zmax.reshape(nx, ny)
+
+        normal = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+        up = np.sign(normal[:, 2].sum()) or 1.0
+        nz = up * normal[:, 2] / np.maximum(np.linalg.norm(normal, axis=-1), 1e-12)
+        ceiling = nz < -overhang_min_normal_z
+        self.overhang = np.zeros(nx * ny, dtype=bool)
+        self.overhang[cell[ceiling[tri_idx]]] = True
+        self.overhang = self.overhang.reshape(nx, ny)
+
+        h = self.heights
+        missing = ~np.isfinite(np.stack([h[:-1, :-1], h[1:, :-1], h[:-1, 1:], h[1:, 1:]])).all(axis=0)
+        self.fallback = self.overhang | missing
+
+    def _cells(self, xy):
+        ij = np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(ij, 0, self.shape - 1)
+
+    def _lookup(self, xy):
+        f = (xy - self.origin) / self.cell_size
+        inside = np.all((f >= 0) & (f <= self.shape), axis=-1)
+        ij = np.clip(np.floor(f).astype(np.int64), 0, self.shape - 1)
+        t = f - ij
+        i, j = ij[:, 0], ij[:, 1]
+        h = self.heights
+        corners = h[i, j], h[i + 1, j], h[i, j + 1], h[i + 1, j + 1]
+        return i, j, t, corners, inside
+
+    def height(self, xy):
+
+        '''
+        (N,) top surface height at (N, 2) xy locations by bilinear interpolation, nan outside the grid
+        '''
+
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        i, j, t, (h00, h10, h01, h11), inside = self._lookup(xy)
+        tx, ty = t[:, 0], t[:, 1]
+        with np.errstate(invalid='ignore'):
+            z = (h00 * (1 - tx) + h10 * tx) * (1 - ty) + (h01 * (1 - tx) + h11 * tx) * ty
+        return np.where(inside & np.isfinite(z), z, np.nan)
+
+    def gradient(self, xy):
+
+        '''
+        (N, 2) dz/dx, dz/dy of the interpolated top surface, nan outside the grid
+        '''
+
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        i, j, t, (h00, h10, h01, h11), inside = self._lookup(xy)
+        tx, ty = t[:, 0], t[:, 1]
+        with np.errstate(invalid='ignore'):
+            dx = ((h10 - h00) * (1 - ty) + (h11 - h01) * ty) / self.cell_size
+            dy = ((h01 - h00) * (1 - tx) + (h11 - h10) * tx) / self.cell_size
+        g = np.stack([dx, dy], axis=-1)
+        g[~inside] = np.nan
+        return g
+
+    def slope(self, points):
+
+        '''
+        (N,) terrain slope in radians below (N, 2+) points
+        '''
+
+        points = np.asarray(points, dtype=np.float64)
+        g = self.gradient(points.reshape(len(points), -1)[:, :2])
+        return np.arctan(np.linalg.norm(g, axis=-1))
+
+    def altitude(self, points):
+
+        '''
+        (N,) distance straight down from (N, 3) points to the terrain, nan where nothing is below.
+        Points over overhang / unmapped cells, or not above the highest terrain in their cell,
+        are answered by the BVH so results always match get_altitude on the raw BVH up to
+        the interpolation error of the grid
+        '''
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        z = self.height(points[:, :2])
+        cells = self._cells(points[:, :2])
+        ci, cj = cells[:, 0], cells[:, 1]
+        exact = np.isnan(z) | self.fallback[ci, cj] | (points[:, 2] <= self.zmax[ci, cj])
+
+        alt = points[:, 2] - z
+        for k in np.nonzero(exact)[0]:
+            *_, dist = self.bvh.ray_cast(Vector(points[k]), Vector(DOWN))
+            alt[k] = np.nan if dist is None else dist
+        return alt
+
+    def altitude_one(self, loc):
+
+        '''
+        Scalar version of altitude() for a single point, returns None where nothing is below like BVHTree.ray_cast.
+        Avoids numpy array overhead for the per-step queries made by animation policies
+        '''
+
+        x, y, z = loc[0], loc[1], loc[2]
+        fx = (x - self.origin[0]) / self.cell_size
+        fy = (y - self.origin[1]) / self.cell_size
+        nx, ny = self.shape
+        if 0 <= fx <= nx and 0 <= fy <= ny:
+            i, j = min(int(fx), nx - 1), min(int(fy), ny - 1)
+            if not self.fallback[i, j] and z > self.zmax[i, j]:
+                tx, ty = fx - i, fy - j
+                h = self.heights
+                zh = (h[i, j] * (1 - tx) + h[i + 1, j] * tx) * (1 - ty) + (h[i, j + 1] * (1 - tx) + h[i + 1, j + 1] * tx) * ty
+                return float(z - zh)
+        *_, dist = self.bvh.ray_cast(Vector((x, y, z)), Vector(DOWN))
+        return dist
@@ -0,0 +1,450 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Precomputed remap plans for applying lens distortion to rendered images.
+
+bproc_camera_utility.set_lens_distortion produces a (2, H*W) float64 mapping from every
+distorted output pixel to a real-valued pixel of the oversized undistorted render. Running
+map_coordinates over it per channel converts every pass to float64 and allocates several
+full-size temporaries per channel. A DistortionRemapPlan instead stores the mapping as
+float32 maps, derives integer gather indices and bilinear weights once per source shape, and
+applies them to all channels of an image in one gather, in bounded chunks, keeping the
+input dtype.
+'''
+
+import logging
+
+import gin
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CV2_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+UNSTABLE_HELP = (
+    "Some (corner) pixels of the desired image are not defined by the used lens distortion model. "
+    "The parameters k3,p1,p2 can easily overshoot for regions where the calibration software had no datapoints. "
+    "You can either take more projections (ideally image-filling) at the image corners and repeat calibration, "
+    "reduce the # of released parameters to calibrate to k1,k2, or reduce the target image size "
+    "(subtract some lines and columns from the desired resolution and subtract at most that number of lines "
+    "and columns from the main point location)."
+)
+
+def brown_conrady(x, y, k1, k2, k3, p1, p2):
+
+    '''
+    Undistorted -> distorted normalized image coordinates, in the DLR CalLab convention used by set_lens_distortion
+    '''
+
+    r2 = x * x + y * y
+    radial = 1 + k1 * r2 + k2 * r2 * r2 + k3 * r2 * r2 * r2
+    xd = x * radial + 2 * p2 * x * y + p1 * (r2 + 2 * x * x)
+    yd = y * radial + 2 * p1 * x * y + p2 * (r2 + 2 * y * y)
+    return xd, yd
+
+def brown_conrady_jacobian(x, y, k1, k2, k3, p1, p2):
+
+    '''
+    (dxd/dx, dxd/dy, dyd/dx, dyd/dy) of brown_conrady
+    '''
+
+    r2 = x * x + y * y
+    radial = 1 + k1 * r2 + k2 * r2 * r2 + k3 * r2 * r2 * r2
+    dradial = k1 + 2 * k2 * r2 + 3 * k3 * r2 * r2 # d radial / d r2
+    cross = 2 * x * y * dradial
+    return (
+        radial + 2 * x * x * dradial + 2 * p2 * y + 6 * p1 * x,
+        cross + 2 * p2 * x + 2 * p1 * y,
+        cross + 2 * p1 * y + 2 * p2 * x,
+        radial + 2 * y * y * dradial + 2 * p1 * x + 6 * p2 * y,
+    )
+
+@gin.configurable
+def invert_distortion(xd, yd, distort, fx, fy, jacobian=None, tol=0.15, newton=False, max_iters=1000):
+
+    '''
+    Normalized undistorted (x, y) such that distort(x, y) == (xd, yd) to within `tol` pixels.
+
+    Starts at x = xd and iterates x -= distort(x) - xd, or Newton steps with `jacobian` if `newton`.
+    Pixels leave the active set as soon as they converge, so the cheap central pixels stop costing
+    anything after a few iterations while the corners keep iterating.
+
+    Returns x, y and a list of per-iteration residual statistics in pixels
+    '''
+
+    xd, yd = np.asarray(xd, dtype=np.float64), np.asarray(yd, dtype=np.float64)
+    x, y = xd.copy(), yd.copy()
+    newton = newton and jacobian is not None
+
+    active = np.arange(len(x))
+    stats = []
+    while True:
+        xa, ya = x[active], y[active]
+        ex, ey = distort(xa, ya)
+        ex, ey = ex - xd[active], ey - yd[active]
+        err = np.hypot(fx * ex, fy * ey)
+
+        worst = float(err.max())
+        stats.append(dict(iteration=len(stats), active=len(active), max=worst, mean=float(err.mean())))
+        logger.debug(f'Distortion inversion {stats[-1]}')
+
+        keep = err > tol
+        if not keep.any():
+            break
+        if not np.isfinite(worst) or worst > 1e9:
+            raise Exception(f"The iterative distortion algorithm is unstable. {UNSTABLE_HELP}")
+        if len(stats) > max_iters:
+            raise Exception(f"The iterative distortion algorithm is unstable/stalled after {max_iters} iterations, "
+                            f"{keep.sum()} pixels still have residuals up to {worst:.3g}px")
+        if len(stats) > 1 and worst > stats[-2]['max'] * .99999:
+            logger.warning(f'The residual for the worst distorted pixel got unstable/stalled at {worst:.3g}px')
+
+        active, xa, ya, ex, ey = active[keep], xa[keep], ya[keep], ex[keep], ey[keep]
+        if newton:
+            a, b, c, d = jacobian(xa, ya)
+            det = a * d - b * c
+            ok = np.abs(det) > 1e-9
+            det = np.where(ok, det, 1)
+            # fall back to a fixed point step where the lens model folds over
+            dx = np.where(ok, (d * ex - b * ey) / det, ex)
+            dy = np.where(ok, (a * ey - c * ex) / det, ey)
+        else:
+            dx, dy = ex, ey
+        x[active] = xa - dx
+        y[active] = ya - dy
+
+    logger.info(
+        f'Inverted lens distortion for {len(x)} pixels in {len(stats)} iterations, '
+        f'{sum(s["active"] for s in stats) / len(x):.2f} evaluations per pixel'
+    )
+    return x, y, stats
+
+def invert_radial(target, f, df, scale, tol=1e-3, max_iters=50):
+
+    '''
+    Per element r >= 0 with f(r) == target, by Newton iterations starting at r = target, for monotone radial
+    lens functions. `scale` converts residuals to pixels for the `tol` stopping criterion
+    '''
+
+    target = np.asarray(target, dtype=np.float64)
+    r = target.copy()
+    active = np.arange(len(r))
+    for _ in range(max_iters):
+        ra = r[active]
+        residual = f(ra) - target[active]
+        keep = np.abs(residual) * scale > tol
+        if not keep.any():
+            return r
+        active, ra, residual = active[keep], ra[keep], residual[keep]
+        slope = df(ra)
+        if not np.all(slope > 0):
+            raise Exception("The lens model is not monotonic over the image, it can not be inverted. "
+                            "Double-check the distortion parameters.")
+        r[active] = np.maximum(ra - residual / slope, 0)
+    raise Exception(f"Inverting the radial lens model did not converge after {max_iters} iterations")
+
+class LensModel:
+
+    '''
+    A lens distortion model acting on normalized image coordinates (pinhole projection at z == 1).
+    distort maps undistorted to distorted coordinates, undistort the reverse, fx / fy convert residuals to pixels
+    '''
+
+    name = None
+
+    def params(self):
+        raise NotImplementedError
+
+    def distort(self, x, y):
+        raise NotImplementedError
+
+    def undistort(self, xd, yd, fx, fy):
+        raise NotImplementedError
+
+    def to_dict(self):
+        return dict(model=self.name, params=[float(p) for p in self.params()])
+
+@gin.configurable
+class BrownConrady(LensModel):
+
+    '''
+    Undistorted-to-distorted Brown-Conrady polynomial, see bproc_camera_utility.set_lens_distortion
+    '''
+
+    name = 'brown_conrady'
+
+    def __init__(self, k1=0., k2=0., k3=0., p1=0., p2=0.):
+        if all(v == 0.0 for v in [k1, k2, k3, p1, p2]):
+            raise Exception("All given lens distortion parameters (k1, k2, k3, p1, p2) are zero.")
+        self.k1, self.k2, self.k3, self.p1, self.p2 = k1, k2, k3, p1, p2
+
+    def params(self):
+        return [self.k1, self.k2, self.k3, self.p1, self.p2]
+
+    def distort(self, x, y):
+        return brown_conrady(x, y, *self.params())
+
+    def undistort(self, xd, yd, fx, fy):
+        # Only pixels that have not converged yet are iterated, see invert_distortion
+        x, y, _ = invert_distortion(
+            xd, yd, self.distort, fx, fy,
+            jacobian=lambda x, y: brown_conrady_jacobian(x, y, *self.params()))
+        return x, y
+
+@gin.configurable
+class KannalaBrandt(LensModel):
+
+    '''
+    Kannala-Brandt fisheye model, distorted radius theta_d = theta (1 + k1 theta^2 + k2 theta^4 + k3 theta^6 + k4 theta^8)
+    for incidence angle theta. All zero coefficients give the equidistant projection.
+    The rendered pinhole image can only cover theta < max_theta, wider lenses need a smaller output image
+    '''
+
+    name = 'kannala_brandt'
+
+    def __init__(self, k1=0., k2=0., k3=0., k4=0., max_theta=np.deg2rad(85)):
+        self.k1, self.k2, self.k3, self.k4 = k1, k2, k3, k4
+        self.max_theta = max_theta
+
+    def params(self):
+        return [self.k1, self.k2, self.k3, self.k4]
+
+    def theta_d(self, theta):
+        t2 = theta * theta
+        return theta * (1 + t2 * (self.k1 + t2 * (self.k2 + t2 * (self.k3 + t2 * self.k4))))
+
+    def dtheta_d(self, theta):
+        t2 = theta * theta
+        return 1 + t2 * (3 * self.k1 + t2 * (5 * self.k2 + t2 * (7 * self.k3 + t2 * 9 * self.k4)))
+
+    def distort(self, x, y):
+        r = np.hypot(x, y)
+        scale = np.where(r > 0, self.theta_d(np.arctan(r)) / np.where(r > 0, r, 1), 1)
+        return x * scale, y * scale
+
+    def undistort(self, xd, yd, fx, fy):
+        rd = np.hypot(xd, yd)
+        theta = invert_radial(rd, self.theta_d, self.dtheta_d, max(fx, fy))
+        if theta.max(initial=0) >= self.max_theta:
+            raise Exception(
+                f"The lens sees up to {np.rad2deg(theta.max()):.1f} degrees off axis, more than the "
+                f"{np.rad2deg(self.max_theta):.1f} degrees a pinhole render can cover. Reduce the output resolution "
+                f"or increase max_theta (the render resolution grows with tan(max_theta)).")
+        scale = np.where(rd > 0, np.tan(theta) / np.where(rd > 0, rd, 1), 1)
+        return xd * scale, yd * scale
+
+@gin.configurable
+class DivisionModel(LensModel):
+
+    '''
+    Division model, undistorted = distorted / (1 + l1 r_d^2 + l2 r_d^4) for distorted radius r_d.
+    Undistorting is closed-form, which keeps strong barrel distortion (l1 < 0) stable
+    '''
+
+    name = 'division'
+
+    def __init__(self, l1=0., l2=0.):
+        self.l1, self.l2 = l1, l2
+
+    def params(self):
+        return [self.l1, self.l2]
+
+    def denominator(self, rd):
+        r2 = rd * rd
+        return 1 + self.l1 * r2 + self.l2 * r2 * r2
+
+    def distort(self, x, y):
+        r = np.hypot(x, y)
+        rd = invert_radial(
+            r, lambda rd: rd / self.denominator(rd),
+            lambda rd: (1 - self.l1 * rd * rd - 3 * self.l2 * rd ** 4) / self.denominator(rd) ** 2,
+            scale=1e4) # no focal length here, converge to ~1e-7 in normalized coordinates
+        scale = np.where(r > 0, rd / np.where(r > 0, r, 1), 1)
+        return x * scale, y * scale
+
+    def undistort(self, xd, yd, fx, fy):
+        denominator = self.denominator(np.hypot(xd, yd))
+        if not np.all(denominator > 0):
+            raise Exception("The division model maps part of the image to infinity, "
+                            "double-check l1, l2 or reduce the output resolution.")
+        return xd / denominator, yd / denominator
+
+LENS_MODELS = {m.name: m for m in (BrownConrady, KannalaBrandt, DivisionModel)}
+
+def lens_from_dict(d):
+    return LENS_MODELS[d['model']](*d['params'])
+
+def cast_like(values, dtype):
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        return values >= 0.5
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(values), info.min, info.max).astype(dtype)
+    return values.astype(dtype, copy=False)
+
+@gin.configurable
+class DistortionRemapPlan:
+
+    '''
+    Gather from the undistorted render to the distorted output image.
+
+    map_y, map_x: (H, W) source row / column of every output pixel, upper-left pixel center at [0, 0]
+    backend: 'numpy', or 'cv2' to interpolate with cv2.remap on int16 fixed-point maps where
+        it supports the image (<= 4 channels, 8/16 bit or float). Nearest sampling always uses numpy
+    chunk_pixels: output pixels gathered at once, bounds the size of temporaries
+    label_rule: how apply_labels picks a source label, 'nearest' pixel or 'majority' of the 4 bilinear
+        neighbours, ties going to the label with the larger bilinear weight
+    '''
+
+    def __init__(self, map_y, map_x, backend='numpy', chunk_pixels=2**20, label_rule='nearest'):
+        if backend not in ('numpy', 'cv2'):
+            raise ValueError(f'Unrecognized {backend=}')
+        if label_rule not in ('nearest', 'majority'):
+            raise ValueError(f'Unrecognized {label_rule=}')
+        self.map_y = np.ascontiguousarray(map_y, dtype=np.float32)
+        self.map_x = np.ascontiguousarray(map_x, dtype=np.float32)
+        self.shape = self.map_y.shape
+        self.backend = backend
+        self.chunk_pixels = chunk_pixels
+        self.label_rule = label_rule
+        self._tables = {}
+        self._cv2_maps = None
+
+    @classmethod
+    def from_mapping_coords(cls, mapping_coords, orig_res_y, orig_res_x, **kwargs):
+        mapping_coords = np.asarray(mapping_coords)
+        shape = (int(orig_res_y), int(orig_res_x))
+        return cls(mapping_coords[0].reshape(shape), mapping_coords[1].reshape(shape), **kwargs)
+
+    def gather_tables(self, src_shape, interpolate):
+
+        '''
+        Flat source indices of the upper-left neighbour plus (fy, fx) bilinear weights, or flat
+        indices of the nearest source pixel. Out of bounds coordinates are clamped to the border
+        '''
+
+        key = (tuple(src_shape), interpolate)
+        if key in self._tables:
+            return self._tables[key]
+
+        Hs, Ws = src_shape
+        y, x = self.map_y.ravel(), self.map_x.ravel()
+        if interpolate:
+            r0 = np.clip(np.floor(y), 0, max(Hs - 2, 0)).astype(np.int32)
+            c0 = np.clip(np.floor(x), 0, max(Ws - 2, 0)).astype(np.int32)
+            fy = np.clip(y - r0, 0, 1).astype(np.float32)
+            fx = np.clip(x - c0, 0, 1).astype(np.float32)
+            tables = (r0 * np.int32(Ws) + c0, fy, fx)
+        else:
+            r = np.clip(np.rint(y), 0, Hs - 1).astype(np.int32)
+            c = np.clip(np.rint(x), 0, Ws - 1).astype(np.int32)
+            tables = (r * np.int32(Ws) + c,)
+
+        self._tables[key] = tables
+        return tables
+
+    def _use_cv2(self, image, interpolate):
+        if self.backend != 'cv2' or not interpolate:
+            return False
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        return channels <= 4 and image.dtype.type in CV2_DTYPES
+
+    def _apply_cv2(self, image):
+        import cv2
+        if self._cv2_maps is None:
+            self._cv2_maps = cv2.convertMaps(self.map_x, self.map_y, cv2.CV_16SC2)
+        res = cv2.remap(image, *self._cv2_maps, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        return res.reshape(self.shape + image.shape[2:])
+
+    def apply(self, image, interpolate=True):
+
+        '''
+        (Hs, Ws) or (Hs, Ws, C) undistorted image -> (H, W) or (H, W, C) distorted image of the same dtype
+        '''
+
+        image = np.asarray(image)
+        if self._use_cv2(image, interpolate):
+            return self._apply_cv2(image)
+
+        Hs, Ws = image.shape[:2]
+        src = image.reshape(Hs * Ws, -1)
+        n = self.shape[0] * self.shape[1]
+        out = np.empty((n, src.shape[1]), dtype=image.dtype)
+        tables = self.gather_tables((Hs, Ws), interpolate)
+        compute_dtype = np.float64 if image.dtype == np.float64 else np.float32
+
+        for start in range(0, n, self.chunk_pixels):
+            s = slice(start, start + self.chunk_pixels)
+            if not interpolate:
+                out[s] = src[tables[0][s]]
+                continue
+            idx, fy, fx = (t[s] for t in tables)
+            fy, fx = fy[:, None], fx[:, None]
+            a, b = src[idx].astype(compute_dtype), src[idx + 1].astype(compute_dtype)
+            top = a + (b - a) * fx
+            c, d = src[idx + Ws].astype(compute_dtype), src[idx + Ws + 1].astype(compute_dtype)
+            bottom = c + (d - c) * fx
+            out[s] = cast_like(top + (bottom - top) * fy, image.dtype)
+
+        return out.reshape(self.shape + image.shape[2:])
+
+    def apply_labels(self, labels, rule=None):
+
+        '''
+        Distorts a label image, eg IndexOB object ids or packed (object, instance) keys, keeping its dtype.
+        Every output pixel is a copy of one source pixel, all channels together, so the result only contains
+        labels present in the input and needs no denoising. rule overrides label_rule
+        '''
+
+        rule = rule or self.label_rule
+        labels = np.asarray(labels)
+        if rule == 'nearest':
+            return self.apply(labels, interpolate=False)
+
+        Hs, Ws = labels.shape[:2]
+        src = labels.reshape(Hs * Ws, -1)
+        n = self.shape[0] * self.shape[1]
+        out = np.empty((n, src.shape[1]), dtype=labels.dtype)
+        idx, fy, fx = self.gather_tables((Hs, Ws), interpolate=True)
+
+        for start in range(0, n, self.chunk_pixels):
+            s = slice(start, start + self.chunk_pixels)
+            cy, cx = fy[s], fx[s]
+            corners = np.stack([idx[s], idx[s] + 1, idx[s] + Ws, idx[s] + Ws + 1], axis=1)
+            weights = np.stack([(1 - cy) * (1 - cx), (1 - cy) * cx, cy * (1 - cx), cy * cx], axis=1)
+            vals = src[corners] # (n, 4, C)
+            same = (vals[:, :, None] == vals[:, None, :]).all(axis=-1) # (n, 4, 4)
+            # corners sharing a label get its vote count, plus its total weight (< 1) to break ties
+            score = same.sum(axis=2) + (same * weights[:, None, :]).sum(axis=2)
+            best = np.argmax(score, axis=1)
+            out[s] = src[corners[np.arange(len(best)), best]]
+
+        return out.reshape(self.shape + labels.shape[2:])
+
+    def apply_many(self, images, interpolate=True):
+
+        '''
+        Distorts a dict of images rendered at the same resolution, eg all passes of a frame. Images of
+        the same dtype are stacked along channels and share one gather, returns a dict of the results
+        '''
+
+        groups = {}
+        for name, image in images.items():
+            groups.setdefault(np.asarray(image).dtype, []).append(name)
+
+        res = {}
+        for names in groups.values():
+            if len(names) == 1:
+                res[names[0]] = self.apply(images[names[0]], interpolate=interpolate)
+                continue
+            arrays = [np.asarray(images[n]) for n in names]
+            channels = [1 if a.ndim == 2 else a.shape[2] for a in arrays]
+            stacked = np.concatenate([a.reshape(a.shape[:2] + (-1,)) for a in arrays], axis=2)
+            out = self.apply(stacked, interpolate=interpolate)
+            for n, a, part in zip(names, arrays, np.split(out, np.cumsum(channels)[:-1], axis=2)):
+                res[n] = part.reshape(self.shape + a.shape[2:])
+        return res
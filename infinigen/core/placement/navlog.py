@@ -0,0 +1,96 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Streaming reader for AUV navigation logs (CSV or Parquet).
+
+Only the rows inside the requested time window, plus one row either side of it for
+interpolation, are ever held in memory, so arbitrarily long dive logs can be replayed.
+'''
+
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6378137.0
+
+def iter_chunks(path, columns, chunksize):
+
+    '''
+    Yields dicts of column name -> numpy array, `chunksize` rows at a time
+    '''
+
+    path = Path(path)
+    if path.suffix in ['.parquet', '.pq']:
+        import pyarrow.parquet as pq # optional, only needed for parquet logs
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield {c: batch.column(c).to_numpy(zero_copy_only=False) for c in columns}
+    else:
+        for df in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield {c: df[c].to_numpy() for c in columns}
+
+def to_seconds(t):
+    if np.issubdtype(t.dtype, np.number):
+        return t.astype(np.float64)
+    return pd.to_datetime(t).to_numpy().astype('datetime64[ns]').astype(np.int64) / 1e9
+
+def read_window(path, columns, start_time=None, duration=None, chunksize=100_000):
+
+    '''
+    Reads the rows of a nav log with time in [start_time, start_time + duration], plus the
+    neighbouring row on each side. columns: names to read, the first must be the time column.
+    start_time defaults to the first timestamp in the log, duration to the rest of the log.
+    Returns a dict of column -> numpy array, with time converted to float seconds
+    '''
+
+    time_col = columns[0]
+    kept = []
+    before = None
+    end_time = None
+
+    for chunk in iter_chunks(path, columns, chunksize):
+        t = to_seconds(chunk[time_col])
+        chunk[time_col] = t
+        if start_time is None:
+            start_time = t[0]
+        if end_time is None:
+            end_time = np.inf if duration is None else start_time + duration
+
+        pre = np.nonzero(t < start_time)[0]
+        if len(pre):
+            before = {c: v[pre[-1]:pre[-1]+1] for c, v in chunk.items()}
+
+        inside = (t >= start_time) & (t <= end_time)
+        if inside.any():
+            kept.append({c: v[inside] for c, v in chunk.items()})
+
+        post = np.nonzero(t > end_time)[0]
+        if len(post):
+            kept.append({c: v[post[0]:post[0]+1] for c, v in chunk.items()})
+            break
+
+    if before is not None:
+        kept.insert(0, before)
+    if not kept:
+        raise ValueError(f'Nav log {path} has no rows after {start_time=}')
+
+    window = {c: np.concatenate([k[c] for k in kept]) for c in columns}
+    logger.info(f'Read {len(window[time_col])} nav rows from {path} for {start_time=} {duration=}')
+    return window
+
+def latlon_to_local(lat, lon, lat0, lon0):
+
+    '''
+    Equirectangular projection of degrees lat/lon to east/north metres about (lat0, lon0).
+    Accurate to well under a metre over the few km of a single survey
+    '''
+
+    x = np.deg2rad(lon - lon0) * np.cos(np.deg2rad(lat0)) * EARTH_RADIUS
+    y = np.deg2rad(lat - lat0) * EARTH_RADIUS
+    return x, y
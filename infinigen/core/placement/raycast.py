@@ -0,0 +1,330 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Batched (array-in, array-out) ray casting against a static triangle mesh.
+
+mathutils BVHTree.ray_cast answers one ray per python call, which dominates camera pose
+validation once we need thousands of rays per proposal. MeshRaycaster bins the mesh
+triangles into a uniform grid once per scene, then traverses every ray of a batch through
+that grid in lock-step (3D-DDA), so that a batch of N rays costs a handful of numpy calls
+per grid step instead of N python calls.
+'''
+
+import logging
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def mesh_arrays_from_object(obj, depsgraph=None):
+
+    '''
+    World-space float32 (V, 3) vertices, int32 (F, 3) triangles and the index of the
+    polygon each triangle came from, for the evaluated version of `obj`
+    '''
+
+    import bpy
+
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    mesh.calc_loop_triangles()
+
+    verts = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', verts)
+    tris = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('vertices', tris)
+    polys = np.empty(len(mesh.loop_triangles), dtype=np.int32)
+    mesh.loop_triangles.foreach_get('polygon_index', polys)
+    obj_eval.to_mesh_clear()
+
+    M = np.asarray(obj.matrix_world, dtype=np.float64)
+    verts = verts.reshape(-1, 3) @ M[:3, :3].T + M[:3, 3]
+
+    return verts.astype(np.float32), tris.reshape(-1, 3), polys
+
+def match_faces_to_bvh(vertices, faces, bvh, polys=None, n_check=256, tol=1e-3):
+
+    '''
+    For each triangle, the index of the `bvh` face it lies on, or -1 if it is not part of
+    the bvh. Needed when the bvh was built from a different face ordering than `faces`,
+    eg the attribute arrays returned by Terrain.build_terrain_bvh_and_attrs
+
+    polys: polygon index of each triangle, from mesh_arrays_from_object. When a strided sample of
+        `n_check` triangles lies on the bvh faces with those indices, as it does whenever the bvh was
+        built from the same mesh, polys is returned rather than querying the bvh once per face
+    '''
+
+    centroids = vertices[faces].mean(axis=1)
+
+    def nearest_faces(idxs):
+        face_ids = np.full(len(idxs), -1, dtype=np.int64)
+        for j, i in enumerate(idxs):
+            _, _, index, dist = bvh.find_nearest(centroids[i].tolist())
+            if index is not None and dist < tol:
+                face_ids[j] = index
+        return face_ids
+
+    if polys is not None and len(faces):
+        polys = np.asarray(polys, dtype=np.int64)
+        sample = np.unique(np.linspace(0, len(faces) - 1, min(n_check, len(faces))).astype(np.int64))
+        if np.array_equal(nearest_faces(sample), polys[sample]):
+            return polys
+        logger.warning(f'Mesh faces are not in bvh order, matching all {len(faces)} faces one at a time')
+
+    return nearest_faces(np.arange(len(faces)))
+
+class MeshRaycaster:
+
+    '''
+    Uniform-grid acceleration structure over a triangle mesh.
+
+    ray_cast() takes (N, 3) origins & directions and returns (N,) hit distances (inf on miss)
+    and (N,) face indices (-1 on miss). If `face_ids` is given, returned indices are
+    translated through it, so that callers can keep indexing per-face attribute arrays
+    which were computed for some other face ordering.
+    '''
+
+    _ARRAYS = ('vertices', 'faces', 'lo', 'hi', 'dims', 'cell_size', '_v0', '_e1', '_e2', '_cell_tris', '_cell_start')
+
+    def __init__(self, vertices, faces, face_ids=None, tris_per_cell=4, max_cells_per_axis=512):
+
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+        self.faces = np.ascontiguousarray(faces, dtype=np.int32)
+        self.face_ids = None if face_ids is None else np.asarray(face_ids)
+
+        tri = self.vertices[self.faces].astype(np.float64)
+        self._v0 = tri[:, 0]
+        self._e1 = tri[:, 1] - tri[:, 0]
+        self._e2 = tri[:, 2] - tri[:, 0]
+
+        lo, hi = tri.min(axis=(0, 1)), tri.max(axis=(0, 1))
+        extent = np.maximum(hi - lo, 1e-6)
+        pad = 1e-4 * extent.max()
+        self.lo, self.hi = lo - pad, hi + pad
+        extent = self.hi - self.lo
+
+        # pick a roughly cubic cell size giving ~tris_per_cell triangles per occupied cell.
+        # terrain is mostly a 2D sheet, so size cells by surface area rather than volume
+        n_cells_target = max(len(self.faces) / tris_per_cell, 1)
+        flat_axes = extent < extent.max() * 1e-3
+        area = np.prod(np.where(flat_axes, 1, extent)[np.argsort(extent)[1:]])
+        cell_size = np.sqrt(area / n_cells_target)
+        self.dims = np.clip(np.ceil(extent / cell_size), 1, max_cells_per_axis).astype(np.int64)
+        self.cell_size = extent / self.dims
+
+        self._build_cells(tri)
+
+        logger.debug(f'Built MeshRaycaster with {len(self.faces)=} {self.dims=}')
+
+    @classmethod
+    def from_object(cls, obj, **kwargs):
+        vertices, faces, polys = mesh_arrays_from_object(obj)
+        return cls(vertices, faces, face_ids=polys, **kwargs)
+
+    def save(self, folder):
+
+        '''
+        Writes every array of the built index to `folder` as .npy, so other processes can load() it without rebuilding
+        '''
+
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        for name in self._ARRAYS:
+            np.save(folder/f'{name}.npy', getattr(self, name))
+        if self.face_ids is not None:
+            np.save(folder/'face_ids.npy', self.face_ids)
+
+    @classmethod
+    def load(cls, folder):
+
+        '''
+        Memory-maps an index written by save(). The arrays are read-only, so many worker processes
+        can share the same pages
+        '''
+
+        folder = Path(folder)
+        self = cls.__new__(cls)
+        for name in cls._ARRAYS:
+            setattr(self, name, np.load(folder/f'{name}.npy', mmap_mode='r'))
+        face_ids = folder/'face_ids.npy'
+        self.face_ids = np.load(face_ids, mmap_mode='r') if face_ids.exists() else None
+        return self
+
+    def _cell_coords(self, points):
+        return np.floor((points - self.lo) / self.cell_size).astype(np.int64)
+
+    def _flat_cell(self, ijk):
+        return (ijk[..., 0] * self.dims[1] + ijk[..., 1]) * self.dims[2] + ijk[..., 2]
+
+    def _build_cells(self, tri):
+
+        # conservatively bin each triangle into every cell its bounding box touches, stored CSR-style
+        cmin = np.clip(self._cell_coords(tri.min(axis=1)), 0, self.dims - 1)
+        cmax = np.clip(self._cell_coords(tri.max(axis=1)), 0, self.dims - 1)
+        span = cmax - cmin + 1
+        counts = np.prod(span, axis=-1)
+
+        tri_idx = np.repeat(np.arange(len(tri)), counts)
+        offs = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        span_r = span[tri_idx]
+        ijk = np.stack([
+            offs // (span_r[:, 1] * span_r[:, 2]),
+            (offs // span_r[:, 2]) % span_r[:, 1],
+            offs % span_r[:, 2],
+        ], axis=-1) + cmin[tri_idx]
+        cell = self._flat_cell(ijk)
+
+        order = np.argsort(cell, kind='stable')
+        self._cell_tris = tri_idx[order].astype(np.int32)
+        n_cells = int(np.prod(self.dims))
+        self._cell_start = np.zeros(n_cells + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=n_cells), out=self._cell_start[1:])
+
+    def _intersect(self, ray_idx, tri_idx, origins, directions):
+
+        # Moller-Trumbore for arbitrary (ray, triangle) pairs, double sided like BVHTree
+        d = directions[ray_idx]
+        e1, e2 = self._e1[tri_idx], self._e2[tri_idx]
+        p = np.cross(d, e2)
+        det = np.einsum('ij,ij->i', e1, p)
+        ok = np.abs(det) > 1e-12
+        inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=ok)
+        s = origins[ray_idx] - self._v0[tri_idx]
+        u = np.einsum('ij,ij->i', s, p) * inv_det
+        q = np.cross(s, e1)
+        v = np.einsum('ij,ij->i', d, q) * inv_det
+        t = np.einsum('ij,ij->i', e2, q) * inv_det
+        ok &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0)
+        return np.where(ok, t, np.inf)
+
+    def ray_cast(self, origins, directions, max_dist=np.inf):
+
+        '''
+        origins, directions: (N, 3) arrays, directions need not be normalized.
+        max_dist: scalar or (N,) array, hits further than this are reported as misses
+        returns: (N,) float64 distances (inf where missed), (N,) int64 face indices (-1 where missed)
+        '''
+
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        n = len(origins)
+        directions = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+        max_dist = np.broadcast_to(np.asarray(max_dist, dtype=np.float64), (n,))
+
+        hit_t = np.full(n, np.inf)
+        hit_face = np.full(n, -1, dtype=np.int64)
+
+        # clip each ray against the grid bounds
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_d = 1.0 / directions
+            t0 = (self.lo - origins) * inv_d
+            t1 = (self.hi - origins) * inv_d
+        t0 = np.where(np.isnan(t0), -np.inf, t0)
+        t1 = np.where(np.isnan(t1), np.inf, t1)
+        t_enter = np.maximum(np.minimum(t0, t1).max(axis=-1), 0)
+        t_exit = np.minimum(np.maximum(t0, t1).min(axis=-1), max_dist)
+
+        active = np.nonzero(t_enter <= t_exit)[0]
+        if len(active) == 0:
+            return hit_t, hit_face
+
+        # 3D-DDA state for every active ray
+        o, d = origins[active], directions[active]
+        ijk = np.clip(self._cell_coords(o + d * t_enter[active, None]), 0, self.dims - 1)
+        step = np.where(d >= 0, 1, -1)
+        next_bound = self.lo + (ijk + (step > 0)) * self.cell_size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_max = np.where(d != 0, (next_bound - o) / d, np.inf)
+            t_delta = np.where(d != 0, self.cell_size / np.abs(d), np.inf)
+        t_stop = t_exit[active]
+
+        while len(active):
+
+            cell = self._flat_cell(ijk)
+            start, end = self._cell_start[cell], self._cell_start[cell + 1]
+            counts = end - start
+            t_cell_exit = np.minimum(t_max.min(axis=-1), t_stop)
+
+            if counts.sum() > 0:
+                pair_ray = np.repeat(np.arange(len(active)), counts)
+                pair_tri = self._cell_tris[
+                    np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+                ]
+                t = self._intersect(active[pair_ray], pair_tri, origins, directions)
+
+                # only accept hits inside the current cell, a nearer one may be in the next cell
+                t[t > t_cell_exit[pair_ray]] = np.inf
+                best = np.full(len(active), np.inf)
+                np.minimum.at(best, pair_ray, t)
+                is_best = (t == best[pair_ray]) & np.isfinite(t)
+                best_tri = np.full(len(active), -1, dtype=np.int64)
+                best_tri[pair_ray[is_best]] = pair_tri[is_best]
+
+                found = np.isfinite(best)
+                hit_t[active[found]] = best[found]
+                hit_face[active[found]] = best_tri[found]
+            else:
+                found = np.zeros(len(active), dtype=bool)
+
+            # advance every unfinished ray by one cell along its nearest boundary
+            axis = np.argmin(t_max, axis=-1)
+            rows = np.arange(len(active))
+            ijk[rows, axis] += step[rows, axis]
+            t_max[rows, axis] += t_delta[rows, axis]
+
+            alive = (
+                ~found &
+                (t_cell_exit < t_stop) &
+                np.all((ijk >= 0) & (ijk < self.dims), axis=-1)
+            )
+            active, o, ijk, step, t_max, t_delta, t_stop = (
+                a[alive] for a in (active, o, ijk, step, t_max, t_delta, t_stop)
+            )
+
+        if self.face_ids is not None:
+            hit = hit_face >= 0
+            hit_face[hit] = self.face_ids[hit_face[hit]]
+
+        return hit_t, hit_face
+
+    def segments_clear(self, starts, ends):
+
+        '''
+        For (N, 3) segment endpoints, a boolean (N,) array which is True where nothing is hit
+        between start and end. Vectorized form of the freespace_ray_check in animation_policy
+        '''
+
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+        offsets = ends - starts
+        lengths = np.linalg.norm(offsets, axis=-1)
+        clear = np.ones(len(starts), dtype=bool)
+        nonzero = lengths > 1e-9
+        dist, _ = self.ray_cast(starts[nonzero], offsets[nonzero], max_dist=lengths[nonzero])
+        clear[nonzero] = ~np.isfinite(dist)
+        return clear
+
+class RaycasterBVH:
+
+    '''
+    Single-ray BVHTree.ray_cast interface over a MeshRaycaster, for processes which have the
+    exported raycaster arrays but no mathutils BVHTree of the terrain
+    '''
+
+    def __init__(self, raycaster):
+        self.raycaster = raycaster
+
+    def ray_cast(self, origin, direction, distance=np.inf):
+        from mathutils import Vector
+        origin, direction = np.array(origin, dtype=np.float64), np.array(direction, dtype=np.float64)
+        dist, face = self.raycaster.ray_cast(origin, direction, max_dist=distance)
+        if not np.isfinite(dist[0]):
+            return None, None, None, None
+        location = origin + direction / np.linalg.norm(direction) * dist[0]
+        return Vector(location), None, int(face[0]), float(dist[0])
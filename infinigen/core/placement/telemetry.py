@@ -0,0 +1,181 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Per-rig counters and timings for camera animation.
+
+animate_trajectory can burn through max_full_retries * max_step_tries policy calls before
+succeeding or giving up. AnimationTelemetry records where that effort goes: attempts, a
+histogram of why candidate steps / plans were rejected, rays cast and time spent in
+validate_pose_func, so policies can be tuned against measured cost.
+'''
+
+import csv
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+class RigTelemetry:
+
+    def __init__(self, name):
+        self.name = name
+        self.success = None
+        self.attempts = 0
+        self.accepted = 0
+        self.reasons = defaultdict(int)
+        self.rays = defaultdict(int)
+        self.n_validations = 0
+        self.validation_time = 0.
+        self.time = 0.
+
+    def to_dict(self):
+        return dict(
+            rig=self.name,
+            success=self.success,
+            attempts=self.attempts,
+            accepted=self.accepted,
+            time=self.time,
+            n_validations=self.n_validations,
+            validation_time=self.validation_time,
+            mean_validation_ms=1000 * self.validation_time / max(self.n_validations, 1),
+            rays=sum(self.rays.values()),
+            reasons=dict(self.reasons),
+            rays_by_reason=dict(self.rays),
+        )
+
+    def to_row(self):
+        row = self.to_dict()
+        reasons, rays = row.pop('reasons'), row.pop('rays_by_reason')
+        row.update({f'reason_{k}': v for k, v in sorted(reasons.items())})
+        row.update({f'rays_{k}': v for k, v in sorted(rays.items())})
+        return row
+
+class AnimationTelemetry:
+
+    '''
+    Thread-safe record of animation effort, one RigTelemetry per animated object.
+    Events recorded outside of begin_rig / end_rig are attributed to a rig named None
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.rigs = {}
+            self._current = None
+            self._start = None
+
+    def _rig(self, name=None):
+        name = self._current if name is None else name
+        if name not in self.rigs:
+            self.rigs[name] = RigTelemetry(name)
+        return self.rigs[name]
+
+    def begin_rig(self, name):
+        with self._lock:
+            self._current = name
+            self._rig()
+            self._start = time.perf_counter()
+
+    def end_rig(self, success):
+        with self._lock:
+            rig = self._rig()
+            rig.success = success
+            rig.time += time.perf_counter() - self._start
+            self._current = None
+
+    def attempt(self):
+        with self._lock:
+            self._rig().attempts += 1
+
+    def accept(self, n=1):
+        with self._lock:
+            self._rig().accepted += n
+
+    def reject(self, reason, n=1):
+        with self._lock:
+            self._rig().reasons[reason] += n
+
+    def rays(self, reason, n):
+        with self._lock:
+            self._rig().rays[reason] += n
+
+    def validation(self, duration):
+        with self._lock:
+            rig = self._rig()
+            rig.n_validations += 1
+            rig.validation_time += duration
+
+    def add_pose_stats(self, name, counts, rays):
+        '''Merge per-reason pose check counts and rays into rig `name`, eg the change in camera.pose_rejection_stats over it'''
+        with self._lock:
+            rig = self._rig(name)
+            for k, v in counts.items():
+                if v:
+                    rig.reasons[f'pose_{k}'] += v
+            for k, v in rays.items():
+                if v:
+                    rig.rays[f'pose_{k}'] += v
+
+    def add_attempts(self, name, n, reasons):
+        '''Merge `n` failed attempts made outside this process into rig `name`, with reasons: reason -> count, eg by planner workers'''
+        with self._lock:
+            rig = self._rig(name)
+            rig.attempts += n
+            for k, v in reasons.items():
+                if v:
+                    rig.reasons[k] += v
+
+    def stage_result(self):
+
+        '''
+        Scene-level totals, flat so they can be added to RandomStageExecutor results
+        '''
+
+        with self._lock:
+            rigs = [r.to_row() for r in self.rigs.values()]
+        totals = defaultdict(float)
+        for row in rigs:
+            for k, v in row.items():
+                if k not in ('rig', 'success', 'mean_validation_ms'):
+                    totals[k] += v
+        totals['n_rigs'] = len(rigs)
+        totals['n_failed'] = sum(row['success'] is False for row in rigs)
+        totals['mean_validation_ms'] = 1000 * totals['validation_time'] / max(totals['n_validations'], 1)
+        return {f'anim_{k}': v for k, v in totals.items()}
+
+    def save(self, folder, name='animation_telemetry'):
+
+        '''
+        Writes folder/{name}.json with nested per-rig records, and folder/{name}.csv with one flat row per rig
+        '''
+
+        with self._lock:
+            records = [r.to_dict() for r in self.rigs.values()]
+            rows = [r.to_row() for r in self.rigs.values()]
+        if not records:
+            return
+
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        with (folder/f'{name}.json').open('w') as f:
+            json.dump(records, f, indent=4)
+
+        fields = list(dict.fromkeys(k for row in rows for k in row))
+        with (folder/f'{name}.csv').open('w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, restval=0)
+            writer.writeheader()
+            writer.writerows(rows)
+
+        logger.info(f'Saved animation telemetry for {len(records)} rigs to {folder}')
+
+animation_telemetry = AnimationTelemetry()
@@ -0,0 +1,421 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Whole-trajectory helpers for camera animation: closed-form survey paths, terrain draping,
+bulk validation and single-shot keyframe insertion, as opposed to the step-by-step
+policies in animation_policy.
+'''
+
+import logging
+
+import bpy
+import numpy as np
+from mathutils import Vector
+
+logger = logging.getLogger(__name__)
+
+# values of the bpy Keyframe.interpolation enum, as used by foreach_set
+INTERPOLATION_MODES = {'CONSTANT': 0, 'LINEAR': 1, 'BEZIER': 2}
+
+def insert_keyframes(obj, frames, locs=None, rots=None, interp='BEZIER'):
+
+    '''
+    Appends keyframes at `frames` to obj's location / rotation_euler fcurves in one
+    keyframe_points.add + foreach_set per fcurve, instead of one keyframe_insert per frame.
+    interp: a single interpolation mode, or one per frame
+    '''
+
+    frames = np.asarray(frames, dtype=np.float32)
+    interp = np.broadcast_to(np.asarray(interp, dtype=object), frames.shape)
+    interp = np.array([INTERPOLATION_MODES[m] for m in interp], dtype=np.int32)
+
+    if obj.animation_data is None:
+        obj.animation_data_create()
+    if obj.animation_data.action is None:
+        obj.animation_data.action = bpy.data.actions.new(f'{obj.name}Action')
+    action = obj.animation_data.action
+
+    for data_path, values in (('location', locs), ('rotation_euler', rots)):
+        if values is None:
+            continue
+        values = np.asarray(values, dtype=np.float32).reshape(len(frames), 3)
+        for i in range(3):
+            # nan marks frames where this channel has no keyframe
+            mask = ~np.isnan(values[:, i])
+            if not mask.any():
+                continue
+            fc = action.fcurves.find(data_path, index=i)
+            if fc is None:
+                fc = action.fcurves.new(data_path, index=i, action_group='Object Transforms')
+            kps = fc.keyframe_points
+            n_prev = len(kps)
+            if n_prev > 0:
+                co = np.empty(2 * n_prev, dtype=np.float32)
+                kps.foreach_get('co', co)
+                if co[-2] >= frames[mask][0]:
+                    raise ValueError(f'Unexpected out-of-order keyframing {co[-2]=}, {frames[mask][0]=}')
+            kps.add(int(mask.sum()))
+            co = np.stack([frames[mask], values[mask, i]], axis=-1).ravel()
+            for attr in ('co', 'handle_left', 'handle_right'):
+                kp_co = np.empty(2 * len(kps), dtype=np.float32)
+                kps.foreach_get(attr, kp_co)
+                kp_co[2 * n_prev:] = co
+                kps.foreach_set(attr, kp_co)
+            kp_interp = np.empty(len(kps), dtype=np.int32)
+            kps.foreach_get('interpolation', kp_interp)
+            kp_interp[n_prev:] = interp[mask]
+            kps.foreach_set('interpolation', kp_interp)
+            fc.update()
+
+def auto_clamped_handles(x, y):
+
+    '''
+    Left and right (K, 2) bezier handles of keyframes at (K,) x, y, following Blender's
+    AUTO_CLAMPED fcurve handle rules: handles are flat at extrema and at the first / last key,
+    and never overshoot the neighbouring key values
+    '''
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    K = len(x)
+    if K < 2:
+        p = np.stack([x, y], axis=-1)
+        return p.copy(), p.copy()
+
+    # end keys use a mirrored neighbour, as in BKE_nurb_handle_calc
+    xp = np.concatenate([[2 * x[0] - x[1]], x[:-1]])
+    yp = np.concatenate([[2 * y[0] - y[1]], y[:-1]])
+    xn = np.concatenate([x[1:], [2 * x[-1] - x[-2]]])
+    yn = np.concatenate([y[1:], [2 * y[-1] - y[-2]]])
+
+    len_a = np.where(x - xp == 0, 1.0, x - xp)
+    len_b = np.where(xn - x == 0, 1.0, xn - x)
+    tx = (xn - x) / len_b + (x - xp) / len_a
+    ty = (yn - y) / len_b + (y - yp) / len_a
+    length = tx * 2.5614
+    length = np.where(length == 0, 1.0, length)
+
+    len_a = np.minimum(len_a, 5 * len_b)
+    len_b = np.minimum(len_b, 5 * len_a)
+
+    h1 = np.stack([x - tx * len_a / length, y - ty * len_a / length], axis=-1)
+    h2 = np.stack([x + tx * len_b / length, y + ty * len_b / length], axis=-1)
+
+    interior = np.zeros(K, dtype=bool)
+    interior[1:-1] = True
+    ydiff1, ydiff2 = yp - y, yn - y
+    extremum = interior & (((ydiff1 <= 0) & (ydiff2 <= 0)) | ((ydiff1 >= 0) & (ydiff2 >= 0)))
+    rising = ydiff1 <= 0
+
+    left_violate = extremum | (interior & np.where(rising, yp > h1[:, 1], yp < h1[:, 1]))
+    right_violate = extremum | (interior & np.where(rising, yn < h2[:, 1], yn > h2[:, 1]))
+    h1[:, 1] = np.where(extremum, y, np.where(left_violate, yp, h1[:, 1]))
+    h2[:, 1] = np.where(extremum, y, np.where(right_violate, yn, h2[:, 1]))
+
+    # keep the handles aligned after clamping one of them
+    h1_x, h2_x = h1[:, 0] - x, x - h2[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        realign_right = y + (y - h1[:, 1]) / h1_x * h2_x
+        realign_left = y + (y - h2[:, 1]) / h2_x * h1_x
+    h2[:, 1] = np.where(left_violate & ~extremum, realign_right, h2[:, 1])
+    h1[:, 1] = np.where(right_violate & ~left_violate, realign_left, h1[:, 1])
+
+    # first / last keys are flat with constant extrapolation
+    h1[[0, -1], 1] = y[[0, -1]]
+    h2[[0, -1], 1] = y[[0, -1]]
+
+    return h1, h2
+
+def evaluate_keyframes(x, y, interp, frames, handles=None, n_iters=32):
+
+    '''
+    Values at `frames` of an fcurve with keyframes at (K,) x, y and (K,) interpolation mode
+    names, with constant extrapolation. handles: (K, 2) left and right handles, computed as
+    auto-clamped if not given
+    '''
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    frames = np.asarray(frames, dtype=np.float64)
+    if len(x) == 1:
+        return np.full(frames.shape, y[0])
+
+    h1, h2 = auto_clamped_handles(x, y) if handles is None else handles
+    seg = np.clip(np.searchsorted(x, frames, side='right') - 1, 0, len(x) - 2)
+
+    x0, x3 = x[seg], x[seg + 1]
+    y0, y3 = y[seg], y[seg + 1]
+    x1, y1 = h2[seg, 0], h2[seg, 1]
+    x2, y2 = h1[seg + 1, 0], h1[seg + 1, 1]
+
+    # shrink handles which overlap in x, as BKE_fcurve_correct_bezpart does
+    len1, len2 = np.abs(x1 - x0), np.abs(x3 - x2)
+    total = len1 + len2
+    fac = np.where(total > x3 - x0, (x3 - x0) / np.where(total == 0, 1, total), 1.0)
+    x1, y1 = x0 + fac * (x1 - x0), y0 + fac * (y1 - y0)
+    x2, y2 = x3 + fac * (x2 - x3), y3 + fac * (y2 - y3)
+
+    # x(t) is monotonic once corrected, so bisect for t
+    lo, hi = np.zeros_like(frames), np.ones_like(frames)
+    for _ in range(n_iters):
+        t = (lo + hi) / 2
+        xt = (1-t)**3 * x0 + 3*(1-t)**2*t * x1 + 3*(1-t)*t**2 * x2 + t**3 * x3
+        below = xt < frames
+        lo, hi = np.where(below, t, lo), np.where(below, hi, t)
+    t = (lo + hi) / 2
+    bezier = (1-t)**3 * y0 + 3*(1-t)**2*t * y1 + 3*(1-t)*t**2 * y2 + t**3 * y3
+
+    u = np.clip((frames - x0) / (x3 - x0), 0, 1)
+    mode = np.asarray(interp)[seg]
+    values = np.where(mode == 'CONSTANT', y0, np.where(mode == 'LINEAR', y0 + u * (y3 - y0), bezier))
+    values = np.where(frames <= x[0], y[0], values)
+    values = np.where(frames >= x[-1], y[-1], values)
+    return values
+
+def read_fcurve(fc):
+
+    '''
+    Keyframe x, y, interpolation names and (left, right) handles of a bpy FCurve via foreach_get
+    '''
+
+    kps = fc.keyframe_points
+    n = len(kps)
+    arrays = {}
+    for attr in ('co', 'handle_left', 'handle_right'):
+        arrays[attr] = np.empty(2 * n, dtype=np.float32)
+        kps.foreach_get(attr, arrays[attr])
+        arrays[attr] = arrays[attr].reshape(n, 2).astype(np.float64)
+    interp = np.empty(n, dtype=np.int32)
+    kps.foreach_get('interpolation', interp)
+    names = {v: k for k, v in INTERPOLATION_MODES.items()}
+    # easing modes are not emulated, treat them as bezier
+    interp = np.array([names.get(i, 'BEZIER') for i in interp], dtype=object)
+
+    co = arrays['co']
+    return co[:, 0], co[:, 1], interp, (arrays['handle_left'], arrays['handle_right'])
+
+def has_constraints_or_drivers(obj):
+    return len(obj.constraints) > 0 or (obj.animation_data is not None and len(obj.animation_data.drivers) > 0)
+
+def needs_scene_evaluation(obj):
+
+    '''
+    True if obj's pose at a frame depends on more than its own fcurves, ie obj or one of its parents
+    has constraints or drivers, or one of its parents is animated
+    '''
+
+    o = obj
+    while o is not None:
+        if has_constraints_or_drivers(o):
+            return True
+        if o is not obj and o.animation_data is not None and o.animation_data.action is not None:
+            return True
+        o = o.parent
+    return False
+
+def evaluate_object_fcurves(obj, frames):
+
+    '''
+    (N, 3) location and rotation_euler channels of obj at `frames` from its action's fcurves alone.
+    Channels without an fcurve keep obj's current value
+    '''
+
+    frames = np.asarray(frames, dtype=np.float64)
+    locs = np.tile(np.array(obj.location), (len(frames), 1))
+    rots = np.tile(np.array(obj.rotation_euler), (len(frames), 1))
+
+    action = obj.animation_data.action if obj.animation_data is not None else None
+    if action is None:
+        return locs, rots
+
+    targets = {'location': locs, 'rotation_euler': rots}
+    for fc in action.fcurves:
+        if fc.data_path not in targets or len(fc.keyframe_points) == 0:
+            continue
+        x, y, interp, handles = read_fcurve(fc)
+        targets[fc.data_path][:, fc.array_index] = evaluate_keyframes(x, y, interp, frames, handles=handles)
+
+    return locs, rots
+
+def sample_object_trajectory(obj, frames):
+
+    '''
+    (N, 3) location and rotation_euler of obj at `frames`, read straight from its action's fcurves
+    instead of setting the scene frame. Channels without an fcurve keep obj's current value.
+    Fcurve modifiers and non-constant extrapolation are not supported.
+    Falls back to scene.frame_set for objects where needs_scene_evaluation(obj)
+    '''
+
+    frames = np.asarray(frames, dtype=np.float64)
+    if needs_scene_evaluation(obj):
+        locs, rots = np.zeros((len(frames), 3)), np.zeros((len(frames), 3))
+        for i, frame in enumerate(frames):
+            bpy.context.scene.frame_set(int(frame))
+            locs[i], rots[i] = obj.location, obj.rotation_euler
+        return locs, rots
+
+    return evaluate_object_fcurves(obj, frames)
+
+class TrajectoryBuffer:
+
+    '''
+    Keyframes of an object's location and rotation_euler held in numpy arrays, so policies can
+    append, evaluate, reverse and trim a trajectory without touching the action, then write it
+    with a single flush(). nan entries mean that channel has no keyframe at that time
+    '''
+
+    def __init__(self):
+        self.t = np.zeros(0)
+        self.loc = np.zeros((0, 3))
+        self.rot = np.zeros((0, 3))
+        self.interp = np.zeros(0, dtype=object)
+
+    def __len__(self):
+        return len(self.t)
+
+    def extend(self, t, loc=None, rot=None, interp='BEZIER'):
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        if len(self.t) and t[0] <= self.t[-1] or (np.diff(t) <= 0).any():
+            raise ValueError(f'Unexpected out-of-order keyframing {self.t[-1:]=}, {t=}')
+        nan = np.full((len(t), 3), np.nan)
+        loc = nan if loc is None else np.asarray(loc, dtype=np.float64).reshape(len(t), 3)
+        rot = nan if rot is None else np.asarray(rot, dtype=np.float64).reshape(len(t), 3)
+        self.t = np.concatenate([self.t, t])
+        self.loc = np.concatenate([self.loc, loc])
+        self.rot = np.concatenate([self.rot, rot])
+        self.interp = np.concatenate([self.interp, np.broadcast_to(np.asarray(interp, dtype=object), t.shape)])
+
+    def append(self, t, loc=None, rot=None, interp='BEZIER'):
+        self.extend([t], None if loc is None else [loc], None if rot is None else [rot], [interp])
+
+    def pop(self):
+        self.trim(len(self) - 1)
+
+    def trim(self, n):
+        '''Keep only the first n keyframes'''
+        self.t, self.loc, self.rot, self.interp = self.t[:n], self.loc[:n], self.rot[:n], self.interp[:n]
+
+    def trim_after(self, frame):
+        self.trim(np.searchsorted(self.t, frame, side='right'))
+
+    def reversed(self, frame_start, frame_end, interp='LINEAR'):
+        res = TrajectoryBuffer()
+        res.extend(
+            frame_end + frame_start - self.t[::-1], 
+            self.loc[::-1], self.rot[::-1], 
+            np.full(len(self), interp, dtype=object)
+        )
+        return res
+
+    def evaluate(self, frames):
+
+        '''
+        (N, 3) location and rotation at `frames` as Blender would interpolate them once flushed.
+        Channels without any keyframe are nan
+        '''
+
+        frames = np.asarray(frames, dtype=np.float64)
+        out = []
+        for values in (self.loc, self.rot):
+            res = np.full((len(frames), 3), np.nan)
+            for i in range(3):
+                mask = ~np.isnan(values[:, i])
+                if mask.any():
+                    res[:, i] = evaluate_keyframes(self.t[mask], values[mask, i], self.interp[mask], frames)
+            out.append(res)
+        return out
+
+    def flush(self, obj):
+        '''Write every buffered keyframe into obj's action, after any keyframes it already has'''
+        if len(self):
+            insert_keyframes(obj, self.t, self.loc, self.rot, interp=self.interp)
+
+def lawnmower_path(s, transect_length, line_spacing):
+
+    '''
+    Boustrophedon survey path with semicircular turns, evaluated at arc lengths `s`.
+    Legs alternate along +x / -x and successive legs step along +y, starting at the origin.
+    Returns (N, 2) positions and (N,) unwrapped heading angles from the +x axis
+    '''
+
+    s = np.asarray(s, dtype=np.float64)
+    r = line_spacing / 2
+    period = transect_length + np.pi * r
+    leg = np.floor(s / period).astype(np.int64)
+    rem = s - leg * period
+    direction = np.where(leg % 2 == 0, 1.0, -1.0)
+    x_start = np.where(leg % 2 == 0, 0.0, transect_length)
+
+    phi = np.clip((rem - transect_length) / r, 0, np.pi) # progress around the turn
+    along = np.minimum(rem, transect_length) + r * np.sin(phi)
+    x = x_start + direction * along
+    y = leg * line_spacing + r * (1 - np.cos(phi))
+    heading = np.unwrap(np.arctan2(np.sin(phi), direction * np.cos(phi)))
+
+    return np.stack([x, y], axis=-1), heading
+
+def terrain_xy_bounds(bvh):
+
+    '''
+    (2,) xy min and max of the terrain behind bvh, or None if it has no MeshRaycaster to read them from
+    '''
+
+    raycaster = getattr(bvh, 'raycaster', None)
+    if raycaster is None:
+        return None
+    return raycaster.lo[:2], raycaster.hi[:2]
+
+def terrain_top(bvh):
+
+    '''
+    Height above every point of the terrain behind bvh, or None if it has no MeshRaycaster to read it from
+    '''
+
+    raycaster = getattr(bvh, 'raycaster', None)
+    if raycaster is None:
+        return None
+    return float(raycaster.hi[2]) + 1
+
+def ground_height(bvh, xy, probe_z=None):
+
+    '''
+    (N,) terrain height below (N, 2) xy, probing straight down from `probe_z`. nan where there is no terrain.
+    probe_z defaults to terrain_top(bvh), or far above the terrain for a plain BVHTree, which has no bounds
+    to read. A probe below the local seabed would start inside the terrain and miss it
+    '''
+
+    if probe_z is None:
+        probe_z = terrain_top(bvh)
+    if probe_z is None:
+        probe_z = 1e4
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    points = np.column_stack([xy, np.full(len(xy), probe_z)])
+    if hasattr(bvh, 'altitude'):
+        alt = bvh.altitude(points)
+    else:
+        alt = np.full(len(points), np.nan)
+        for k, p in enumerate(points):
+            *_, dist = bvh.ray_cast(Vector(p), Vector((0., 0., -1.)))
+            if dist is not None:
+                alt[k] = dist
+    return probe_z - alt
+
+def segments_clear(bvh, starts, ends):
+
+    '''
+    (N,) bool, True where the straight segment from starts[i] to ends[i] hits no terrain
+    '''
+
+    raycaster = getattr(bvh, 'raycaster', None)
+    if raycaster is not None:
+        return raycaster.segments_clear(starts, ends)
+
+    clear = np.ones(len(starts), dtype=bool)
+    for k, (a, b) in enumerate(zip(starts, ends)):
+        a, b = Vector(a), Vector(b)
+        if (b - a).length == 0:
+            continue
+        location, *_ = bvh.ray_cast(a, b - a, (b - a).length)
+        clear[k] = location is None
+    return clear
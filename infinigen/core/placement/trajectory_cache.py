@@ -0,0 +1,197 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Cache of the camera rig poses and keyframes produced by pose_cameras and animate_cameras.
+
+Re-running the coarse stage to tweak unrelated things (scatter densities etc) should not redo
+the viewpoint search and trajectory generation. The result is stored as a compact .npz next to
+pipeline_coarse.csv, keyed on the scene seed, a digest of the terrain, the rig layout, the scene's
+frame range and fps and the gin parameters of the camera placement, animation & planning code,
+and replayed when the key matches.
+'''
+
+import hashlib
+import logging
+import re
+from pathlib import Path
+
+import bpy
+import gin
+import numpy as np
+
+from infinigen.core.placement import (camera as cam_util, animation_policy, auv_dynamics,
+                                     heightfield, raycast, trajectory)
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+CACHE_FILENAME = 'camera_trajectories.npz'
+INTERPOLATION_NAMES = {v: k for k, v in trajectory.INTERPOLATION_MODES.items()}
+
+def gin_bindings_repr(configurables):
+    res = []
+    for c in configurables:
+        try:
+            bindings = gin.get_bindings(c)
+        except (ValueError, TypeError):
+            bindings = None # not gin configurable, so nothing can change it
+        res.append((getattr(c, '__name__', repr(c)), sorted(bindings.items()) if bindings else None))
+    return re.sub(r' at 0x[0-9a-f]+', '', repr(res)) # object reprs must not make the key differ between runs
+
+def terrain_digest(scene_preprocessed, terrain_mesh):
+    raycaster = scene_preprocessed.get('terrain_raycaster')
+    if raycaster is not None:
+        vertices, faces = raycaster.vertices, raycaster.faces
+    else:
+        vertices, faces, _ = raycast.mesh_arrays_from_object(terrain_mesh)
+    m = hashlib.md5()
+    m.update(np.ascontiguousarray(vertices, dtype=np.float32).tobytes())
+    m.update(np.ascontiguousarray(faces, dtype=np.int32).tobytes())
+    return m.hexdigest()
+
+def rig_layout(cam_rigs):
+    layout = []
+    for rig in cam_rigs:
+        for child in rig.children:
+            layout.append(np.round(np.array(child.matrix_local), 6).tobytes())
+    return layout
+
+def rig_cameras(rig):
+    return [c for c in rig.children_recursive if c.type == 'CAMERA']
+
+def read_keyframes(obj):
+
+    '''
+    (K,) frames, (K, 3) locations, (K, 3) rotations and (K,) interpolation codes of obj's location / rotation_euler
+    keyframes, nan where a channel has no keyframe at that frame
+    '''
+
+    fcurves = []
+    if obj.animation_data is not None and obj.animation_data.action is not None:
+        fcurves = [
+            fc for fc in obj.animation_data.action.fcurves
+            if fc.data_path in ('location', 'rotation_euler') and len(fc.keyframe_points)
+        ]
+    curves = [(fc.data_path, fc.array_index, *trajectory.read_fcurve(fc)[:3]) for fc in fcurves]
+    frames = np.unique(np.concatenate([c[2] for c in curves])) if curves else np.zeros(0)
+
+    bezier = trajectory.INTERPOLATION_MODES['BEZIER']
+    values = {'location': np.full((len(frames), 3), np.nan), 'rotation_euler': np.full((len(frames), 3), np.nan)}
+    interp = np.full(len(frames), bezier, dtype=np.int8)
+    for data_path, i, x, y, names in curves:
+        idx = np.searchsorted(frames, x)
+        values[data_path][idx, i] = y
+        interp[idx] = [trajectory.INTERPOLATION_MODES.get(n, bezier) for n in names]
+    return frames, values['location'], values['rotation_euler'], interp
+
+@gin.configurable
+class TrajectoryCache:
+
+    '''
+    Stores / replays rig poses and keyframes for one scene. On a hit, apply_poses and apply_keyframes
+    replace configure_cameras and animate_cameras, on a miss call record_poses after posing and save after animating.
+
+    policy: the policy_registry passed to animate_cameras, its gin parameters are part of the key
+    '''
+
+    def __init__(self, path, scene_seed, scene_preprocessed, terrain_mesh, cam_rigs, policy=None, enabled=True):
+
+        self.path = Path(path)
+        self.enabled = enabled
+        self.poses = None
+
+        # everything whose gin parameters change the poses, including the terrain indices the planners query
+        configurables = [
+            cam_util.spawn_camera_rigs, cam_util.camera_pose_proposal, cam_util.keep_cam_pose_proposal,
+            cam_util.compute_base_views, cam_util.configure_cameras, cam_util.set_camera_parameters,
+            cam_util.animate_cameras, cam_util.camera_selection_preprocessing, cam_util.camera_selection_tags_ratio,
+            cam_util.camera_selection_ranges_ratio, cam_util.camera_selection_keep_in_animation,
+            cam_util.get_sensor_rays, cam_util.get_sensor_coords,
+            animation_policy.animate_trajectory, animation_policy.walk_same_altitude,
+            animation_policy.plan_trajectories_parallel, auv_dynamics.AUVDynamics, heightfield.SeabedHeightfield,
+        ]
+        if policy is not None:
+            configurables.append(policy)
+
+        scene = bpy.context.scene
+        m = hashlib.md5()
+        m.update(f'v{CACHE_VERSION} seed={scene_seed} terrain={terrain_digest(scene_preprocessed, terrain_mesh)}'.encode('utf-8'))
+        m.update(f'frames={scene.frame_start}-{scene.frame_end} fps={scene.render.fps}/{scene.render.fps_base}'.encode('utf-8'))
+        for b in rig_layout(cam_rigs):
+            m.update(b)
+        m.update(gin_bindings_repr(configurables).encode('utf-8'))
+        self.key = m.hexdigest()
+
+        self.data = self.load() if enabled else None
+
+    @property
+    def hit(self):
+        return self.data is not None
+
+    def load(self):
+        if not self.path.exists():
+            return None
+        data = dict(np.load(self.path))
+        if str(data['key']) != self.key:
+            logger.info(f'Ignoring {self.path}, its key does not match the current scene / config')
+            return None
+        logger.info(f'Replaying camera trajectories from {self.path}')
+        return data
+
+    def record_poses(self, cam_rigs):
+        focus = []
+        for rig in cam_rigs:
+            cams = rig_cameras(rig)
+            focus.append(cams[0].data.dof.focus_distance if len(cams) else np.nan)
+        self.poses = dict(
+            locations=np.array([rig.location for rig in cam_rigs]),
+            rotations=np.array([rig.rotation_euler for rig in cam_rigs]),
+            focus_distance=np.array(focus),
+        )
+
+    def apply_poses(self, cam_rigs):
+        d = self.data
+        for i, rig in enumerate(cam_rigs):
+            rig.location = d['locations'][i]
+            rig.rotation_euler = d['rotations'][i]
+            if not np.isnan(d['focus_distance'][i]):
+                for c in rig_cameras(rig):
+                    c.data.dof.focus_distance = d['focus_distance'][i]
+
+    def apply_keyframes(self, cam_rigs):
+        d = self.data
+        starts = d['key_start']
+        for i, rig in enumerate(cam_rigs):
+            rig.animation_data_clear()
+            s = slice(starts[i], starts[i + 1])
+            if starts[i + 1] > starts[i]:
+                interp = [INTERPOLATION_NAMES[int(c)] for c in d['key_interp'][s]]
+                trajectory.insert_keyframes(rig, d['key_frames'][s], d['key_locs'][s], d['key_rots'][s], interp=interp)
+            rig.location = d['end_locations'][i]
+            rig.rotation_euler = d['end_rotations'][i]
+
+    def save(self, cam_rigs):
+
+        if not self.enabled:
+            return
+        if self.poses is None:
+            logger.warning(f'Not saving {self.path}, record_poses was not called after posing the cameras')
+            return
+
+        keys = [read_keyframes(rig) for rig in cam_rigs]
+        np.savez_compressed(
+            self.path,
+            key=np.array(self.key),
+            **self.poses,
+            end_locations=np.array([rig.location for rig in cam_rigs]),
+            end_rotations=np.array([rig.rotation_euler for rig in cam_rigs]),
+            key_start=np.concatenate([[0], np.cumsum([len(k[0]) for k in keys])]),
+            key_frames=np.concatenate([k[0] for k in keys]),
+            key_locs=np.concatenate([k[1] for k in keys]).reshape(-1, 3),
+            key_rots=np.concatenate([k[2] for k in keys]).reshape(-1, 3),
+            key_interp=np.concatenate([k[3] for k in keys]),
+        )
+        logger.info(f'Saved camera trajectories to {self.path}')
@@ -0,0 +1,233 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Ground truth postprocessing of the flat shading render passes, which needs no bpy.
+
+render_image runs it on background threads while rendering. With render_image.defer_gt_postprocess
+it instead moves the raw EXR passes to raw_gt_folder(frames_folder) along with a sidecar describing
+them, so a separate CPU-only task can postprocess them:
+
+    python -m infinigen.core.rendering.gt_postprocess --raw_folder <scene>/frames_0_0_0001_0_rawgt
+'''
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from imageio import imwrite
+
+from infinigen.core.placement.lens_distortion import DistortionRemapPlan
+from infinigen.core.rendering.post_render import (colorize_depth, colorize_flow,
+                                   colorize_normals, colorize_int_array,
+                                   load_depth, load_flow, load_normals,
+                                   load_seg_mask)
+from infinigen.tools.datarelease_toolkit import reorganize_old_framesfolder
+
+logger = logging.getLogger(__name__)
+
+RAW_PASSES = ['Vector', 'Normal', 'Depth', 'IndexOB', 'UniqueInstances']
+SIDECAR = 'gt_postprocess.json' # written once every frame of the block is in the raw folder
+
+def postprocess_blendergt_outputs(frames_folder, output_stem, frame, tmp_dir):
+
+    # Save flow visualization
+    flow_dst_path = frames_folder / f"Vector{output_stem}.exr"
+    flow_array = load_flow(flow_dst_path)
+    np.save(flow_dst_path.with_name(f"Flow{output_stem}.npy"), flow_array)
+    imwrite(flow_dst_path.with_name(f"Flow{output_stem}.png"), colorize_flow(flow_array))
+    flow_dst_path.unlink()
+
+    # Save surface normal visualization
+    normal_dst_path = frames_folder / f"Normal{output_stem}.exr"
+    normal_array = load_normals(normal_dst_path)
+    np.save(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.npy"), normal_array)
+    imwrite(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.png"), colorize_normals(normal_array))
+    normal_dst_path.unlink()
+
+    # Save depth visualization
+    depth_dst_path = frames_folder / f"Depth{output_stem}.exr"
+    depth_array = load_depth(depth_dst_path)
+    np.save(flow_dst_path.with_name(f"Depth{output_stem}.npy"), depth_array)
+    imwrite(depth_dst_path.with_name(f"Depth{output_stem}.png"), colorize_depth(depth_array))
+    depth_dst_path.unlink()
+
+    # Save segmentation visualization
+    seg_dst_path = frames_folder / f"IndexOB{output_stem}.exr"
+    seg_mask_array = load_seg_mask(seg_dst_path)
+    np.save(flow_dst_path.with_name(f"ObjectSegmentation{output_stem}.npy"), seg_mask_array)
+    imwrite(seg_dst_path.with_name(f"ObjectSegmentation{output_stem}.png"), colorize_int_array(seg_mask_array))
+    seg_dst_path.unlink()
+
+    # Save unique instances visualization
+    uniq_inst_path = frames_folder / f"UniqueInstances{output_stem}.exr"
+    #uniq_inst_array = load_uniq_inst(uniq_inst_path)
+    uniq_inst_tmp_path = f"{tmp_dir}/{frame:04d}.png"
+    uniq_inst_array = cv2.imread(uniq_inst_tmp_path)
+    np.save(flow_dst_path.with_name(f"InstanceSegmentation{output_stem}.npy"), uniq_inst_array)
+    shutil.copy(uniq_inst_tmp_path, str(flow_dst_path.with_name(f"InstanceSegmentation{output_stem}.png")))
+    uniq_inst_path.unlink()
+
+def postprocess_blendergt_outputs_with_distortion(frames_folder, output_stem, frame, tmp_dir, flat_shading, plan):
+
+    flow_dst_path = frames_folder / f"Vector{output_stem}.exr"
+    normal_dst_path = frames_folder / f"Normal{output_stem}.exr"
+    depth_dst_path = frames_folder / f"Depth{output_stem}.exr"
+    seg_dst_path = frames_folder / f"IndexOB{output_stem}.exr"
+    uniq_inst_path = frames_folder / f"UniqueInstances{output_stem}.exr"
+
+    uniq_inst_array = cv2.imread(f"{tmp_dir}/{frame:04d}.png")
+    cv2.imwrite(uniq_inst_path.with_name(f"InstanceSegmentation_undistorted{output_stem}.png"), uniq_inst_array)
+
+    # All passes of the frame share the plan's gather tables. Label maps only ever copy source labels,
+    # so they need no float conversion nor remove_segmap_noise
+    continuous = plan.apply_many(dict(
+        flow=load_flow(flow_dst_path),
+        normal=load_normals(normal_dst_path),
+        depth=load_depth(depth_dst_path),
+    ), interpolate=not flat_shading)
+    labels = dict(
+        seg_mask=plan.apply_labels(load_seg_mask(seg_dst_path)),
+        uniq_inst=plan.apply_labels(uniq_inst_array),
+    )
+
+    # Save flow visualization
+    flow_array = continuous['flow']
+    np.save(flow_dst_path.with_name(f"Flow{output_stem}.npy"), flow_array)
+    imwrite(flow_dst_path.with_name(f"Flow{output_stem}.png"), colorize_flow(flow_array))
+    flow_dst_path.unlink()
+
+    # Save surface normal visualization
+    normal_array = continuous['normal']
+    np.save(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.npy"), normal_array)
+    imwrite(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.png"), colorize_normals(normal_array))
+    normal_dst_path.unlink()
+
+    # Save depth visualization
+    depth_array = continuous['depth']
+    np.save(flow_dst_path.with_name(f"Depth{output_stem}.npy"), depth_array)
+    imwrite(depth_dst_path.with_name(f"Depth{output_stem}.png"), colorize_depth(depth_array))
+    depth_dst_path.unlink()
+
+    # Save segmentation visualization
+    seg_mask_array = labels['seg_mask']
+    np.save(flow_dst_path.with_name(f"ObjectSegmentation{output_stem}.npy"), seg_mask_array)
+    imwrite(seg_dst_path.with_name(f"ObjectSegmentation{output_stem}.png"), colorize_int_array(seg_mask_array))
+    seg_dst_path.unlink()
+
+    # Save unique instances visualization
+    uniq_inst_array = labels['uniq_inst']
+    np.save(flow_dst_path.with_name(f"InstanceSegmentation{output_stem}.npy"), uniq_inst_array)
+    cv2.imwrite(uniq_inst_path.with_name(f"InstanceSegmentation{output_stem}.png"), uniq_inst_array)
+    uniq_inst_path.unlink()
+
+def raw_gt_folder(frames_folder):
+    # a sibling of frames_folder, so reorganize_old_framesfolder moves its outputs to the same frames/ folder
+    frames_folder = Path(frames_folder)
+    return frames_folder.with_name(f'{frames_folder.name}_rawgt')
+
+def defer_blendergt_outputs(frames_folder, output_stem, frame, tmp_dir):
+
+    '''
+    Moves the raw passes of `frame` to raw_gt_folder(frames_folder) rather than postprocessing them
+    '''
+
+    raw_folder = raw_gt_folder(frames_folder)
+    (raw_folder/'tmp').mkdir(parents=True, exist_ok=True)
+    for name in RAW_PASSES:
+        shutil.move(frames_folder/f'{name}{output_stem}.exr', raw_folder/f'{name}{output_stem}.exr')
+    shutil.move(f'{tmp_dir}/{frame:04d}.png', raw_folder/'tmp'/f'{frame:04d}.png')
+
+def write_sidecar(frames_folder, output_stems, flat_shading, plan=None, mapping_path=None):
+
+    '''
+    output_stems: frame -> output suffix of every deferred frame
+    plan, mapping_path: the DistortionRemapPlan of the camera and the .npy mapping it was loaded from,
+        or None for undistorted cameras
+    '''
+
+    distortion = None
+    if plan is not None:
+        distortion = dict(
+            mapping_coords=str(Path(mapping_path).resolve()),
+            orig_resolution=[int(r) for r in plan.shape],
+            backend=plan.backend,
+            chunk_pixels=plan.chunk_pixels,
+            label_rule=plan.label_rule,
+        )
+    sidecar = dict(
+        frames={str(frame): stem for frame, stem in output_stems.items()},
+        flat_shading=flat_shading,
+        distortion=distortion,
+    )
+
+    path = raw_gt_folder(frames_folder)/'tmp'/SIDECAR
+    tmp_path = path.with_name(f'.{SIDECAR}.tmp-{os.getpid()}')
+    with tmp_path.open('w') as f:
+        json.dump(sidecar, f, indent=4)
+    os.replace(tmp_path, path)
+    logger.info(f'Deferred ground truth postprocessing of {len(output_stems)} frames to {path}')
+
+def load_sidecar_plan(distortion):
+    if distortion is None:
+        return None
+    mapping_coords = np.load(distortion['mapping_coords'], mmap_mode='r')
+    return DistortionRemapPlan.from_mapping_coords(
+        mapping_coords, *distortion['orig_resolution'], backend=distortion['backend'],
+        chunk_pixels=distortion['chunk_pixels'], label_rule=distortion['label_rule'])
+
+def postprocess_deferred_frame(raw_folder, frame, output_stem, flat_shading, plan):
+    if not (raw_folder/f'UniqueInstances{output_stem}.exr').exists():
+        logger.info(f'Skipping frame {frame}, already postprocessed')
+        return # the last pass to be removed, so the frame was done by an earlier attempt
+    tmp_dir = raw_folder/'tmp'
+    if plan is None:
+        postprocess_blendergt_outputs(raw_folder, output_stem, frame, tmp_dir)
+    else:
+        postprocess_blendergt_outputs_with_distortion(raw_folder, output_stem, frame, tmp_dir, flat_shading, plan)
+
+def postprocess_deferred(raw_folder, workers=4):
+
+    '''
+    Postprocesses every frame described by the sidecar in `raw_folder`, then moves the outputs to the frames/ folder
+    '''
+
+    tic = time.time()
+    raw_folder = Path(raw_folder)
+    with (raw_folder/'tmp'/SIDECAR).open('r') as f:
+        sidecar = json.load(f)
+
+    plan = load_sidecar_plan(sidecar['distortion'])
+    frames = sorted((int(frame), stem) for frame, stem in sidecar['frames'].items())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(postprocess_deferred_frame, raw_folder, frame, stem, sidecar['flat_shading'], plan)
+            for frame, stem in frames
+        ]
+        for future in futures:
+            future.result()
+
+    shutil.rmtree(raw_folder/'tmp')
+    reorganize_old_framesfolder(raw_folder)
+    logger.info(f'Postprocessed {len(frames)} ground truth frames in {time.time() - tic:.1f}s')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_folder', type=Path, required=True)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s.%(msecs)03d] [%(name)s] [%(levelname)s] | %(message)s')
+    postprocess_deferred(args.raw_folder, workers=args.workers)
+
+if __name__ == '__main__':
+    main()
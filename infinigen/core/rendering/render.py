@@ -14,6 +14,8 @@ import time
 import warnings
 import cv2
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import bpy
 import gin
@@ -27,13 +29,16 @@ from infinigen.core.rendering.post_render import (colorize_depth, colorize_flow,
                                    colorize_normals, colorize_int_array,
                                    load_depth, load_flow, load_normals,
                                    load_seg_mask, load_uniq_inst, load_exr)
+from infinigen.core.rendering.gt_postprocess import (postprocess_blendergt_outputs,
+                                   postprocess_blendergt_outputs_with_distortion,
+                                   defer_blendergt_outputs, write_sidecar)
 from infinigen.core import surface
 from infinigen.core.util import blender as butil
 from infinigen.core.util import exporting as exputil
 from infinigen.core.util.logging import Timer
 from infinigen.tools.datarelease_toolkit import reorganize_old_framesfolder
 from infinigen.tools.suffixes import get_suffix
-from infinigen.core.placement.bproc_camera_utility import apply_lens_distortion, load_distortion_parameters, remove_segmap_noise
+from infinigen.core.placement.bproc_camera_utility import load_distortion_plan, distortion_mapping_path
 from numpy.random import uniform as U
 
 
@@ -290,45 +295,6 @@ def global_flat_shading():
     for link in nw.links:
         nw.links.remove(link)
 
-def postprocess_blendergt_outputs(frames_folder, output_stem, frame, tmp_dir):
-
-    # Save flow visualization
-    flow_dst_path = frames_folder / f"Vector{output_stem}.exr"
-    flow_array = load_flow(flow_dst_path)
-    np.save(flow_dst_path.with_name(f"Flow{output_stem}.npy"), flow_array)
-    imwrite(flow_dst_path.with_name(f"Flow{output_stem}.png"), colorize_flow(flow_array))
-    flow_dst_path.unlink()
-
-    # Save surface normal visualization
-    normal_dst_path = frames_folder / f"Normal{output_stem}.exr"
-    normal_array = load_normals(normal_dst_path)
-    np.save(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.npy"), normal_array)
-    imwrite(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.png"), colorize_normals(normal_array))
-    normal_dst_path.unlink()
-
-    # Save depth visualization
-    depth_dst_path = frames_folder / f"Depth{output_stem}.exr"
-    depth_array = load_depth(depth_dst_path)
-    np.save(flow_dst_path.with_name(f"Depth{output_stem}.npy"), depth_array)
-    imwrite(depth_dst_path.with_name(f"Depth{output_stem}.png"), colorize_depth(depth_array))
-    depth_dst_path.unlink()
-
-    # Save segmentation visualization
-    seg_dst_path = frames_folder / f"IndexOB{output_stem}.exr"
-    seg_mask_array = load_seg_mask(seg_dst_path)
-    np.save(flow_dst_path.with_name(f"ObjectSegmentation{output_stem}.npy"), seg_mask_array)
-    imwrite(seg_dst_path.with_name(f"ObjectSegmentation{output_stem}.png"), colorize_int_array(seg_mask_array))
-    seg_dst_path.unlink()
-
-    # Save unique instances visualization
-    uniq_inst_path = frames_folder / f"UniqueInstances{output_stem}.exr"
-    #uniq_inst_array = load_uniq_inst(uniq_inst_path)
-    uniq_inst_tmp_path = f"{tmp_dir}/{frame:04d}.png"
-    uniq_inst_array = cv2.imread(uniq_inst_tmp_path)
-    np.save(flow_dst_path.with_name(f"InstanceSegmentation{output_stem}.npy"), uniq_inst_array)
-    shutil.copy(uniq_inst_tmp_path, str(flow_dst_path.with_name(f"InstanceSegmentation{output_stem}.png")))
-    uniq_inst_path.unlink()
-
 def configure_compositor(frames_folder, passes_to_save, flat_shading):
     compositor_node_tree = bpy.context.scene.node_tree
     nw = NodeWrangler(compositor_node_tree)
@@ -350,77 +316,99 @@ def configure_compositor(frames_folder, passes_to_save, flat_shading):
         saving_ground_truth=flat_shading
     )
 
-def postprocess_blendergt_outputs_with_distortion(frames_folder, output_stem, camera_id, frame, tmp_dir, flat_shading):
-    cam_ob = cam_util.get_camera(*camera_id)
-    mapping_coords, orig_res = load_distortion_parameters(cam_ob)
-
-    # Save flow visualization
-    flow_dst_path = frames_folder / f"Vector{output_stem}.exr"
-    flow_array = load_flow(flow_dst_path)
-    flow_array = apply_lens_distortion(flow_array, mapping_coords=mapping_coords,
-                                        orig_res_x=orig_res[1], orig_res_y=orig_res[0],
-                                        use_interpolation=not flat_shading)
-    np.save(flow_dst_path.with_name(f"Flow{output_stem}.npy"), flow_array)
-    imwrite(flow_dst_path.with_name(f"Flow{output_stem}.png"), colorize_flow(flow_array))
-    flow_dst_path.unlink()
-
-    # Save surface normal visualization
-    normal_dst_path = frames_folder / f"Normal{output_stem}.exr"
-    normal_array = load_normals(normal_dst_path)
-    normal_array = apply_lens_distortion(normal_array, mapping_coords=mapping_coords,
-                                        orig_res_x=orig_res[1], orig_res_y=orig_res[0],
-                                        use_interpolation=not flat_shading)
-    np.save(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.npy"), normal_array)
-    imwrite(flow_dst_path.with_name(f"SurfaceNormal{output_stem}.png"), colorize_normals(normal_array))
-    normal_dst_path.unlink()
-
-    # Save depth visualization
-    depth_dst_path = frames_folder / f"Depth{output_stem}.exr"
-    depth_array = load_depth(depth_dst_path)
-    depth_array = apply_lens_distortion(depth_array, mapping_coords=mapping_coords,
-                                        orig_res_x=orig_res[1], orig_res_y=orig_res[0],
-                                        use_interpolation=not flat_shading)
-    np.save(flow_dst_path.with_name(f"Depth{output_stem}.npy"), depth_array)
-    imwrite(depth_dst_path.with_name(f"Depth{output_stem}.png"), colorize_depth(depth_array))
-    depth_dst_path.unlink()
-
-    # Save segmentation visualization
-    seg_dst_path = frames_folder / f"IndexOB{output_stem}.exr"
-    seg_mask_array = load_seg_mask(seg_dst_path)
-    seg_mask_array = apply_lens_distortion(seg_mask_array, mapping_coords=mapping_coords,
-                                        orig_res_x=orig_res[1], orig_res_y=orig_res[0],
-                                        use_interpolation=not flat_shading)
-    np.save(flow_dst_path.with_name(f"ObjectSegmentation{output_stem}.npy"), seg_mask_array)
-    imwrite(seg_dst_path.with_name(f"ObjectSegmentation{output_stem}.png"), colorize_int_array(seg_mask_array))
-    seg_dst_path.unlink()
-
-    # Save unique instances visualization
-    uniq_inst_path = frames_folder / f"UniqueInstances{output_stem}.exr"
-    uniq_inst_array = load_exr(uniq_inst_path)
-    uniq_inst_array = cv2.imread(f"{tmp_dir}/{frame:04d}.png")
-    cv2.imwrite(uniq_inst_path.with_name(f"InstanceSegmentation_undistorted{output_stem}.png"), uniq_inst_array)
-    uniq_inst_array = apply_lens_distortion(uniq_inst_array, mapping_coords=mapping_coords,
-                                        orig_res_x=orig_res[1], orig_res_y=orig_res[0],
-                                        use_interpolation=not flat_shading)
-    np.save(flow_dst_path.with_name(f"InstanceSegmentation{output_stem}.npy"), uniq_inst_array)
-    cv2.imwrite(uniq_inst_path.with_name(f"InstanceSegmentation{output_stem}.png"), uniq_inst_array)
-    uniq_inst_path.unlink()
-
-def postprocess_apply_distortion(camera_id, frames_folder, output_stem, saving_ground_truth, output="Image"):
+def postprocess_apply_distortion(camera_id, frames_folder, output_stem, saving_ground_truth, output="Image", plan=None):
     # Distort Apply distortion
-    cam_ob = cam_util.get_camera(*camera_id)
-    mapping_coords, orig_res = load_distortion_parameters(cam_ob)
+    if plan is None:
+        plan = load_distortion_plan(cam_util.get_camera(*camera_id))
 
     image_dst_path = frames_folder / f"{output}{output_stem}.png"
     image_array = cv2.imread(image_dst_path)
-    image_array = apply_lens_distortion(image_array, mapping_coords=mapping_coords,
-                                                 orig_res_x=orig_res[1], orig_res_y=orig_res[0],
-                                                 use_interpolation=not saving_ground_truth)
+    image_array = plan.apply(image_array, interpolate=not saving_ground_truth)
 
     np.save(image_dst_path.with_name(f"{output}{output_stem}.npy"), image_array)
     imwrite(image_dst_path.with_name(f"{output}{output_stem}.png"), image_array)
 
 
+def frame_ranges(frames):
+
+    '''
+    Groups frames into a sorted list of inclusive (start, end) runs of consecutive frames
+    '''
+
+    ranges = []
+    for frame in sorted(set(frames)):
+        if ranges and frame == ranges[-1][1] + 1:
+            ranges[-1][1] = frame
+        else:
+            ranges.append([frame, frame])
+    return [tuple(r) for r in ranges]
+
+@gin.configurable
+class FramePostprocessor:
+
+    '''
+    Postprocesses the rendered frames. By default, every frame is postprocessed in turn on the main thread
+    by finish(), once the whole block is rendered.
+
+    Setting overlap instead submits each frame to a thread pool as soon as Blender has written its outputs.
+    This is opt-in and makes no speedup claim: whether the workers actually progress during a Cycles render
+    is unmeasured, and if bpy.ops.render.render holds the GIL they only run between render calls.
+
+    postprocess_frame: frame -> None, must not touch bpy as it may run off the main thread
+    workers: postprocessing threads, 1 postprocesses serially on the main thread unless overlap is set
+    max_pending: frames queued or in progress before the render waits for the oldest, bounds memory use
+    overlap: if True, frames are submitted from the render_write handler while rendering
+    '''
+
+    def __init__(self, postprocess_frame, frames, workers=1, max_pending=4, overlap=False):
+        self.postprocess_frame = postprocess_frame
+        self.frames = set(frames)
+        self.workers = workers
+        self.max_pending = max(max_pending, workers)
+        self.overlap = overlap
+        self.futures = {}
+        self.pending = deque()
+        self.executor = None
+
+    def submit(self, frame):
+        if frame not in self.frames or frame in self.futures:
+            return
+        while len(self.pending) >= self.max_pending:
+            # errors are raised by finish(), Blender would swallow them inside a handler
+            self.pending.popleft().exception()
+        future = self.executor.submit(self.postprocess_frame, frame)
+        self.futures[frame] = future
+        self.pending.append(future)
+
+    def on_render_write(self, scene, *args):
+        # render_write runs once the frame's compositor outputs and the render result are on disk
+        self.submit(scene.frame_current)
+
+    def finish(self):
+        if self.executor is None:
+            for frame in sorted(self.frames):
+                self.postprocess_frame(frame)
+            return
+        for frame in sorted(self.frames - self.futures.keys()):
+            self.submit(frame)
+        for frame in sorted(self.frames):
+            self.futures[frame].result()
+        self.pending.clear()
+
+    def __enter__(self):
+        if self.overlap or self.workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        if self.overlap:
+            bpy.app.handlers.render_write.append(self.on_render_write)
+        return self
+
+    def __exit__(self, *_):
+        if self.overlap:
+            bpy.app.handlers.render_write.remove(self.on_render_write)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
 @gin.configurable
 def render_image(
     camera_id,
@@ -431,9 +419,18 @@ def render_image(
     excludes=[],
     use_dof=False,
     dof_aperture_fstop=2.8,
-    apply_distortion=False
+    apply_distortion=False,
+    frames=None,
+    defer_gt_postprocess=False,
 ):
 
+    '''
+    frames: optional list of frames to render, eg from frame_selection. Frames outside the scene's
+        frame range are ignored. Defaults to every frame in the range
+    defer_gt_postprocess: if True, the ground truth passes are left unprocessed for a separate
+        gt_postprocess task, see gt_postprocess.defer_blendergt_outputs
+    '''
+
     tic = time.time()
 
     camera_rig_id, subcam_id = camera_id
@@ -495,30 +492,61 @@ def render_image(
 
     # Render the scene
     bpy.context.scene.camera = camera
-    with Timer("Actual rendering"):
-        bpy.ops.wm.save_mainfile(filepath="render.blend")
-        bpy.ops.render.render(animation=True)
-
-    with Timer("Post Processing"):
-        for frame in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end + 1):
-            if flat_shading:
-                bpy.context.scene.frame_set(frame)
-                suffix = get_suffix(dict(frame=frame, **indices))
-                if apply_distortion:
-                    postprocess_blendergt_outputs_with_distortion(frames_folder, suffix, camera_id, frame, tmp_dir, flat_shading)
-                else:
-                    postprocess_blendergt_outputs(frames_folder, suffix, frame, tmp_dir)
+    scene = bpy.context.scene
+    if frames is None:
+        render_frames = list(range(scene.frame_start, scene.frame_end + 1))
+    else:
+        render_frames = [f for f in frames if scene.frame_start <= f <= scene.frame_end]
+        logger.info(f'Rendering {len(render_frames)} selected frames of {scene.frame_start}-{scene.frame_end}')
+
+    # Everything that needs bpy is looked up here, frames are postprocessed off the main thread
+    plan = load_distortion_plan(camera) if apply_distortion else None
+
+    defer = flat_shading and defer_gt_postprocess
+
+    def postprocess_frame(frame):
+        suffix = get_suffix(dict(frame=frame, **indices))
+        if defer:
+            defer_blendergt_outputs(frames_folder, suffix, frame, tmp_dir)
+        elif flat_shading:
+            if apply_distortion:
+                postprocess_blendergt_outputs_with_distortion(
+                    frames_folder, suffix, frame, tmp_dir, flat_shading, plan)
+            else:
+                postprocess_blendergt_outputs(frames_folder, suffix, frame, tmp_dir)
+        elif apply_distortion:
+            # Note:  Need to have used set_lens_distortion when configuring cameras
+            postprocess_apply_distortion(camera_id, frames_folder, suffix, flat_shading, output="Image", plan=plan)
+
+    with FramePostprocessor(postprocess_frame, render_frames) as postprocessor:
+        with Timer("Actual rendering"):
+            bpy.ops.wm.save_mainfile(filepath="render.blend")
+            if frames is None:
+                bpy.ops.render.render(animation=True)
             else:
-                bpy.context.scene.frame_set(frame)
-                suffix = get_suffix(dict(frame=frame, **indices))
-                if apply_distortion:
-                    # Note:  Need to have used set_lens_distortion when configuring cameras
-                    postprocess_apply_distortion(camera_id, frames_folder, suffix, flat_shading, output="Image")
-                cam_util.save_camera_parameters(
-                    camera_ids=cam_util.get_cameras_ids(),
-                    output_folder=frames_folder,
-                    frame=frame
-                )
+                # render each run of consecutive frames as an animation so all outputs keep their usual
+                # frame-numbered names, and blender only sets up the render once per run
+                frame_start, frame_end = scene.frame_start, scene.frame_end
+                for start, end in frame_ranges(render_frames):
+                    scene.frame_start = start
+                    scene.frame_end = end
+                    bpy.ops.render.render(animation=True)
+                scene.frame_start, scene.frame_end = frame_start, frame_end
+
+        with Timer("Post Processing"):
+            postprocessor.finish()
+            if defer:
+                write_sidecar(
+                    frames_folder, {frame: get_suffix(dict(frame=frame, **indices)) for frame in render_frames},
+                    flat_shading, plan=plan, mapping_path=distortion_mapping_path(camera) if apply_distortion else None)
+            if not flat_shading:
+                for frame in render_frames:
+                    bpy.context.scene.frame_set(frame)
+                    cam_util.save_camera_parameters(
+                        camera_ids=cam_util.get_cameras_ids(),
+                        output_folder=frames_folder,
+                        frame=frame
+                    )
 
     for file in list(tmp_dir.glob('*png')) + list(tmp_dir.glob('*jpg')):
         file.unlink()
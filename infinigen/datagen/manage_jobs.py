@@ -56,6 +56,7 @@ from infinigen.datagen.util.submitit_emulator import (
     LocalScheduleHandler
 )
 from infinigen.core import execute_tasks, surface, init
+from infinigen.core.rendering.gt_postprocess import raw_gt_folder
 
 debug = False
 if debug:
@@ -193,6 +194,33 @@ def local_submit_cmd(cmd, folder, name, use_scheduler=False, **kwargs):
         return executor.submit(func)
 
 
+@gin.configurable
+def queue_gt_postprocess(
+        folder,
+        name,
+        taskname,
+        submit_cmd=local_submit_cmd,
+        workers=4,
+        cpus=None,
+        mem_gb=None,
+        hours=1,
+        **_
+):
+
+    '''
+    CPU-only task postprocessing the ground truth passes a render_image.defer_gt_postprocess task left
+    in raw_gt_folder, outside of Blender
+    '''
+
+    # tasks are named f'{name}{suffix}' by iterate_sequential_tasks, with the suffix of the block's frames folder
+    suffix = taskname[len(taskname.split('_')[0]):]
+    raw_folder = raw_gt_folder(folder / f'frames{suffix}')
+    cmd = [sys.executable, '-m', 'infinigen.core.rendering.gt_postprocess',
+           '--raw_folder', str(raw_folder), '--workers', str(workers)]
+    res = submit_cmd(cmd, folder=folder, name=name, gpus=0, cpus=cpus or workers, mem_gb=mem_gb, hours=hours)
+    return res, raw_folder
+
+
 def init_db_from_existing(output_folder: Path):
     # TODO in future: directly use existing_db (with some cleanup / checking).
 
@@ -545,7 +573,8 @@ def jobs_to_launch_next(
         # warning: may reduce throughput, especially if not using warmup_sec, or cluster capacity varies
         max_queued_task: int = None,
         max_queued_total: int = None,
-        max_stuck_at_task: int = None
+        max_stuck_at_task: int = None,
+        take_slot=None,
 ):
     def is_candidate_for_launch(scene):
         return (
@@ -606,6 +635,9 @@ def jobs_to_launch_next(
             if max_queued_total is not None and total_queued >= max_queued_total:
                 logging.info(f"{seed} - Not launching due to {total_queued=} > {max_queued_total} for {taskname}")
                 continue
+            # checked last, so a job which takes a slot is always yielded
+            if take_slot is not None and not take_slot(taskname):
+                continue
 
             yield scene, taskname, queue_func
 
@@ -647,19 +679,60 @@ def record_states(stats, totals, control_state):
     print("-" * 60)
 
 
+def select_jobs_to_launch(scenes, state_counts, try_to_launch, task_slots, **kwargs):
+
+    '''
+    Lazily yields up to `try_to_launch` jobs of tasks without their own limit, plus up to `task_slots[stem]`
+    jobs of each task with one. Jobs without a free slot are skipped inside jobs_to_launch_next, so they are
+    not counted as queued, and it is resumed no more times than there are free slots in total
+    '''
+
+    task_slots = dict(task_slots)
+    shared_slots = try_to_launch
+
+    def take_slot(taskname):
+        nonlocal shared_slots
+        stem = taskname.split('_')[0]
+        if stem in task_slots:
+            if task_slots[stem] <= 0:
+                return False
+            task_slots[stem] -= 1
+        elif shared_slots > 0:
+            shared_slots -= 1
+        else:
+            return False
+        return True
+
+    new_jobs = jobs_to_launch_next(scenes, state_counts, take_slot=take_slot, **kwargs)
+    return itertools.islice(new_jobs, try_to_launch + sum(task_slots.values()))
+
+
 @gin.configurable
-def manage_datagen_jobs(all_scenes, elapsed, num_concurrent, disk_sleep_threshold=0.95):
+def manage_datagen_jobs(all_scenes, elapsed, num_concurrent, disk_sleep_threshold=0.95, task_concurrency=None):
+
+    '''
+    task_concurrency: optional {task name: max jobs in flight}. These tasks do not count towards
+        num_concurrent, eg {'gtpostprocess': 32} to run CPU-only postprocessing on its own workers
+    '''
+
     if LocalScheduleHandler._inst is not None:
         sys.path = ORIG_SYS_PATH  # hacky workaround because bpy module breaks with multiprocessing
         LocalScheduleHandler.instance().poll()
         sys.path = BPY_SYS_PATH
 
+    task_concurrency = task_concurrency or {}
     state_counts = monitor_existing_jobs(all_scenes)
     stats, totals = stats_summary(state_counts)
-    control_state = compute_control_state(args, totals, elapsed, num_concurrent)
+    _, shared_totals = stats_summary({k: v for k, v in state_counts.items() if k[1] not in task_concurrency})
+    control_state = compute_control_state(args, shared_totals, elapsed, num_concurrent)
+
+    task_slots = {}
+    for stem, limit in task_concurrency.items():
+        in_flight = state_counts.get((JobState.Running, stem), 0) + state_counts.get((JobState.Queued, stem), 0)
+        control_state[f'n_in_flight_{stem}'] = in_flight
+        task_slots[stem] = max(limit - in_flight, 0)
 
-    new_jobs = jobs_to_launch_next(all_scenes, state_counts)
-    new_jobs = list(itertools.islice(new_jobs, control_state['try_to_launch']))
+    new_jobs = list(select_jobs_to_launch(all_scenes, state_counts, control_state['try_to_launch'], task_slots))
     control_state['will_launch'] = len(
         new_jobs)  # may be less due to jobs_to_launch optional kwargs, or running out of num_jobs
 
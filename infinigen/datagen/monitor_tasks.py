@@ -7,6 +7,7 @@
 # - Hei Law: initial version
 
 import itertools
+import json
 from functools import partial
 import logging
 from shutil import rmtree
@@ -140,6 +141,18 @@ def check_intermediate_cleanup(args, scene, idxs, stagetype_name, tasklist):
                 rmtree(path)
         scene[key] = True
 
+def load_render_frames(path):
+
+    '''
+    Per-rig lists of frames to render written by frame_selection.select_render_frames, or None to render every frame
+    '''
+
+    if not path.exists():
+        logger.warning(f'{path} does not exist, rendering the full frame range')
+        return None
+    with path.open('r') as f:
+        return {int(k): set(v) for k, v in json.load(f)['frames'].items()}
+
 @gin.configurable
 def iterate_scene_tasks(
     scene_dict,
@@ -164,7 +177,8 @@ def iterate_scene_tasks(
     #cleanup_viewdep=False, # TODO fix. Should cleanup the results of `view_dependent_tasks` once each view iter is done?
     viewdep_paralell=True, # can we work on multiple view depenendent tasks (usually `fine`) in paralell?
     camdep_paralell=True, # can we work on multiple camera dependent tasks (usually render/gt) in paralell?
-    ignore_first_camera=True
+    ignore_first_camera=True,
+    render_frames_file=None, # eg coarse/render_frames.json, frames to render per rig relative to the scene folder
 ):
 
     '''
@@ -212,6 +226,10 @@ def iterate_scene_tasks(
     if not state == JobState.Succeeded:
         return
 
+    render_frames = None
+    if render_frames_file is not None:
+        render_frames = load_render_frames(scene_folder/render_frames_file)
+
     # blender frame_range is inclusive, but python's range is end-exclusive
     view_range = render_frame_range if render_frame_range is not None else frame_range
     view_frames = range(view_range[0], view_range[1] + 1, view_block_size)
@@ -224,6 +242,9 @@ def iterate_scene_tasks(
     for cam_rig, view_frame in itertools.product(cam_rigs, view_frames):
 
         view_frame_range = [view_frame, min(frame_range[1], view_frame + view_block_size - 1)] 
+        rig_frames = None if render_frames is None else render_frames.get(cam_rig)
+        if rig_frames is not None and not any(view_frame_range[0] <= f <= view_frame_range[1] for f in rig_frames):
+            continue # nothing selected to render in this block
         view_overrides = [
             f'execute_tasks.frame_range=[{view_frame_range[0]},{view_frame_range[1]}]',
             f'execute_tasks.camera_id=[{cam_rig},{0}]'
@@ -263,6 +284,11 @@ def iterate_scene_tasks(
                     f'execute_tasks.camera_id=[{cam_rig},{subcam}]',
                     f'execute_tasks.resample_idx={resample_idx}'
                 ]
+                if rig_frames is not None:
+                    block_frames = sorted(f for f in rig_frames if cam_frame_range[0] <= f <= cam_frame_range[1])
+                    if not block_frames:
+                        continue
+                    cam_overrides.append(f'render_image.frames={block_frames}')
 
                 camdep_indices = dict(
                     cam_rig=cam_rig,
@@ -29,7 +29,9 @@ from infinigen.core.placement import (
     camera as cam_util,
     split_in_view, factory,
     animation_policy, instance_scatter, detail,
+    frame_selection, trajectory_cache,
 )
+from infinigen.core.placement.telemetry import animation_telemetry
 
 from infinigen.assets.scatters import (
     pebbles, grass, ground_leaves, ground_twigs, \
@@ -177,17 +179,25 @@ def compose_scene(output_folder, scene_seed, fps=24, **params):
 
     def camera_preprocess():
         camera_rigs = cam_util.spawn_camera_rigs()
-        scene_preprocessed = cam_util.camera_selection_preprocessing(terrain, terrain_mesh)
+        scene_preprocessed = cam_util.camera_selection_preprocessing(terrain, terrain_mesh, scene_seed=scene_seed)
         return camera_rigs, scene_preprocessed
     camera_rigs, scene_preprocessed = p.run_stage('camera_preprocess', camera_preprocess, use_chance=False)
 
-    bbox = terrain.get_bounding_box() if terrain is not None else butil.bounds(terrain_mesh)
-    p.run_stage(
-        'pose_cameras',
-        lambda: cam_util.configure_cameras(camera_rigs, bbox, scene_preprocessed),
-        use_chance=False
+    policy_registry = animation_policy.AnimPolicyMowTheLawn
+    traj_cache = trajectory_cache.TrajectoryCache(
+        output_folder/trajectory_cache.CACHE_FILENAME, scene_seed, scene_preprocessed, 
+        terrain_mesh, camera_rigs, policy=policy_registry
     )
 
+    bbox = terrain.get_bounding_box() if terrain is not None else butil.bounds(terrain_mesh)
+    def pose_cameras():
+        if traj_cache.hit:
+            traj_cache.apply_poses(camera_rigs)
+            return
+        cam_util.configure_cameras(camera_rigs, bbox, scene_preprocessed)
+        traj_cache.record_poses(camera_rigs)
+    p.run_stage('pose_cameras', pose_cameras, use_chance=False)
+
     p.run_stage(
         'configure_camera_parameters',
         lambda: cam_util.set_camera_parameters(camera_rigs),
@@ -234,8 +244,21 @@ def compose_scene(output_folder, scene_seed, fps=24, **params):
         return list(col.objects)
     #pois += p.run_stage('flying_creatures', flying_creatures, default=[])
 
-    p.run_stage('animate_cameras', lambda: cam_util.animate_cameras(
-        camera_rigs, scene_preprocessed, pois=pois, policy_registry=animation_policy.AnimPolicyMowTheLawn), use_chance=False)
+    def animate_cameras():
+        if traj_cache.hit:
+            traj_cache.apply_keyframes(camera_rigs)
+            return
+        cam_util.animate_cameras(camera_rigs, scene_preprocessed, pois=pois, policy_registry=policy_registry)
+        traj_cache.save(camera_rigs)
+        animation_telemetry.save(output_folder)
+    p.run_stage('animate_cameras', animate_cameras, use_chance=False)
+    if animation_telemetry.rigs:
+        p.results.append(dict(name='animate_cameras_telemetry', **animation_telemetry.stage_result()))
+
+    if params.get('select_render_frames', False):
+        # only read by iterate_scene_tasks when its render_frames_file is set
+        p.run_stage('select_render_frames', lambda: frame_selection.select_render_frames(
+            camera_rigs, scene_preprocessed, output_folder), use_chance=False)
 
     with logging_util.Timer('Compute coarse terrain frustrums'):
         terrain_inview, *_ = split_in_view.split_inview(
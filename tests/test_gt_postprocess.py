@@ -0,0 +1,83 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Runs the deferred ground truth postprocessing on a tiny synthetic block of frames, the way the
+gtpostprocess task does after a render_image.defer_gt_postprocess render.
+'''
+
+import os
+
+os.environ['OPENCV_IO_ENABLE_OPENEXR'] = '1' # must be set before cv2 is imported
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+gt_postprocess = pytest.importorskip('infinigen.core.rendering.gt_postprocess')
+
+from infinigen.core.placement.lens_distortion import DistortionRemapPlan
+from infinigen.core.rendering import post_render
+
+H, W = 12, 16
+FRAMES = [1, 2, 3]
+OUTPUTS = {
+    'Flow': post_render.load_flow,
+    'SurfaceNormal': post_render.load_normals,
+    'Depth': post_render.load_depth,
+    'ObjectSegmentation': post_render.load_seg_mask,
+}
+PASSES = {'Flow': 'Vector', 'SurfaceNormal': 'Normal', 'Depth': 'Depth', 'ObjectSegmentation': 'IndexOB'}
+
+def stem(frame):
+    return f'_0_0_{frame:04d}_0'
+
+def write_render(frames_folder, tmp_dir, frame, rng):
+    # what a flat shading render leaves behind for one frame
+    for name in gt_postprocess.RAW_PASSES:
+        image = rng.uniform(-1, 1, (H, W, 3)).astype(np.float32)
+        if name in ('IndexOB', 'UniqueInstances'):
+            image = rng.integers(0, 8, (H, W, 3)).astype(np.float32)
+        cv2.imwrite(str(frames_folder/f'{name}{stem(frame)}.exr'), image)
+    cv2.imwrite(str(tmp_dir/f'{frame:04d}.png'), rng.integers(0, 255, (H, W, 3)).astype(np.uint8))
+
+def find_output(scene_folder, name, frame):
+    matches = [p for p in scene_folder.rglob(f'{name}{stem(frame)}.npy') if '_rawgt' not in str(p)]
+    assert len(matches) == 1, f'Expected one {name} output for {frame=}, got {matches}'
+    return np.load(matches[0])
+
+@pytest.mark.parametrize('distorted', [False, True], ids=['undistorted', 'identity_distortion'])
+def test_postprocess_deferred(tmp_path, distorted):
+    rng = np.random.default_rng(0)
+    frames_folder = tmp_path/'frames_0_0_0001_0'
+    tmp_dir = tmp_path/'tmp'
+    frames_folder.mkdir()
+    tmp_dir.mkdir()
+
+    expected = {}
+    for frame in FRAMES:
+        write_render(frames_folder, tmp_dir, frame, rng)
+        for name, load in OUTPUTS.items():
+            expected[name, frame] = load(frames_folder/f'{PASSES[name]}{stem(frame)}.exr')
+        expected['InstanceSegmentation', frame] = cv2.imread(str(tmp_dir/f'{frame:04d}.png'))
+        gt_postprocess.defer_blendergt_outputs(frames_folder, stem(frame), frame, tmp_dir)
+
+    assert not list(frames_folder.glob('*.exr'))
+    plan, mapping_path = None, None
+    if distorted:
+        # maps every output pixel to the same source pixel, so distortion must leave the passes unchanged
+        rows, cols = np.mgrid[0:H, 0:W]
+        mapping_path = tmp_path/'mapping_coords.npy'
+        np.save(mapping_path, np.stack([rows.ravel(), cols.ravel()]).astype(np.float64))
+        plan = DistortionRemapPlan.from_mapping_coords(np.load(mapping_path), H, W)
+    gt_postprocess.write_sidecar(frames_folder, {f: stem(f) for f in FRAMES}, True, plan=plan, mapping_path=mapping_path)
+
+    raw_folder = gt_postprocess.raw_gt_folder(frames_folder)
+    gt_postprocess.postprocess_deferred(raw_folder, workers=2)
+
+    assert not (raw_folder/'tmp').exists()
+    assert not list(tmp_path.rglob('*.exr'))
+    for (name, frame), array in expected.items():
+        np.testing.assert_allclose(find_output(tmp_path, name, frame), array, rtol=1e-6, atol=1e-6)
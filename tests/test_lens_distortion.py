@@ -0,0 +1,89 @@
+# Copyright (c) Princeton University.
+# This source code is licensed under the BSD 3-Clause license found in the LICENSE file in the root directory of this source tree.
+
+# Authors: Heather Doig
+
+'''
+Distorts a synthetic checkerboard render with every lens model, and checks its corners land
+where the forward lens model projects them, and that cached mappings reload the same lens.
+'''
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gin')
+
+from infinigen.core.placement import distortion_cache
+from infinigen.core.placement.lens_distortion import (BrownConrady, DistortionRemapPlan,
+                                                      DivisionModel, KannalaBrandt, lens_from_dict)
+
+H, W = 120, 160
+K = np.array([[110., 0, 79.5], [0, 110., 59.5], [0, 0, 1]])
+SQUARE = 12 / K[0, 0] # checkerboard square size in normalized coordinates, 12 pixels at the center
+
+LENSES = [
+    BrownConrady(k1=-0.15, k2=0.02, p1=5e-4, p2=-3e-4),
+    KannalaBrandt(k1=0.02, k2=-0.005),
+    DivisionModel(l1=-0.1),
+]
+
+# max corner error in pixels, Brown-Conrady is only inverted to within invert_distortion's 0.15px tol
+MAX_ERROR = {'brown_conrady': 0.2, 'kannala_brandt': 0.05, 'division': 0.05}
+
+def distortion_mapping(lens):
+    bproc_camera_utility = pytest.importorskip('infinigen.core.placement.bproc_camera_utility')
+    render_K, render_res = bproc_camera_utility.compute_lens_distortion_render_intrinsics(K, H, W, lens)
+    mapping = bproc_camera_utility.compute_lens_distortion_mapping_for(K, render_K, render_res, H, W, lens)
+    return mapping, render_K, render_res
+
+def render_checkerboard(render_K, render_res):
+    # smooth checkerboard, its sign flips across the square edges and its saddle points are the corners
+    rows, cols = np.mgrid[0:render_res[1], 0:render_res[0]].astype(np.float64)
+    x = (cols - render_K[0, 2]) / render_K[0, 0]
+    y = (rows - render_K[1, 2]) / render_K[1, 1]
+    return (np.sin(np.pi * x / SQUARE) * np.sin(np.pi * y / SQUARE)).astype(np.float32)
+
+def saddle_point(image, center, half=1):
+    # subpixel corner from a least squares quadratic fit around an integer pixel
+    r0, c0 = center
+    dy, dx = np.mgrid[-half:half + 1, -half:half + 1].reshape(2, -1).astype(np.float64)
+    A = np.stack([np.ones_like(dx), dx, dy, dx * dx, dx * dy, dy * dy], axis=-1)
+    _, b, c, d, e, f = np.linalg.lstsq(A, image[r0 + dy.astype(int), c0 + dx.astype(int)], rcond=None)[0]
+    sx, sy = np.linalg.solve([[2 * d, e], [e, 2 * f]], [-b, -c])
+    return r0 + sy, c0 + sx
+
+@pytest.mark.parametrize('lens', LENSES, ids=lambda lens: lens.name)
+def test_checkerboard_corner_reprojection(lens):
+    mapping, render_K, render_res = distortion_mapping(lens)
+    plan = DistortionRemapPlan.from_mapping_coords(mapping, H, W)
+    distorted = plan.apply(render_checkerboard(render_K, render_res)).astype(np.float64)
+    assert distorted.shape == (H, W)
+
+    n = int(1.5 / SQUARE)
+    i, j = np.mgrid[-n:n + 1, -n:n + 1].reshape(2, -1) * SQUARE
+    xd, yd = lens.distort(i, j)
+    expected = np.stack([K[1, 1] * yd + K[1, 2], K[0, 0] * xd + K[0, 2]], axis=-1)
+    inside = ((expected >= 4) & (expected <= np.array([H, W]) - 5)).all(axis=-1)
+    expected = expected[inside]
+    assert len(expected) > 50
+
+    found = np.array([saddle_point(distorted, np.rint(p).astype(int)) for p in expected])
+    error = np.linalg.norm(found - expected, axis=-1)
+    assert error.max() < MAX_ERROR[lens.name], f'{lens.name} corners reproject up to {error.max():.3f}px away'
+
+@pytest.mark.parametrize('lens', LENSES, ids=lambda lens: lens.name)
+def test_cached_manifest_round_trip(lens, tmp_path):
+    mapping, render_K, render_res = distortion_mapping(lens)
+    key = distortion_cache.cache_key(K, (H, W), lens)
+    distortion_cache.save(tmp_path, key, mapping, K, render_K, render_res, (H, W), lens)
+
+    cached_lens = lens_from_dict(distortion_cache.load_manifest(tmp_path, key)['lens'])
+    assert type(cached_lens) is type(lens)
+    assert cached_lens.params() == lens.params()
+    assert distortion_cache.cache_key(K, (H, W), cached_lens) == key
+
+    cached_mapping, cached_K, cached_res, orig_res = distortion_cache.load(tmp_path, key)
+    np.testing.assert_array_equal(cached_mapping, mapping)
+    np.testing.assert_array_equal(cached_K, render_K)
+    np.testing.assert_array_equal(cached_res, render_res)
+    np.testing.assert_array_equal(orig_res, (H, W))